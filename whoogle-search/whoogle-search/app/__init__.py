@@ -1,25 +1,45 @@
+# Imported first, so that the startup report includes the time spent
+# importing dependencies
+from app.utils.startup import StartupReport, start_deferred_imports, \
+    IMPORT_START
 from app.filter import clean_query
-from app.request import send_tor_signal
-from app.utils.session import generate_key
-from app.utils.bangs import gen_bangs_json, load_all_bangs
-from app.utils.misc import gen_file_hash, read_config_bool
+from app.request import send_tor_signal, upstream_flights, \
+    upstream_scheduler
+from app.utils.results import compile_tabs
+from app.utils.scheduler import Scheduler
+from app.utils.session import generate_key, clear_invalid_sessions
+from app.utils.bangs import BangRefresher, load_all_bangs, \
+    BANG_WATCH_INTERVAL
+from app.utils.assets import build_cache_busting_map
+from app.utils.backends import parse_backends
+from app.utils.batch import RateLimiter
+from app.utils.page_cache import parse_cache_windows
+from app.utils.prefetch import TokenBucket
+from app.utils.search import backend_pool, page_cache, prefetcher
+from app.utils.compression import CompressionMiddleware
+from app.utils.metrics import register_app_metrics
+from app.utils.tracing import tracer
+from app.utils.misc import read_config_bool, check_for_update
 from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
 from bs4 import MarkupResemblesLocatorWarning
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
-from flask import Flask
+from flask import Flask, before_render_template, template_rendered, g
 import json
 import logging.config
 import os
-from stem import Signal
-import threading
+import sys
 import warnings
 
 from werkzeug.middleware.proxy_fix import ProxyFix
 
-from app.utils.misc import read_config_bool
+from app.models.endpoint import Endpoint
 from app.version import __version__
 
+startup_report = StartupReport(IMPORT_START)
+startup_report.mark('imports')
+
 app = Flask(__name__, static_folder=os.path.dirname(
     os.path.abspath(__file__)) + '/static')
 
@@ -31,8 +51,19 @@ dot_env_path = os.getenv(
     os.path.join(os.path.dirname(os.path.abspath(__file__)), "../whoogle.env"))
 
 # Load .env file if enabled
-if os.path.exists(dot_env_path):
-    load_dotenv(dot_env_path)
+with startup_report.phase('env'):
+    if os.path.exists(dot_env_path):
+        load_dotenv(dot_env_path)
+
+# Compress responses for clients that accept it. Proxied media from the
+# element endpoint is already compressed, so it is left alone.
+if read_config_bool('WHOOGLE_COMPRESSION', True):
+    app.wsgi_app = CompressionMiddleware(
+        app.wsgi_app,
+        br_level=int(os.getenv('WHOOGLE_COMPRESSION_BR_LEVEL', 4)),
+        gzip_level=int(os.getenv('WHOOGLE_COMPRESSION_GZIP_LEVEL', 6)),
+        min_size=int(os.getenv('WHOOGLE_COMPRESSION_MIN_SIZE', 1024)),
+        exclude_paths=[f'/{Endpoint.element}'])
 
 app.enc_key = generate_key()
 
@@ -50,24 +81,24 @@ app.config['STATIC_FOLDER'] = os.getenv(
 app.config['BUILD_FOLDER'] = os.path.join(
     app.config['STATIC_FOLDER'], 'build')
 app.config['CACHE_BUSTING_MAP'] = {}
-app.config['LANGUAGES'] = json.load(open(
-    os.path.join(app.config['STATIC_FOLDER'], 'settings/languages.json'),
-    encoding='utf-8'))
-app.config['COUNTRIES'] = json.load(open(
-    os.path.join(app.config['STATIC_FOLDER'], 'settings/countries.json'),
-    encoding='utf-8'))
-app.config['TIME_PERIODS'] = json.load(open(
-    os.path.join(app.config['STATIC_FOLDER'], 'settings/time_periods.json'),
-    encoding='utf-8'))
-app.config['TRANSLATIONS'] = json.load(open(
-    os.path.join(app.config['STATIC_FOLDER'], 'settings/translations.json'),
-    encoding='utf-8'))
-app.config['THEMES'] = json.load(open(
-    os.path.join(app.config['STATIC_FOLDER'], 'settings/themes.json'),
-    encoding='utf-8'))
-app.config['HEADER_TABS'] = json.load(open(
-    os.path.join(app.config['STATIC_FOLDER'], 'settings/header_tabs.json'),
-    encoding='utf-8'))
+
+# Settings files are small, and are needed to render the home page
+settings_files = {
+    'LANGUAGES': 'languages.json',
+    'COUNTRIES': 'countries.json',
+    'TIME_PERIODS': 'time_periods.json',
+    'TRANSLATIONS': 'translations.json',
+    'THEMES': 'themes.json',
+    'HEADER_TABS': 'header_tabs.json'
+}
+with startup_report.phase('settings'):
+    for config_key, settings_file in settings_files.items():
+        with open(os.path.join(app.config['STATIC_FOLDER'], 'settings',
+                               settings_file), encoding='utf-8') as f:
+            app.config[config_key] = json.load(f)
+    app.config['HEADER_TAB_TEMPLATES'] = compile_tabs(
+        app.config['HEADER_TABS'])
+
 app.config['CONFIG_PATH'] = os.getenv(
     'CONFIG_VOLUME',
     os.path.join(app.config['STATIC_FOLDER'], 'config'))
@@ -87,30 +118,25 @@ app.config['BANG_FILE'] = os.path.join(
     'bangs.json')
 
 # Ensure all necessary directories exist
-if not os.path.exists(app.config['CONFIG_PATH']):
-    os.makedirs(app.config['CONFIG_PATH'])
-
-if not os.path.exists(app.config['SESSION_FILE_DIR']):
-    os.makedirs(app.config['SESSION_FILE_DIR'])
-
-if not os.path.exists(app.config['BANG_PATH']):
-    os.makedirs(app.config['BANG_PATH'])
-
-if not os.path.exists(app.config['BUILD_FOLDER']):
-    os.makedirs(app.config['BUILD_FOLDER'])
+with startup_report.phase('directories'):
+    for folder in ['CONFIG_PATH', 'SESSION_FILE_DIR', 'BANG_PATH',
+                   'BUILD_FOLDER']:
+        if not os.path.exists(app.config[folder]):
+            os.makedirs(app.config[folder])
 
 # Session values
 app_key_path = os.path.join(app.config['CONFIG_PATH'], 'whoogle.key')
-if os.path.exists(app_key_path):
-    try:
-        app.config['SECRET_KEY'] = open(app_key_path, 'r').read()
-    except PermissionError:
+with startup_report.phase('secret_key'):
+    if os.path.exists(app_key_path):
+        try:
+            app.config['SECRET_KEY'] = open(app_key_path, 'r').read()
+        except PermissionError:
+            app.config['SECRET_KEY'] = str(b64encode(os.urandom(32)))
+    else:
         app.config['SECRET_KEY'] = str(b64encode(os.urandom(32)))
-else:
-    app.config['SECRET_KEY'] = str(b64encode(os.urandom(32)))
-    with open(app_key_path, 'w') as key_file:
-        key_file.write(app.config['SECRET_KEY'])
-        key_file.close()
+        with open(app_key_path, 'w') as key_file:
+            key_file.write(app.config['SECRET_KEY'])
+            key_file.close()
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=365)
 
 # NOTE: SESSION_COOKIE_SAMESITE must be set to 'lax' to allow the user's
@@ -125,6 +151,34 @@ app.config['RELEASES_URL'] = 'https://github.com/' \
 app.config['LAST_UPDATE_CHECK'] = datetime.now() - timedelta(hours=24)
 app.config['HAS_UPDATE'] = ''
 
+# Periodic maintenance tasks are run by the scheduler in the background, and
+# publish their results for requests to read
+app.scheduler = Scheduler()
+
+# Attempt to acquire tor identity, to determine if Tor config is available.
+# This is registered first so that it runs before the slower tasks, and
+# TOR_AVAILABLE stays unset until it has finished.
+app.scheduler.add_task('tor_check',
+                       lambda: send_tor_signal('HEARTBEAT'),
+                       5 * 60)
+
+
+def update_check() -> None:
+    app.config['HAS_UPDATE'] = check_for_update(
+        app.config['RELEASES_URL'],
+        app.config['VERSION_NUMBER'])
+    app.config['LAST_UPDATE_CHECK'] = datetime.now()
+
+
+if read_config_bool('WHOOGLE_UPDATE_CHECK', True):
+    app.scheduler.add_task('update_check', update_check, 24 * 60 * 60)
+
+app.scheduler.add_task(
+    'session_cleanup',
+    lambda: clear_invalid_sessions(app.config['SESSION_FILE_DIR'],
+                                   app.config['MAX_SESSION_SIZE']),
+    60 * 60)
+
 # The alternative to Google Translate is treated a bit differently than other
 # social media site alternatives, in that it is used for any translation
 # related searches.
@@ -142,55 +196,145 @@ app.config['CSP'] = 'default-src \'none\';' \
                     'media-src \'self\';' \
                     'connect-src \'self\';'
 
-# Generate DDG bang filter
-generating_bangs = False
+# Identical upstream requests that are in flight at the same time share one
+# response. Duplicates wait up to the timeout before sending their own.
+upstream_flights.enabled = read_config_bool('WHOOGLE_COALESCE', True)
+upstream_flights.timeout = float(os.getenv('WHOOGLE_COALESCE_TIMEOUT', 10))
+app.upstream_flights = upstream_flights
+
+# Upstream searches and suggestions are paced per egress identity (direct,
+# proxy or Tor), and the rate is halved each time upstream returns a captcha.
+# Requests only wait briefly for their turn, since each one holds a worker
+# thread while it waits.
+upstream_scheduler.enabled = read_config_bool('WHOOGLE_UPSTREAM_PACING', True)
+upstream_scheduler.max_wait = float(
+    os.getenv('WHOOGLE_UPSTREAM_MAX_WAIT', 1))
+upstream_scheduler.limiter_args = {
+    'max_rate': float(os.getenv('WHOOGLE_UPSTREAM_RATE', 10)),
+    'min_rate': float(os.getenv('WHOOGLE_UPSTREAM_MIN_RATE', 0.2)),
+    'burst': float(os.getenv('WHOOGLE_UPSTREAM_BURST', 20)),
+    'cooldown': float(os.getenv('WHOOGLE_UPSTREAM_COOLDOWN', 60))
+}
+app.upstream_scheduler = upstream_scheduler
+
+# Upstream result pages can be cached, and served while they're refreshed in
+# the background or when upstream requests fail (i.e. during captcha storms)
+if read_config_bool('WHOOGLE_PAGE_CACHE'):
+    page_cache.enabled = True
+    page_cache.max_entries = int(os.getenv('WHOOGLE_PAGE_CACHE_SIZE', 100))
+    page_cache.windows = parse_cache_windows(
+        os.getenv('WHOOGLE_PAGE_CACHE_WINDOWS', ''))
+    app.scheduler.add_task('page_cache_sweep', page_cache.sweep, 5 * 60,
+                           delay=5 * 60)
+app.page_cache = page_cache
+
+# The next page of results can be prefetched into the page cache, within a
+# budget of prefetches per minute
+if page_cache.enabled and read_config_bool('WHOOGLE_PREFETCH'):
+    prefetcher.enabled = True
+    prefetch_budget = int(os.getenv('WHOOGLE_PREFETCH_BUDGET', 30))
+    prefetcher.budget = TokenBucket(prefetch_budget, prefetch_budget / 60)
+    prefetcher.max_load = float(os.getenv('WHOOGLE_PREFETCH_MAX_LOAD', 1.0))
+app.prefetcher = prefetcher
+
+# Searches are hedged with the secondary backends (if any) when Google is
+# slow to respond or has been blocking requests
+backend_pool.backends += parse_backends(os.getenv('WHOOGLE_BACKENDS', ''))
+backend_pool.hedge_delay = float(os.getenv('WHOOGLE_HEDGE_DELAY', 2))
+# By default, every request thread can have an attempt in flight with each
+# backend at once
+backend_pool.max_workers = int(os.getenv(
+    'WHOOGLE_HEDGE_WORKERS',
+    int(os.getenv('WHOOGLE_WORKER_THREADS', 4)) * len(backend_pool.backends)))
+app.backend_pool = backend_pool
+
+# Queries in a batch search are run concurrently, but all batches share one
+# pool of threads and one upstream rate limit
+app.config['BATCH_CONCURRENCY'] = int(
+    os.getenv('WHOOGLE_BATCH_CONCURRENCY', 4))
+app.batch_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('WHOOGLE_BATCH_WORKERS',
+                              app.config['BATCH_CONCURRENCY'])),
+    thread_name_prefix='batch')
+app.config['BATCH_MAX_QUERIES'] = int(
+    os.getenv('WHOOGLE_BATCH_MAX_QUERIES', 100))
+app.batch_limiter = RateLimiter(
+    float(os.getenv('WHOOGLE_BATCH_RATE_LIMIT', 2)))
+
+# Runtime metrics can be served at /metrics (off by default, since they
+# reveal details of the instance such as its proxy and traffic). Requests are
+# handled by a fixed pool of worker threads, which the metrics report
+# utilization against.
+app.config['METRICS'] = read_config_bool('WHOOGLE_METRICS')
+app.config['WORKER_THREADS'] = int(os.getenv('WHOOGLE_WORKER_THREADS', 4))
+register_app_metrics(app)
+
+# Sampled requests (and requests with the X-Whoogle-Trace header) are traced,
+# and written to the trace file as OTLP/JSON lines
+tracer.enabled = read_config_bool('WHOOGLE_TRACING')
+tracer.sample_rate = float(os.getenv('WHOOGLE_TRACE_SAMPLE_RATE', 0.01))
+tracer.path = os.getenv('WHOOGLE_TRACE_FILE', os.path.join(
+    app.config['CONFIG_PATH'], 'traces.jsonl'))
+tracer.resource['service.version'] = app.config['VERSION_NUMBER']
+
+
+def trace_template(sender, template, context, **extra) -> None:
+    g.setdefault('template_spans', []).append(tracer.span(
+        'render_template', **{'whoogle.template': template.name}))
+
+
+def end_template_trace(sender, template, context, **extra) -> None:
+    if g.get('template_spans'):
+        g.template_spans.pop().__exit__(None, None, None)
+
+
+before_render_template.connect(trace_template, app)
+template_rendered.connect(end_template_trace, app)
+
+# Generate DDG bang filter (the full list is downloaded in the background)
 if not os.path.exists(app.config['BANG_FILE']):
-    generating_bangs = True
     json.dump({}, open(app.config['BANG_FILE'], 'w'))
-    bangs_thread = threading.Thread(
-        target=gen_bangs_json,
-        args=(app.config['BANG_FILE'],))
-    bangs_thread.start()
+app.config['BANG_REFRESH_INTERVAL'] = float(
+    os.getenv('WHOOGLE_BANG_REFRESH_INTERVAL', 24)) * 60 * 60
 
-# Build new mapping of static files for cache busting
+# Build new mapping of static files for cache busting. File hashes are kept in
+# a manifest in the build folder, so only changed files are hashed again.
 cache_busting_dirs = ['css', 'js']
-for cb_dir in cache_busting_dirs:
-    full_cb_dir = os.path.join(app.config['STATIC_FOLDER'], cb_dir)
-    for cb_file in os.listdir(full_cb_dir):
-        # Create hash from current file state
-        full_cb_path = os.path.join(full_cb_dir, cb_file)
-        cb_file_link = gen_file_hash(full_cb_dir, cb_file)
-        build_path = os.path.join(app.config['BUILD_FOLDER'], cb_file_link)
-
-        try:
-            os.symlink(full_cb_path, build_path)
-        except FileExistsError:
-            # Symlink hasn't changed, ignore
-            pass
-
-        # Create mapping for relative path urls
-        map_path = build_path.replace(app.config['APP_ROOT'], '')
-        if map_path.startswith('/'):
-            map_path = map_path[1:]
-        app.config['CACHE_BUSTING_MAP'][cb_file] = map_path
+with startup_report.phase('cache_busting'):
+    app.config['CACHE_BUSTING_MAP'] = build_cache_busting_map(
+        app.config['STATIC_FOLDER'],
+        app.config['BUILD_FOLDER'],
+        app.config['APP_ROOT'],
+        cache_busting_dirs)
 
 # Templating functions
 app.jinja_env.globals.update(clean_query=clean_query)
 app.jinja_env.globals.update(
     cb_url=lambda f: app.config['CACHE_BUSTING_MAP'][f.lower()])
 
-# Attempt to acquire tor identity, to determine if Tor config is available
-send_tor_signal(Signal.HEARTBEAT)
-
 # Suppress spurious warnings from BeautifulSoup
 warnings.simplefilter('ignore', MarkupResemblesLocatorWarning)
 
-from app import routes  # noqa
+with startup_report.phase('routes'):
+    from app import routes  # noqa
 
-# The gen_bangs_json function takes care of loading bangs, so skip it here if
-# it's already being loaded
-if not generating_bangs:
+# Load current bangs, and keep them up to date without blocking requests
+with startup_report.phase('bangs'):
     load_all_bangs(app.config['BANG_FILE'])
+bang_refresher = BangRefresher(app.config['BANG_FILE'],
+                               app.config['BANG_REFRESH_INTERVAL'])
+app.scheduler.add_task('bang_refresh', bang_refresher.check,
+                       BANG_WATCH_INTERVAL)
+
+app.scheduler.start()
+
+# Modules that aren't needed until a search is made are imported in the
+# background, instead of delaying startup
+start_deferred_imports()
+
+app.config['STARTUP_TIMINGS'] = startup_report.as_dict()
+if read_config_bool('WHOOGLE_STARTUP_REPORT'):
+    print(startup_report.format(), file=sys.stderr)
 
 # Disable logging from imported modules
 logging.config.dictConfig({
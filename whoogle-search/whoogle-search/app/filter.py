@@ -1,4 +1,3 @@
-import cssutils
 from bs4 import BeautifulSoup
 from bs4.element import ResultSet, Tag
 from cryptography.fernet import Fernet
@@ -10,7 +9,9 @@ import re
 
 from app.models.g_classes import GClasses
 from app.request import VALID_PARAMS, MAPS_URL
-from app.utils.misc import get_abs_url, read_config_bool
+from app.utils.fragments import render_logo
+from app.utils.misc import get_abs_url, read_config_bool, load_cssutils
+from app.utils.tracing import tracer
 from app.utils.results import (
     BLANK_B64, GOOG_IMG, GOOG_STATIC, G_M_LOGO_URL, LOGO_URL, SITE_ALTS,
     has_ad_content, filter_link_args, append_anon_view, get_site_alt,
@@ -95,6 +96,7 @@ def clean_css(css: str, page_url: str) -> str:
     Returns:
         str: The filtered CSS, with URLs proxied through Whoogle
     """
+    cssutils = load_cssutils()
     sheet = cssutils.parseString(css)
     urls = cssutils.getUrls(sheet)
 
@@ -153,6 +155,7 @@ class Filter:
 
         return Fernet(self.user_key).encrypt(path.encode()).decode()
 
+    @tracer.wrap('filter.clean')
     def clean(self, soup) -> BeautifulSoup:
         self.soup = soup
         self.main_divs = self.soup.find('div', {'id': 'main'})
@@ -189,19 +192,22 @@ class Filter:
         # self.main_divs is only populated for the main page of search results
         # (i.e. not images/news/etc).
         if self.main_divs:
-            for div in self.main_divs:
-                self.sanitize_div(div)
+            with tracer.span('filter.sanitize_divs'):
+                for div in self.main_divs:
+                    self.sanitize_div(div)
 
-        for img in [_ for _ in self.soup.find_all('img') if 'src' in _.attrs]:
-            self.update_element_src(img, 'image/png')
+        with tracer.span('filter.update_element_srcs'):
+            for img in [_ for _ in self.soup.find_all('img') if 'src' in _.attrs]:
+                self.update_element_src(img, 'image/png')
 
-        for audio in [_ for _ in self.soup.find_all('audio') if 'src' in _.attrs]:
-            self.update_element_src(audio, 'audio/mpeg')
-            audio['controls'] = ''
+            for audio in [_ for _ in self.soup.find_all('audio') if 'src' in _.attrs]:
+                self.update_element_src(audio, 'audio/mpeg')
+                audio['controls'] = ''
 
-        for link in self.soup.find_all('a', href=True):
-            self.update_link(link)
-            self.add_favicon(link)
+        with tracer.span('filter.update_links'):
+            for link in self.soup.find_all('a', href=True):
+                self.update_link(link)
+                self.add_favicon(link)
 
         if self.config.alts:
             self.site_alt_swap()
@@ -240,6 +246,50 @@ class Filter:
         self.remove_site_blocks(self.soup)
         return self.soup
 
+    @tracer.wrap('filter.prune')
+    def prune(self, soup) -> BeautifulSoup:
+        """Removes ads and blocked results from the page, without any of the
+        presentation changes made by clean. Used when results are extracted
+        directly from the upstream page.
+
+        Args:
+            soup: The upstream results page
+
+        Returns:
+            BeautifulSoup: The page without ads or blocked results
+        """
+        self.soup = soup
+        self.main_divs = self.soup.find('div', {'id': 'main'})
+
+        self.remove_ads()
+        self.remove_block_titles()
+        self.remove_block_url()
+        return self.soup
+
+    def resolve_link(self, href: str) -> str:
+        """Resolves an upstream result link to the page it leads to, without
+        modifying the page (unlike update_link)
+
+        Args:
+            href: The href of an upstream link
+
+        Returns:
+            str: The external url of the link, or an empty string for
+                 internal links
+        """
+        href = href.replace('https://www.google.com', '')
+        if 'url?q=' in href:
+            link = filter_link_args(
+                extract_q(urlparse.urlparse(href).query, href))
+        else:
+            link = href
+
+        if not link.startswith(('http://', 'https://')):
+            return ''
+
+        return get_site_alt(link) if self.config.alts else link
+
+    @tracer.wrap('filter.remove_google_icons')
     def remove_google_icons(self) -> None:
         """Removes only footer elements with Google logos, Privacy/Terms links, and location info while preserving search results
 
@@ -382,6 +432,7 @@ class Filter:
         target_cls.append('has-favicon')
         favicon_target['class'] = target_cls
 
+    @tracer.wrap('filter.remove_site_blocks')
     def remove_site_blocks(self, soup) -> None:
         if not self.config.block or not soup.body:
             return
@@ -393,6 +444,7 @@ class Filter:
             result.string.replace_with(result.string.replace(
                                        search_string, ''))
 
+    @tracer.wrap('filter.remove_ads')
     def remove_ads(self) -> None:
         """Removes ads found in the list of search result divs
 
@@ -407,6 +459,7 @@ class Filter:
                        if has_ad_content(_.text)]
             _ = div.decompose() if len(div_ads) else None
 
+    @tracer.wrap('filter.remove_images_section')
     def remove_images_section(self) -> None:
         """Removes the Images section from search results in the All tab
 
@@ -430,6 +483,7 @@ class Filter:
                 len(div.find_all('img', recursive=True)) > 2):
                 div.decompose()
 
+    @tracer.wrap('filter.remove_block_titles')
     def remove_block_titles(self) -> None:
         if not self.main_divs or not self.config.block_title:
             return
@@ -439,6 +493,7 @@ class Filter:
                           if block_title.search(_.text) is not None]
             _ = div.decompose() if len(block_divs) else None
 
+    @tracer.wrap('filter.remove_block_url')
     def remove_block_url(self) -> None:
         if not self.main_divs or not self.config.block_url:
             return
@@ -448,6 +503,7 @@ class Filter:
                           if block_url.search(_.attrs['href']) is not None]
             _ = div.decompose() if len(block_divs) else None
 
+    @tracer.wrap('filter.remove_block_tabs')
     def remove_block_tabs(self) -> None:
         if self.main_divs:
             for div in self.main_divs.find_all(
@@ -463,6 +519,7 @@ class Filter:
             ):
                 _ = div.decompose()
 
+    @tracer.wrap('filter.collapse_sections')
     def collapse_sections(self) -> None:
         """Collapses long result sections ("people also asked", "related
          searches", etc) into "details" elements
@@ -580,7 +637,7 @@ class Filter:
         if src.startswith(LOGO_URL):
             # Re-brand with Whoogle logo
             element.replace_with(BeautifulSoup(
-                render_template('logo.html'),
+                render_logo(),
                 features='html.parser'))
             return
         elif src.startswith(G_M_LOGO_URL):
@@ -599,6 +656,7 @@ class Filter:
             ) + '&type=' + urlparse.quote(mime)
         )
 
+    @tracer.wrap('filter.update_css')
     def update_css(self) -> None:
         """Updates URLs used in inline styles to be proxied by Whoogle
         using the /element endpoint.
@@ -616,6 +674,7 @@ class Filter:
         # for link in soup.find_all('link', attrs={'rel': 'stylesheet'}):
             # print(link)
 
+    @tracer.wrap('filter.update_styling')
     def update_styling(self) -> None:
         # Update CSS classes for result divs
         soup = GClasses.replace_css_classes(self.soup)
@@ -775,6 +834,7 @@ class Filter:
         ):
             link["target"] = "_blank"
 
+    @tracer.wrap('filter.site_alt_swap')
     def site_alt_swap(self) -> None:
         """Replaces link locations and page elements if "alts" config
         is enabled
@@ -824,6 +884,7 @@ class Filter:
 
                 link_desc.replace_with(new_desc)
 
+    @tracer.wrap('filter.view_image')
     def view_image(self, soup) -> BeautifulSoup:
         """Replaces the soup with a new one that handles mobile results and
         adds the link of the image full res to the results.
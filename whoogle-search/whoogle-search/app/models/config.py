@@ -1,25 +1,26 @@
 from inspect import Attribute
-from typing import Optional
-from app.utils.misc import read_config_bool
+from collections import OrderedDict
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Optional, TYPE_CHECKING
+from app.models.endpoint import Endpoint
+from app.utils.misc import read_config_bool, load_cssutils
 from flask import current_app
 import os
 from base64 import urlsafe_b64encode, urlsafe_b64decode
 from cryptography.fernet import Fernet
 import hashlib
 import brotli
-import logging
 import json
+import threading
 
-import cssutils
-from cssutils.css.cssstylesheet import CSSStyleSheet
-from cssutils.css.cssstylerule import CSSStyleRule
+if TYPE_CHECKING:
+    from cssutils.css.cssstylesheet import CSSStyleSheet
+    from cssutils.css.cssstylerule import CSSStyleRule
 
-# removes warnings from cssutils
-cssutils.log.setLevel(logging.CRITICAL)
 
-
-def get_rule_for_selector(stylesheet: CSSStyleSheet,
-                          selector: str) -> Optional[CSSStyleRule]:
+def get_rule_for_selector(stylesheet: 'CSSStyleSheet',
+                          selector: str) -> Optional['CSSStyleRule']:
     """Search for a rule that matches a given selector in a stylesheet.
 
     Args:
@@ -35,68 +36,314 @@ def get_rule_for_selector(stylesheet: CSSStyleSheet,
     return None
 
 
+class ConfigDefaults:
+    """Frozen, instance-wide config values derived from the environment.
+
+    These are read once per process and shared by every per-request Config,
+    which only stores the values that differ from them.
+
+    Attributes:
+        values: read-only mapping of every default config attribute
+        mutable_attrs: the attributes (and their types) that a user is
+            allowed to override
+    """
+    __slots__ = ('values', 'mutable_attrs')
+
+    def __init__(self) -> None:
+        values = {
+            # User agent configuration
+            'user_agent': 'LYNX_UA',
+            'custom_user_agent': '',
+            'use_custom_user_agent': False,
+            'safe_keys': (
+                'lang_search',
+                'lang_interface',
+                'country',
+                'theme',
+                'alts',
+                'new_tab',
+                'view_image',
+                'block',
+                'safe',
+                'nojs',
+                'anon_view',
+                'preferences_encrypted',
+                'tbs',
+                'user_agent',
+                'custom_user_agent',
+                'use_custom_user_agent'
+            ),
+            'url': os.getenv('WHOOGLE_CONFIG_URL', ''),
+            'lang_search': os.getenv('WHOOGLE_CONFIG_SEARCH_LANGUAGE', ''),
+            'lang_interface': os.getenv('WHOOGLE_CONFIG_LANGUAGE', ''),
+            'style_modified': os.getenv('WHOOGLE_CONFIG_STYLE', ''),
+            'block': os.getenv('WHOOGLE_CONFIG_BLOCK', ''),
+            'block_title': os.getenv('WHOOGLE_CONFIG_BLOCK_TITLE', ''),
+            'block_url': os.getenv('WHOOGLE_CONFIG_BLOCK_URL', ''),
+            'country': os.getenv('WHOOGLE_CONFIG_COUNTRY', ''),
+            'tbs': os.getenv('WHOOGLE_CONFIG_TIME_PERIOD', ''),
+            'theme': os.getenv('WHOOGLE_CONFIG_THEME', 'system'),
+            'safe': read_config_bool('WHOOGLE_CONFIG_SAFE'),
+            'dark': read_config_bool('WHOOGLE_CONFIG_DARK'),  # deprecated
+            'alts': read_config_bool('WHOOGLE_CONFIG_ALTS'),
+            'nojs': read_config_bool('WHOOGLE_CONFIG_NOJS'),
+            'tor': read_config_bool('WHOOGLE_CONFIG_TOR'),
+            'near': os.getenv('WHOOGLE_CONFIG_NEAR', ''),
+            'new_tab': read_config_bool('WHOOGLE_CONFIG_NEW_TAB'),
+            'view_image': read_config_bool('WHOOGLE_CONFIG_VIEW_IMAGE'),
+            'get_only': read_config_bool('WHOOGLE_CONFIG_GET_ONLY'),
+            'anon_view': read_config_bool('WHOOGLE_CONFIG_ANON_VIEW'),
+            'preferences_encrypted': read_config_bool(
+                'WHOOGLE_CONFIG_PREFERENCES_ENCRYPTED'),
+            'preferences_key': os.getenv(
+                'WHOOGLE_CONFIG_PREFERENCES_KEY', ''),
+            'accept_language': False
+        }
+
+        self.values = MappingProxyType(values)
+        self.mutable_attrs = MappingProxyType({
+            name: type(attr) for name, attr in values.items()
+            if type(attr) is bool or type(attr) is str})
+
+
+# Max number of distinct preferences tokens to keep encoded/decoded results for
+PREFERENCES_CACHE_SIZE = 256
+
+# Max number of distinct compiled theme stylesheets to keep in memory
+STYLE_CACHE_SIZE = 64
+
+_defaults = None
+_defaults_lock = threading.Lock()
+_default_config_files = {}
+_compiled_styles = OrderedDict()
+_compiled_styles_lock = threading.Lock()
+
+
+def get_config_defaults() -> ConfigDefaults:
+    """Returns the environment-derived config defaults, which are only read
+    from the environment on first use.
+
+    Returns:
+        ConfigDefaults -- the shared, read-only defaults
+    """
+    global _defaults
+    if _defaults is None:
+        with _defaults_lock:
+            if _defaults is None:
+                _defaults = ConfigDefaults()
+    return _defaults
+
+
+def reset_config_defaults() -> None:
+    """Discards the cached defaults, forcing the environment to be read
+    again on the next Config creation.
+    """
+    global _defaults
+    with _defaults_lock:
+        _defaults = None
+
+
+def load_default_config(config_file: str) -> dict:
+    """Loads the instance default config file (if one exists). The parsed
+    file is cached and only read again once its modification time changes.
+
+    Args:
+        config_file (str) -- the path to the default config json file
+
+    Returns:
+        dict -- a copy of the default config values
+    """
+    try:
+        mtime = os.stat(config_file).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+
+    cached = _default_config_files.get(config_file)
+    if cached is None or cached[0] != mtime:
+        with open(config_file) as f:
+            cached = (mtime, json.load(f))
+        _default_config_files[config_file] = cached
+
+    return dict(cached[1])
+
+
+def build_style(variables_file: str, style_modified: str) -> str:
+    """Merges the default style variables with a user's modifications.
+
+    Args:
+        variables_file (str) -- the path to the default variables stylesheet
+        style_modified (str) -- the user's custom css
+
+    Returns:
+        str -- the new style
+    """
+    cssutils = load_cssutils()
+    with open(variables_file) as f:
+        style_sheet = cssutils.parseString(f.read())
+
+    modified_sheet = cssutils.parseString(style_modified)
+    for rule in modified_sheet:
+        rule_default = get_rule_for_selector(style_sheet,
+                                             rule.selectorText)
+        # if modified rule is in default stylesheet, update it
+        if rule_default is not None:
+            # TODO: update this in a smarter way to handle :root better
+            # for now if we change a varialbe in :root all other default
+            # variables need to be also present
+            rule_default.style = rule.style
+        # else add the new rule to the default stylesheet
+        else:
+            style_sheet.add(rule)
+    return str(style_sheet.cssText, 'utf-8')
+
+
+def compile_style(variables_file: str, style_modified: str) -> tuple:
+    """Returns the compiled style for a user's modifications, building it
+    only if the (variables file mtime, modifications) pair hasn't been seen.
+
+    Args:
+        variables_file (str) -- the path to the default variables stylesheet
+        style_modified (str) -- the user's custom css
+
+    Returns:
+        tuple -- the (digest, css) of the compiled style, where the digest
+            can be used to serve the css as a cache-busted asset
+    """
+    mtime = os.stat(variables_file).st_mtime_ns
+    style_hash = hashlib.sha1(style_modified.encode()).hexdigest()
+    digest = hashlib.sha1(f'{mtime}:{style_hash}'.encode()).hexdigest()[:16]
+
+    with _compiled_styles_lock:
+        if digest in _compiled_styles:
+            _compiled_styles.move_to_end(digest)
+            return digest, _compiled_styles[digest]
+
+    css = build_style(variables_file, style_modified)
+    with _compiled_styles_lock:
+        _compiled_styles[digest] = css
+        while len(_compiled_styles) > STYLE_CACHE_SIZE:
+            _compiled_styles.popitem(last=False)
+
+    return digest, css
+
+
+def get_compiled_style(digest: str) -> Optional[str]:
+    """Looks up a previously compiled style by its digest.
+
+    Args:
+        digest (str) -- the digest returned by compile_style
+
+    Returns:
+        Optional[str] -- the compiled css, or None if it isn't cached
+    """
+    with _compiled_styles_lock:
+        return _compiled_styles.get(digest)
+
+
+def get_fernet_key(password: str) -> bytes:
+    hash_object = hashlib.md5(password.encode())
+    key = urlsafe_b64encode(hash_object.hexdigest().encode())
+    return key
+
+
+@lru_cache(maxsize=PREFERENCES_CACHE_SIZE)
+def encode_preferences(preferences_json: str, preferences_key: str) -> str:
+    """Compresses (and optionally encrypts) a serialized config into a
+    preferences token. Results are cached, since the same config is encoded
+    several times for each rendered page.
+
+    Args:
+        preferences_json (str) -- the json serialized config attributes
+        preferences_key (str) -- the key to encrypt the token with, or an
+            empty string for an unencrypted token
+
+    Returns:
+        str -- the token, without the leading encryption flag
+    """
+    compressed_preferences = brotli.compress(preferences_json.encode())
+
+    if preferences_key:
+        key = get_fernet_key(preferences_key)
+        encrypted_preferences = Fernet(key).encrypt(compressed_preferences)
+        compressed_preferences = brotli.compress(encrypted_preferences)
+
+    return urlsafe_b64encode(compressed_preferences).decode()
+
+
+@lru_cache(maxsize=PREFERENCES_CACHE_SIZE)
+def decode_preferences(preferences: str, preferences_key: str) -> bytes:
+    """Reverses encode_preferences for a preferences token, caching the
+    result per distinct token.
+
+    Args:
+        preferences (str) -- the token, including the leading encryption flag
+        preferences_key (str) -- the key to decrypt the token with, or an
+            empty string if the token isn't encrypted
+
+    Returns:
+        bytes -- the json serialized config, or empty bytes if the token
+            couldn't be decoded
+    """
+    try:
+        decoded_data = brotli.decompress(
+            urlsafe_b64decode(preferences[1:].encode() + b'=='))
+
+        if preferences[0] == 'e' and preferences_key:
+            # preferences are encrypted
+            key = get_fernet_key(preferences_key)
+            decrypted_data = Fernet(key).decrypt(decoded_data)
+            decoded_data = brotli.decompress(decrypted_data)
+    except Exception:
+        decoded_data = b''
+
+    return decoded_data
+
+
 class Config:
+    """A user's config, stored as an overlay of the values that differ from
+    the instance defaults (see ConfigDefaults). Attributes that haven't been
+    overridden are read through to the shared defaults.
+    """
+    __slots__ = ('_overrides',)
+
     def __init__(self, **kwargs):
-        # User agent configuration
-        self.user_agent = kwargs.get('user_agent', 'LYNX_UA')
-        self.custom_user_agent = kwargs.get('custom_user_agent', '')
-        self.use_custom_user_agent = kwargs.get('use_custom_user_agent', False)
-
-        # Add user agent related keys to safe_keys
-        self.safe_keys = [
-            'lang_search',
-            'lang_interface',
-            'country',
-            'theme',
-            'alts',
-            'new_tab',
-            'view_image',
-            'block',
-            'safe',
-            'nojs',
-            'anon_view',
-            'preferences_encrypted',
-            'tbs',
-            'user_agent',
-            'custom_user_agent',
-            'use_custom_user_agent'
-        ]
-
-        app_config = current_app.config
-        self.url = os.getenv('WHOOGLE_CONFIG_URL', '')
-        self.lang_search = os.getenv('WHOOGLE_CONFIG_SEARCH_LANGUAGE', '')
-        self.lang_interface = os.getenv('WHOOGLE_CONFIG_LANGUAGE', '')
-        self.style_modified = os.getenv(
-            'WHOOGLE_CONFIG_STYLE', '')
-        self.block = os.getenv('WHOOGLE_CONFIG_BLOCK', '')
-        self.block_title = os.getenv('WHOOGLE_CONFIG_BLOCK_TITLE', '')
-        self.block_url = os.getenv('WHOOGLE_CONFIG_BLOCK_URL', '')
-        self.country = os.getenv('WHOOGLE_CONFIG_COUNTRY', '')
-        self.tbs = os.getenv('WHOOGLE_CONFIG_TIME_PERIOD', '')
-        self.theme = os.getenv('WHOOGLE_CONFIG_THEME', 'system')
-        self.safe = read_config_bool('WHOOGLE_CONFIG_SAFE')
-        self.dark = read_config_bool('WHOOGLE_CONFIG_DARK')  # deprecated
-        self.alts = read_config_bool('WHOOGLE_CONFIG_ALTS')
-        self.nojs = read_config_bool('WHOOGLE_CONFIG_NOJS')
-        self.tor = read_config_bool('WHOOGLE_CONFIG_TOR')
-        self.near = os.getenv('WHOOGLE_CONFIG_NEAR', '')
-        self.new_tab = read_config_bool('WHOOGLE_CONFIG_NEW_TAB')
-        self.view_image = read_config_bool('WHOOGLE_CONFIG_VIEW_IMAGE')
-        self.get_only = read_config_bool('WHOOGLE_CONFIG_GET_ONLY')
-        self.anon_view = read_config_bool('WHOOGLE_CONFIG_ANON_VIEW')
-        self.preferences_encrypted = read_config_bool('WHOOGLE_CONFIG_PREFERENCES_ENCRYPTED')
-        self.preferences_key = os.getenv('WHOOGLE_CONFIG_PREFERENCES_KEY', '')
-
-        self.accept_language = False
+        overrides = {}
 
         # Skip setting custom config if there isn't one
         if kwargs:
             mutable_attrs = self.get_mutable_attrs()
             for attr in mutable_attrs:
                 if attr in kwargs.keys():
-                    setattr(self, attr, kwargs[attr])
-                elif attr not in kwargs.keys() and mutable_attrs[attr] == bool:
-                    setattr(self, attr, False)
+                    overrides[attr] = kwargs[attr]
+                elif mutable_attrs[attr] == bool:
+                    overrides[attr] = False
+
+        object.__setattr__(self, '_overrides', overrides)
+
+    def __getattr__(self, name):
+        # Only reached for names that aren't found on the class itself
+        if name == '_overrides':
+            raise AttributeError(name)
+
+        try:
+            return self._overrides[name]
+        except KeyError:
+            pass
+
+        try:
+            return get_config_defaults().values[name]
+        except KeyError:
+            raise AttributeError(
+                f"'Config' object has no attribute '{name}'") from None
+
+    def __setattr__(self, name, value):
+        self._overrides[name] = value
+
+    def __delattr__(self, name):
+        try:
+            del self._overrides[name]
+        except KeyError:
+            raise AttributeError(name) from None
 
     def __getitem__(self, name):
         return getattr(self, name)
@@ -111,14 +358,22 @@ class Config:
         return hasattr(self, name)
 
     def get_mutable_attrs(self):
-        return {name: type(attr) for name, attr in self.__dict__.items()
-                if not name.startswith("__")
-                and (type(attr) is bool or type(attr) is str)}
+        return dict(get_config_defaults().mutable_attrs)
+
+    def as_dict(self) -> dict:
+        """Returns all config values, with user overrides applied on top of
+        the instance defaults.
+
+        Returns:
+            dict -- the full set of config values
+        """
+        attrs = dict(get_config_defaults().values)
+        attrs.update(self._overrides)
+        return attrs
 
     def get_attrs(self):
-        return {name: attr for name, attr in self.__dict__.items()
-                if not name.startswith("__")
-                and (type(attr) is bool or type(attr) is str)}
+        return {name: attr for name, attr in self.as_dict().items()
+                if type(attr) is bool or type(attr) is str}
 
     @property
     def style(self) -> str:
@@ -127,25 +382,23 @@ class Config:
         Returns:
             str -- the new style
         """
-        style_sheet = cssutils.parseString(
-            open(os.path.join(current_app.config['STATIC_FOLDER'],
-                              'css/variables.css')).read()
-        )
-
-        modified_sheet = cssutils.parseString(self.style_modified)
-        for rule in modified_sheet:
-            rule_default = get_rule_for_selector(style_sheet,
-                                                 rule.selectorText)
-            # if modified rule is in default stylesheet, update it
-            if rule_default is not None:
-                # TODO: update this in a smarter way to handle :root better
-                # for now if we change a varialbe in :root all other default
-                # variables need to be also present
-                rule_default.style = rule.style
-            # else add the new rule to the default stylesheet
-            else:
-                style_sheet.add(rule)
-        return str(style_sheet.cssText, 'utf-8')
+        return compile_style(
+            os.path.join(current_app.config['STATIC_FOLDER'],
+                         'css/variables.css'),
+            self.style_modified)[1]
+
+    @property
+    def style_url(self) -> str:
+        """Returns the relative, cache-busted url of the compiled style.
+
+        Returns:
+            str -- the url to the stylesheet
+        """
+        digest = compile_style(
+            os.path.join(current_app.config['STATIC_FOLDER'],
+                         'css/variables.css'),
+            self.style_modified)[0]
+        return f'{Endpoint.style}/{digest}.css'
 
     @property
     def preferences(self) -> str:
@@ -240,37 +493,25 @@ class Config:
         return param_str
 
     def _get_fernet_key(self, password: str) -> bytes:
-        hash_object = hashlib.md5(password.encode())
-        key = urlsafe_b64encode(hash_object.hexdigest().encode())
-        return key
+        return get_fernet_key(password)
 
     def _encode_preferences(self) -> str:
-        preferences_json = json.dumps(self.get_attrs()).encode()
-        compressed_preferences = brotli.compress(preferences_json)
-
+        # The serialized config doubles as the cache key for its token
+        preferences_json = json.dumps(self.get_attrs())
+        preferences_key = ''
         if self.preferences_encrypted and self.preferences_key:
-            key = self._get_fernet_key(self.preferences_key)
-            encrypted_preferences = Fernet(key).encrypt(compressed_preferences)
-            compressed_preferences = brotli.compress(encrypted_preferences)
+            preferences_key = self.preferences_key
 
-        return urlsafe_b64encode(compressed_preferences).decode()
+        return encode_preferences(preferences_json, preferences_key)
 
     def _decode_preferences(self, preferences: str) -> dict:
-        mode = preferences[0]
-        preferences = preferences[1:]
+        preferences_key = (self.preferences_key
+                           if preferences[:1] == 'e' else '')
+        decoded_data = decode_preferences(preferences, preferences_key)
 
         try:
-            decoded_data = brotli.decompress(urlsafe_b64decode(preferences.encode() + b'=='))
-
-            if mode == 'e' and self.preferences_key:
-                # preferences are encrypted
-                key = self._get_fernet_key(self.preferences_key)
-                decrypted_data = Fernet(key).decrypt(decoded_data)
-                decoded_data = brotli.decompress(decrypted_data)
-
-            config = json.loads(decoded_data)
-        except Exception:
+            config = json.loads(decoded_data) if decoded_data else {}
+        except ValueError:
             config = {}
 
         return config
-
@@ -5,14 +5,17 @@ class Endpoint(Enum):
     autocomplete = 'autocomplete'
     home = 'home'
     healthz = 'healthz'
+    metrics = 'metrics'
     config = 'config'
     opensearch = 'opensearch.xml'
     search = 'search'
     search_html = 'search.html'
+    batch = 'batch'
     url = 'url'
     imgres = 'imgres'
     element = 'element'
     window = 'window'
+    style = 'style'
 
     def __str__(self):
         return self.value
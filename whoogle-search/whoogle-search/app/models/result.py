@@ -0,0 +1,127 @@
+class Result:
+    """A single search result, extracted from the upstream results page.
+
+    Attributes:
+        title: The result title
+        url: The url the result links to
+        display_url: The url as displayed under the title (breadcrumbs)
+        snippet: The text description of the result
+        type: The kind of result ('result', 'news', 'video' or 'image')
+        sitelinks: A list of (title, url) tuples for links within the
+                   result to other pages of the same site
+    """
+    __slots__ = ('title', 'url', 'display_url', 'snippet', 'type',
+                 'sitelinks')
+
+    def __init__(self,
+                 title: str,
+                 url: str,
+                 display_url: str = '',
+                 snippet: str = '',
+                 type: str = 'result',
+                 sitelinks: list = None) -> None:
+        self.title = title
+        self.url = url
+        self.display_url = display_url
+        self.snippet = snippet
+        self.type = type
+        self.sitelinks = sitelinks or []
+
+    def __repr__(self) -> str:
+        return f'Result({self.title!r}, {self.url!r})'
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Result) and self.as_dict() == other.as_dict()
+
+    def as_dict(self) -> dict:
+        return {
+            'title': self.title,
+            'url': self.url,
+            'display_url': self.display_url,
+            'snippet': self.snippet,
+            'type': self.type,
+            'sitelinks': [
+                {'title': title, 'url': url} for title, url in self.sitelinks
+            ]
+        }
+
+
+class Card:
+    """A special (non-result) card on the results page, such as a currency
+    conversion.
+
+    Attributes:
+        type: The kind of card (i.e. 'currency')
+        data: The values extracted from the card
+    """
+    __slots__ = ('type', 'data')
+
+    def __init__(self, type: str, data: dict) -> None:
+        self.type = type
+        self.data = data
+
+    def __repr__(self) -> str:
+        return f'Card({self.type!r}, {self.data!r})'
+
+    def as_dict(self) -> dict:
+        return {'type': self.type, **self.data}
+
+
+class ResultPage:
+    """The results and cards extracted from one page of upstream results.
+
+    Records are extracted once per page, so that later stages (feeling lucky
+    redirects, widgets, caching, etc) don't need to scan the page markup
+    again.
+
+    Attributes:
+        results: The results on the page, in order
+        cards: The special cards on the page
+        start: The result offset of the page
+        next_start: The result offset of the next page, or None
+        prev_start: The result offset of the previous page, or None
+    """
+    __slots__ = ('results', 'cards', 'start', 'next_start', 'prev_start')
+
+    def __init__(self,
+                 results: list = None,
+                 cards: list = None,
+                 start: int = 0,
+                 next_start: int = None,
+                 prev_start: int = None) -> None:
+        self.results = results or []
+        self.cards = cards or []
+        self.start = start
+        self.next_start = next_start
+        self.prev_start = prev_start
+
+    def __len__(self) -> int:
+        return len(self.results)
+
+    def __iter__(self):
+        return iter(self.results)
+
+    @property
+    def first_link(self) -> str:
+        return self.results[0].url if self.results else ''
+
+    def get_card(self, card_type: str):
+        """Finds the first card of a given type
+
+        Args:
+            card_type: The type of card to find
+
+        Returns:
+            Card: The card, or None if the page doesn't have one
+
+        """
+        return next((_ for _ in self.cards if _.type == card_type), None)
+
+    def as_dict(self) -> dict:
+        return {
+            'results': [_.as_dict() for _ in self.results],
+            'cards': [_.as_dict() for _ in self.cards],
+            'start': self.start,
+            'next_start': self.next_start,
+            'prev_start': self.prev_start
+        }
@@ -1,5 +1,11 @@
 from app.models.config import Config
-from app.utils.misc import read_config_bool
+from app.utils.admission import UpstreamScheduler, PRIORITY_AUTOCOMPLETE, \
+    PRIORITY_SEARCH
+from app.utils.coalesce import SingleFlight, normalize_url
+from app.utils.metrics import upstream_duration, upstream_responses, \
+    upstream_verdicts
+from app.utils.misc import read_config_bool, route_upstream
+from app.utils.tracing import tracer, SPAN_KIND_CLIENT
 from datetime import datetime
 from defusedxml import ElementTree as ET
 import random
@@ -7,10 +13,6 @@ import requests
 from requests import Response, ConnectionError
 import urllib.parse as urlparse
 import os
-from stem import Signal, SocketError
-from stem.connection import AuthenticationFailure
-from stem.control import Controller
-from stem.connection import authenticate_cookie, authenticate_password
 
 MAPS_URL = 'https://maps.google.com/maps'
 AUTOCOMPLETE_URL = ('https://suggestqueries.google.com/'
@@ -22,6 +24,26 @@ DESKTOP_UA = '{}/5.0 (X11; {} x86_64; rv:75.0) Gecko/20100101 {}/75.0'
 # Valid query params
 VALID_PARAMS = ['tbs', 'tbm', 'start', 'near', 'source', 'nfpr']
 
+# Verdicts of the upstream response classifier
+VERDICT_OK = 'ok'
+VERDICT_CAPTCHA = 'captcha'
+VERDICT_BLOCKED = 'blocked'
+VERDICT_ERROR = 'error'
+BLOCKED_VERDICTS = (VERDICT_CAPTCHA, VERDICT_BLOCKED)
+
+# Markers of a search results page that is blocked by a captcha, and the
+# path of the page that blocked requests are redirected to
+CAPTCHA_MARKERS = (b'div class="g-recaptcha"', b'form id="captcha-form"')
+SORRY_PATH = '/sorry/'
+
+# Identical upstream requests made at the same time (i.e. by users searching
+# for the same trending term) share a single response
+upstream_flights = SingleFlight()
+
+# Upstream requests are paced per egress identity, and slowed down when
+# upstream starts returning captchas
+upstream_scheduler = UpstreamScheduler()
+
 
 class TorError(Exception):
     """Exception raised for errors in Tor requests.
@@ -39,7 +61,16 @@ class TorError(Exception):
         super().__init__(message)
 
 
-def send_tor_signal(signal: Signal) -> bool:
+@tracer.wrap('tor.signal')
+def send_tor_signal(signal: str) -> bool:
+    tracer.annotate(**{'tor.signal': signal})
+
+    # stem is only imported when needed, since it is slow to import
+    from stem import SocketError
+    from stem.connection import AuthenticationFailure
+    from stem.control import Controller
+    from stem.connection import authenticate_cookie, authenticate_password
+
     use_pass = read_config_bool('WHOOGLE_TOR_USE_PASS')
 
     confloc = './misc/tor/control.conf'
@@ -72,6 +103,33 @@ def send_tor_signal(signal: Signal) -> bool:
     return False
 
 
+def classify_response(response: Response) -> str:
+    """Classifies an upstream search response from its status, redirects and
+    raw body, before the body is decoded or parsed
+
+    Args:
+        response: The upstream response
+
+    Returns:
+        str: One of the VERDICT_* values
+
+    """
+    if SORRY_PATH in (response.url or '') or any(
+            SORRY_PATH in _.headers.get('Location', '')
+            for _ in response.history):
+        return VERDICT_BLOCKED
+    elif response.status_code in (403, 429):
+        return VERDICT_BLOCKED
+    elif response.status_code >= 500:
+        return VERDICT_ERROR
+
+    body = response.content or b''
+    if any(_ in body for _ in CAPTCHA_MARKERS):
+        return VERDICT_CAPTCHA
+
+    return VERDICT_OK
+
+
 def gen_user_agent(config, is_mobile) -> str:
     # Define the Lynx user agent
     LYNX_UA = 'Lynx/2.9.2 libwww-FM/2.14 SSL-MM/1.4.1 OpenSSL/3.4.0'
@@ -195,7 +253,7 @@ class Request:
         self.search_url = 'https://www.google.com/search?gbv=1&num=' + str(results_per_page) + '&q='
         # Send heartbeat to Tor, used in determining if the user can or cannot
         # enable Tor for future requests
-        send_tor_signal(Signal.HEARTBEAT)
+        send_tor_signal('HEARTBEAT')
 
         self.language = config.lang_search if config.lang_search else ''
         self.country = config.country if config.country else ''
@@ -210,6 +268,8 @@ class Request:
 
         # Generate user agent based on config
         self.modified_user_agent = gen_user_agent(config, self.mobile)
+        self.random_user_agent = config.user_agent != 'LYNX_UA' and not (
+            config.user_agent == 'custom' and config.custom_user_agent)
         if not self.mobile:
             self.modified_user_agent_mobile = gen_user_agent(config, True)
 
@@ -238,6 +298,13 @@ class Request:
         self.tor_valid = False
         self.root_path = root_path
 
+        # The identity that upstream sees requests as coming from, which
+        # upstream requests are paced by
+        if proxy_path:
+            self.egress_identity = f'proxy:{proxy_path}'
+        else:
+            self.egress_identity = 'tor' if config.tor else 'direct'
+
     def __getitem__(self, name):
         return getattr(self, name)
 
@@ -260,7 +327,8 @@ class Request:
             ac_query['hl'] = self.lang_interface
 
         response = self.send(base_url=AUTOCOMPLETE_URL,
-                             query=urlparse.urlencode(ac_query)).text
+                             query=urlparse.urlencode(ac_query),
+                             priority=PRIORITY_AUTOCOMPLETE).text
 
         if not response:
             return []
@@ -273,8 +341,40 @@ class Request:
             # Malformed XML response
             return []
 
+    def get_user_agent(self, force_mobile=False, user_agent='') -> tuple:
+        """Determines the user agent to send upstream requests with
+
+        Args:
+            force_mobile: Optional flag to use a mobile user agent
+            user_agent: The user's own user agent
+
+        Returns:
+            tuple: The user agent, and a key for it that is the same for
+                   user agents that get the same response (used for sharing
+                   upstream responses between users)
+
+        """
+        use_client_user_agent = int(os.environ.get('WHOOGLE_USE_CLIENT_USER_AGENT', '0'))
+        if user_agent and use_client_user_agent == 1:
+            return user_agent, user_agent
+
+        if force_mobile and not self.mobile:
+            modified_user_agent = self.modified_user_agent_mobile
+        else:
+            modified_user_agent = self.modified_user_agent
+
+        # Generated user agents only differ in their (made up) browser
+        # names, which don't change the response
+        if self.random_user_agent:
+            agent_key = 'mobile' if force_mobile or self.mobile \
+                else 'desktop'
+            return modified_user_agent, agent_key
+        return modified_user_agent, modified_user_agent
+
+    @tracer.wrap('upstream.send')
     def send(self, base_url='', query='', attempt=0,
-             force_mobile=False, user_agent='') -> Response:
+             force_mobile=False, user_agent='',
+             priority=PRIORITY_SEARCH) -> Response:
         """Sends an outbound request to a URL. Optionally sends the request
         using Tor, if enabled by the user.
 
@@ -285,19 +385,19 @@ class Request:
                 (used for cycling through Tor identities, if enabled)
             force_mobile: Optional flag to enable a mobile user agent
                 (used for fetching full size images in search results)
+            priority: The priority of the request when waiting to be sent
+                (one of the PRIORITY_* values in app.utils.admission)
 
         Returns:
             Response: The Response object returned by the requests call
 
+        Raises:
+            AdmissionError: if a search or suggestion request wasn't
+                admitted by the upstream scheduler
+
         """
-        use_client_user_agent = int(os.environ.get('WHOOGLE_USE_CLIENT_USER_AGENT', '0'))
-        if user_agent and use_client_user_agent == 1:
-            modified_user_agent = user_agent
-        else:
-            if force_mobile and not self.mobile:
-                modified_user_agent = self.modified_user_agent_mobile
-            else:
-                modified_user_agent = self.modified_user_agent
+        modified_user_agent, agent_key = self.get_user_agent(force_mobile,
+                                                             user_agent)
 
         headers = {
             'User-Agent': modified_user_agent
@@ -318,12 +418,16 @@ class Request:
 
         # Validate Tor conn and request new identity if the last one failed
         if self.tor and not send_tor_signal(
-                Signal.NEWNYM if attempt > 0 else Signal.HEARTBEAT):
+                'NEWNYM' if attempt > 0 else 'HEARTBEAT'):
             raise TorError(
                 "Tor was previously enabled, but the connection has been "
                 "dropped. Please check your Tor configuration and try again.",
                 disable=True)
 
+        # A new Tor identity starts with a clean slate upstream
+        if self.tor and attempt > 0:
+            upstream_scheduler.reset(self.egress_identity)
+
         # Make sure that the tor connection is valid, if enabled
         if self.tor:
             try:
@@ -341,17 +445,68 @@ class Request:
                     "Error raised during Tor connection validation",
                     disable=True)
 
-        response = requests.get(
-            (base_url or self.search_url) + query,
-            proxies=self.proxies,
-            headers=headers,
-            cookies=cookies)
+        url = (base_url or self.search_url) + query
+        is_search = url.startswith(self.search_url)
+        # Only Google's search and suggestion services are paced, since
+        # they're what block an egress identity. Media and pages from other
+        # hosts (i.e. for the element endpoint) are sent straight away.
+        is_paced = is_search or url.startswith(AUTOCOMPLETE_URL)
+        url = route_upstream(url)
+
+        # The query string isn't traced, since it includes the user's query
+        tracer.annotate(**{'url.full': url.split('?')[0],
+                           'whoogle.egress': self.egress_identity,
+                           'whoogle.attempt': attempt,
+                           'whoogle.priority': priority})
+
+        def get() -> Response:
+            if is_paced:
+                with tracer.span('upstream.admission'):
+                    upstream_scheduler.acquire(self.egress_identity,
+                                               priority)
+            try:
+                with upstream_duration.time(self.egress_identity), \
+                        tracer.span('upstream.http', SPAN_KIND_CLIENT) as span:
+                    response = requests.get(
+                        url,
+                        proxies=self.proxies,
+                        headers=headers,
+                        cookies=cookies)
+                    if span is not None:
+                        span.set_attributes(**{
+                            'http.response.status_code':
+                                response.status_code,
+                            'http.response.body.size':
+                                len(response.content or b'')})
+            except Exception:
+                upstream_responses.inc(self.egress_identity, 'error')
+                raise
+            upstream_responses.inc(self.egress_identity,
+                                   str(response.status_code))
+
+            # Only search pages are blocked by captchas. Blocked pages are
+            # detected here, so that they don't need to be parsed.
+            response.verdict = VERDICT_OK
+            if is_search:
+                response.verdict = classify_response(response)
+                upstream_scheduler.on_response(self.egress_identity,
+                                               response.verdict)
+                upstream_verdicts.inc(self.egress_identity, response.verdict)
+            return response
+
+        flight_key = (normalize_url(url),
+                      agent_key,
+                      headers.get('Accept-Language', ''),
+                      tuple(sorted(self.proxies.items())))
+        response = upstream_flights.do(flight_key, get)
+        tracer.annotate(**{'whoogle.verdict': response.verdict})
 
         # Retry query with new identity if using Tor (max 10 attempts)
-        if 'form id="captcha-form"' in response.text and self.tor:
+        if response.verdict in BLOCKED_VERDICTS and self.tor:
             attempt += 1
             if attempt > 10:
                 raise TorError("Tor query failed -- max attempts exceeded 10")
-            return self.send((base_url or self.search_url), query, attempt)
+            return self.send((base_url or self.search_url), query, attempt,
+                             priority=priority)
 
         return response
@@ -2,6 +2,7 @@ import argparse
 import base64
 import io
 import json
+import mimetypes
 import os
 import pickle
 import re
@@ -9,29 +10,36 @@ import urllib.parse as urlparse
 import uuid
 import validators
 import sys
+import time
 import traceback
-from datetime import datetime, timedelta
-from functools import wraps
+from functools import partial, wraps
 
 import waitress
 from app import app
-from app.models.config import Config
+from app.models.config import Config, load_default_config, \
+    get_compiled_style
 from app.models.endpoint import Endpoint
 from app.request import Request, TorError
+from app.utils.admission import AdmissionError
+from app.utils.assets import get_asset_variant
+from app.utils.batch import BatchError, parse_batch_queries, run_batch
 from app.utils.bangs import suggest_bang, resolve_bang
 from app.utils.misc import empty_gif, placeholder_img, get_proxy_host_url, \
     fetch_favicon
 from app.filter import Filter
 from app.utils.misc import read_config_bool, get_client_ip, get_request_url, \
-    check_for_update, encrypt_string
+    encrypt_string
 from app.utils.widgets import *
-from app.utils.results import bold_search_terms,\
-    add_currency_card, check_currency, get_tabs_content
-from app.utils.search import Search, needs_https, has_captcha
+from app.utils.fragments import render_logo, render_search_header
+from app.utils import metrics
+from app.utils.tracing import tracer, TRACE_HEADER, TRACE_ID_HEADER
+from app.utils.results import bold_search_terms, add_currency_card
+from app.utils.search import Search, CaptchaError, needs_https, \
+    pipeline_stage
 from app.utils.session import valid_user_session
 from bs4 import BeautifulSoup as bsoup
 from flask import jsonify, make_response, request, redirect, render_template, \
-    send_file, session, url_for, g
+    send_file, send_from_directory, session, stream_with_context, url_for, g
 from requests import exceptions
 from requests.models import PreparedRequest
 from cryptography.fernet import Fernet, InvalidToken
@@ -91,65 +99,35 @@ def session_required(f):
         # a session based key is always used.
         g.session_key = app.enc_key
 
-        # Clear out old sessions
-        invalid_sessions = []
-        for user_session in os.listdir(app.config['SESSION_FILE_DIR']):
-            file_path = os.path.join(
-                app.config['SESSION_FILE_DIR'],
-                user_session)
-
-            try:
-                # Ignore files that are larger than the max session file size
-                if os.path.getsize(file_path) > app.config['MAX_SESSION_SIZE']:
-                    continue
-
-                with open(file_path, 'rb') as session_file:
-                    _ = pickle.load(session_file)
-                    data = pickle.load(session_file)
-                    if isinstance(data, dict) and 'valid' in data:
-                        continue
-                    invalid_sessions.append(file_path)
-            except Exception:
-                # Broad exception handling here due to how instances installed
-                # with pip seem to have issues storing unrelated files in the
-                # same directory as sessions
-                pass
-
-        for invalid_session in invalid_sessions:
-            try:
-                os.remove(invalid_session)
-            except FileNotFoundError:
-                # Don't throw error if the invalid session has been removed
-                pass
-
         return f(*args, **kwargs)
 
     return decorated
 
 
 @app.before_request
+def start_request_trace():
+    g.request_start = time.perf_counter()
+    metrics.requests_in_flight.inc()
+
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    g.trace = tracer.start_trace(
+        f'{request.method} {route}',
+        force=request.headers.get(TRACE_HEADER) == '1',
+        **{'http.request.method': request.method, 'http.route': route})
+
+
+@app.before_request
+@tracer.wrap('before_request')
 def before_request_func():
     session.permanent = True
 
-    # Check for latest version if needed
-    now = datetime.now()
-    needs_update_check = now - timedelta(hours=24) > app.config['LAST_UPDATE_CHECK']
-    if read_config_bool('WHOOGLE_UPDATE_CHECK', True) and needs_update_check:
-        app.config['LAST_UPDATE_CHECK'] = now
-        app.config['HAS_UPDATE'] = check_for_update(
-            app.config['RELEASES_URL'],
-            app.config['VERSION_NUMBER'])
-
     g.request_params = (
         request.args if request.method == 'GET' else request.form
     )
 
-    default_config = json.load(open(app.config['DEFAULT_CONFIG'])) \
-        if os.path.exists(app.config['DEFAULT_CONFIG']) else {}
-
     # Generate session values for user if unavailable
     if not valid_user_session(session):
-        session['config'] = default_config
+        session['config'] = load_default_config(app.config['DEFAULT_CONFIG'])
         session['uuid'] = str(uuid.uuid4())
         session['key'] = app.enc_key
         session['auth'] = False
@@ -175,7 +153,10 @@ def before_request_func():
 def after_request_func(resp):
     resp.headers['X-Content-Type-Options'] = 'nosniff'
     resp.headers['X-Frame-Options'] = 'DENY'
-    resp.headers['Cache-Control'] = 'max-age=86400'
+
+    # Fingerprinted assets and metrics set their own caching policy
+    if not resp.cache_control.immutable and not resp.cache_control.no_store:
+        resp.headers['Cache-Control'] = 'max-age=86400'
 
     if os.getenv('WHOOGLE_CSP', False):
         resp.headers['Content-Security-Policy'] = app.config['CSP']
@@ -183,9 +164,34 @@ def after_request_func(resp):
             resp.headers['Content-Security-Policy'] += \
                 'upgrade-insecure-requests'
 
+    if 'request_start' in g:
+        # Routes are labelled by their rule, to keep the number of labels
+        # bounded
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.http_requests.inc(route, request.method,
+                                  str(resp.status_code))
+        metrics.http_duration.observe(
+            time.perf_counter() - g.request_start, route)
+
+    if g.get('trace'):
+        g.trace.set_attributes(
+            **{'http.response.status_code': resp.status_code})
+        resp.headers[TRACE_ID_HEADER] = g.trace.trace.trace_id
+
     return resp
 
 
+@app.teardown_request
+def teardown_request_func(e):
+    if 'request_start' in g:
+        metrics.requests_in_flight.dec()
+
+    if g.get('trace'):
+        if e is not None:
+            g.trace.record_error(e)
+        g.trace.end()
+
+
 @app.errorhandler(404)
 def unknown_page(e):
     app.logger.warn(e)
@@ -197,6 +203,18 @@ def healthz():
     return ''
 
 
+@app.route(f'/{Endpoint.metrics}', methods=['GET'])
+@auth_required
+def metrics_page():
+    if not app.config['METRICS']:
+        return make_response('', 404)
+
+    resp = make_response(metrics.registry.render())
+    resp.headers['Content-Type'] = metrics.CONTENT_TYPE
+    resp.cache_control.no_store = True
+    return resp
+
+
 @app.route('/', methods=['GET'])
 @app.route(f'/{Endpoint.home}', methods=['GET'])
 @auth_required
@@ -217,14 +235,13 @@ def index():
                            translation=app.config['TRANSLATIONS'][
                                g.user_config.get_localization_lang()
                            ],
-                           logo=render_template(
-                               'logo.html',
-                               dark=g.user_config.dark),
+                           logo=render_logo(g.user_config.dark),
                            config_disabled=(
                                    app.config['CONFIG_DISABLE'] or
                                    not valid_user_session(session)),
                            config=g.user_config,
-                           tor_available=int(os.environ.get('TOR_AVAILABLE')),
+                           tor_available=int(
+                               os.environ.get('TOR_AVAILABLE', 0)),
                            version_number=app.config['VERSION_NUMBER'])
 
 
@@ -288,6 +305,52 @@ def autocomplete():
         g.user_request.autocomplete(q) if not g.user_config.tor else []
     ])
 
+def disable_tor(e: TorError) -> None:
+    session['error_message'] = e.message + (
+        "\\n\\nTor config is now disabled!" if e.disable else "")
+    session['config']['tor'] = False if e.disable else session['config'][
+        'tor']
+
+
+def search_json(search_util: Search, query: str):
+    try:
+        results = search_util.generate_results()
+    except TorError as e:
+        disable_tor(e)
+        return jsonify({'error': e.message}), 503
+    except CaptchaError:
+        app.logger.error('503 (CAPTCHA)')
+        return jsonify({'error': 'Blocked by captcha'}), 503
+    except AdmissionError as e:
+        return jsonify({'error': str(e)}), 503
+
+    if search_util.feeling_lucky and results.first_link:
+        return redirect(results.first_link, code=303)
+
+    search_util.prefetch_next_page()
+    return jsonify({
+        'query': query,
+        'search_type': search_util.search_type,
+        **results.as_dict()
+    })
+
+
+def render_blocked(query: str, translation: dict):
+    fallback_engine = os.environ.get('WHOOGLE_FALLBACK_ENGINE_URL', '')
+    if (fallback_engine):
+        return redirect(fallback_engine + query)
+
+    return render_template(
+        'error.html',
+        blocked=True,
+        error_message=translation['ratelimit'],
+        translation=translation,
+        farside='https://farside.link',
+        config=g.user_config,
+        query=urlparse.unquote(query),
+        params=g.user_config.to_params(keys=['preferences'])), 503
+
+
 @app.route(f'/{Endpoint.search}', methods=['GET', 'POST'])
 @session_required
 @auth_required
@@ -306,22 +369,17 @@ def search():
     if bang:
         return redirect(bang)
 
+    json_format = g.request_params.get('format') == 'json'
+
     # Redirect to home if invalid/blank search
     if not query:
+        if json_format:
+            return jsonify({'error': 'No query provided'}), 400
         return redirect(url_for('.index'))
 
-    # Generate response and number of external elements from the page
-    try:
-        response = search_util.generate_response()
-    except TorError as e:
-        session['error_message'] = e.message + (
-            "\\n\\nTor config is now disabled!" if e.disable else "")
-        session['config']['tor'] = False if e.disable else session['config'][
-            'tor']
-        return redirect(url_for('.index'))
-
-    if search_util.feeling_lucky:
-        return redirect(response, code=303)
+    # Structured results skip all of the page rendering below
+    if json_format:
+        return search_json(search_util, query)
 
     # If the user is attempting to translate a string, determine the correct
     # string for formatting the lingva.ml url
@@ -329,93 +387,155 @@ def search():
     translation = app.config['TRANSLATIONS'][localization_lang]
     translate_to = localization_lang.replace('lang_', '')
 
-    # removing st-card to only use whoogle time selector
-    soup = bsoup(response, "html.parser");
-    for x in soup.find_all(attrs={"id": "st-card"}):
-        x.replace_with("")
+    # Generate response and number of external elements from the page
+    try:
+        response = search_util.generate_response()
+    except TorError as e:
+        disable_tor(e)
+        return redirect(url_for('.index'))
+    except CaptchaError:
+        # Return 503 if temporarily blocked by captcha
+        app.logger.error('503 (CAPTCHA)')
+        return render_blocked(query, translation)
+    except AdmissionError:
+        # Upstream is being paced after recent captchas, and this request
+        # couldn't get a turn in time
+        app.logger.error('503 (upstream rate limited)')
+        return render_blocked(query, translation)
 
-    response = str(soup)
+    if search_util.feeling_lucky:
+        return redirect(response, code=303)
 
-    # Return 503 if temporarily blocked by captcha
-    if has_captcha(str(response)):
-        app.logger.error('503 (CAPTCHA)')
-        fallback_engine = os.environ.get('WHOOGLE_FALLBACK_ENGINE_URL', '')
-        if (fallback_engine):
-            return redirect(fallback_engine + query)
-        
-        return render_template(
-            'error.html',
-            blocked=True,
-            error_message=translation['ratelimit'],
-            translation=translation,
-            farside='https://farside.link',
-            config=g.user_config,
-            query=urlparse.unquote(query),
-            params=g.user_config.to_params(keys=['preferences'])), 503
+    # Users often continue on to the next page of results
+    search_util.prefetch_next_page()
 
-    response = bold_search_terms(response, query)
+    with pipeline_stage('highlight'):
+        response = bold_search_terms(response, query)
 
     # check for widgets and add if requested
     if search_util.widget != '':
-        html_soup = bsoup(str(response), 'html.parser')
         if search_util.widget == 'ip':
-            response = add_ip_card(html_soup, get_client_ip(request))
+            response = add_ip_card(response, get_client_ip(request))
         elif search_util.widget == 'calculator' and not 'nojs' in request.args:
-            response = add_calculator_card(html_soup)
-
-    # Update tabs content
-    tabs = get_tabs_content(app.config['HEADER_TABS'],
-                            search_util.full_query,
-                            search_util.search_type,
-                            g.user_config.preferences,
-                            translation)
+            response = add_calculator_card(response)
 
     # Feature to display currency_card
     # Since this is determined by more than just the
     # query is it not defined as a standard widget
-    conversion = check_currency(str(response))
+    conversion = search_util.results.get_card('currency')
     if conversion:
-        html_soup = bsoup(str(response), 'html.parser')
-        response = add_currency_card(html_soup, conversion)
+        response = add_currency_card(response, conversion.data)
 
-    preferences = g.user_config.preferences
-    home_url = f"home?preferences={preferences}" if preferences else "home"
     cleanresponse = str(response).replace("andlt;","&lt;").replace("andgt;","&gt;")
 
-    return render_template(
-        'display.html',
-        has_update=app.config['HAS_UPDATE'],
-        query=urlparse.unquote(query),
-        search_type=search_util.search_type,
-        search_name=get_search_name(search_util.search_type),
-        config=g.user_config,
-        autocomplete_enabled=autocomplete_enabled,
-        lingva_url=app.config['TRANSLATE_URL'],
-        translation=translation,
-        translate_to=translate_to,
-        translate_str=query.replace(
-            'translate', ''
-        ).replace(
-            translation['translate'], ''
-        ),
-        is_translation=any(
-            _ in query.lower() for _ in [translation['translate'], 'translate']
-        ) and not search_util.search_type,  # Standard search queries only
-        response=cleanresponse,
-        version_number=app.config['VERSION_NUMBER'],
-        search_header=render_template(
-            'header.html',
-            home_url=home_url,
-            config=g.user_config,
-            translation=translation,
-            languages=app.config['LANGUAGES'],
-            countries=app.config['COUNTRIES'],
-            time_periods=app.config['TIME_PERIODS'],
-            logo=render_template('logo.html', dark=g.user_config.dark),
+    with pipeline_stage('render'):
+        return render_template(
+            'display.html',
+            has_update=app.config['HAS_UPDATE'],
             query=urlparse.unquote(query),
             search_type=search_util.search_type,
-            mobile=g.user_request.mobile,
-            tabs=tabs)).replace("  ", "")
+            search_name=get_search_name(search_util.search_type),
+            config=g.user_config,
+            autocomplete_enabled=autocomplete_enabled,
+            lingva_url=app.config['TRANSLATE_URL'],
+            translation=translation,
+            translate_to=translate_to,
+            translate_str=query.replace(
+                'translate', ''
+            ).replace(
+                translation['translate'], ''
+            ),
+            is_translation=any(
+                _ in query.lower() for _ in [translation['translate'], 'translate']
+            ) and not search_util.search_type,  # Standard search queries only
+            response=cleanresponse,
+            version_number=app.config['VERSION_NUMBER'],
+            search_header=render_search_header(
+                g.user_config,
+                localization_lang,
+                g.user_request.mobile,
+                urlparse.unquote(query),
+                search_util.full_query,
+                search_util.search_type)).replace("  ", "")
+
+
+def run_batch_query(search_util: Search, user_request: Request) -> dict:
+    """Runs one query of a batch search in a batch worker thread, reporting
+    any errors in the returned item instead of raising them
+
+    Args:
+        search_util: The search for the query
+        user_request: The user's outbound request handler
+
+    Returns:
+        dict: The status and extracted results of the query, or its error
+
+    """
+    with app.app_context():
+        g.user_request = user_request
+        app.batch_limiter.wait()
+        try:
+            results = search_util.generate_results()
+        except TorError as e:
+            return {'status': 503, 'error': e.message}
+        except CaptchaError:
+            app.logger.error('503 (CAPTCHA)')
+            return {'status': 503, 'error': 'Blocked by captcha'}
+        except AdmissionError as e:
+            return {'status': 503, 'error': str(e)}
+        except exceptions.RequestException as e:
+            return {'status': 502,
+                    'error': f'Upstream request failed ({type(e).__name__})'}
+        except Exception:
+            app.logger.exception('Batch query failed')
+            return {'status': 500, 'error': 'Internal error'}
+
+    return {
+        'status': 200,
+        'search_type': search_util.search_type,
+        **results.as_dict()
+    }
+
+
+@app.route(f'/{Endpoint.batch}', methods=['POST'])
+@session_required
+@auth_required
+def batch():
+    try:
+        queries = parse_batch_queries(request.get_json(silent=True),
+                                      app.config['BATCH_MAX_QUERIES'])
+    except BatchError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # Request handling is set up once for the whole batch, and shared by
+    # each of its queries
+    tasks = []
+    for params in queries:
+        search_util = Search(request, g.user_config, g.session_key,
+                             params=params)
+        query = search_util.new_search_query()
+        bang = resolve_bang(query) if query else ''
+        if not query:
+            tasks.append(partial(dict, status=400, error='No query provided'))
+        elif bang:
+            tasks.append(partial(dict, status=302, redirect=bang))
+        else:
+            tasks.append(partial(run_batch_query, search_util,
+                                 g.user_request))
+
+    def stream():
+        # Results are sent in the order that queries finish, so each item
+        # includes the index of its query in the batch
+        for idx, result in run_batch(tasks, app.batch_executor,
+                                     app.config['BATCH_CONCURRENCY']):
+            yield json.dumps({
+                'index': idx,
+                'query': queries[idx]['q'],
+                **result
+            }) + '\n'
+
+    return app.response_class(stream_with_context(stream()),
+                              mimetype='application/x-ndjson')
 
 
 @app.route(f'/{Endpoint.config}', methods=['GET', 'POST', 'PUT'])
@@ -433,7 +553,7 @@ def config():
             return make_response('Invalid config name', 400)
 
     if request.method == 'GET':
-        return json.dumps(g.user_config.__dict__)
+        return json.dumps(g.user_config.as_dict())
     elif request.method == 'PUT' and not config_disabled:
         if name:
             config_pkl = os.path.join(app.config['CONFIG_PATH'], name)
@@ -525,6 +645,45 @@ def element():
     return send_file(io.BytesIO(empty_gif), mimetype='image/gif')
 
 
+@app.route(f'/{Endpoint.style}/<string:digest>.css')
+def style(digest):
+    # Compiled styles are addressed by digest, so they can be cached forever
+    css = get_compiled_style(digest)
+    if css is None:
+        if g.user_config.style_url != f'{Endpoint.style}/{digest}.css':
+            return make_response('', 404)
+        css = g.user_config.style
+
+    response = make_response(css, 200)
+    response.mimetype = 'text/css'
+    response.cache_control.public = True
+    response.cache_control.max_age = 31536000
+    response.cache_control.immutable = True
+    return response
+
+
+@app.route('/static/build/<path:filename>')
+def build_asset(filename):
+    # Hashed assets never change, so can be cached forever. Precompressed
+    # variants are served to clients that accept them.
+    variant, encoding = get_asset_variant(app.config['BUILD_FOLDER'],
+                                          filename,
+                                          request.accept_encodings)
+    response = send_from_directory(
+        app.config['BUILD_FOLDER'],
+        variant,
+        mimetype=mimetypes.guess_type(filename)[0],
+        download_name=os.path.basename(filename),
+        max_age=31536000)
+
+    if encoding:
+        response.content_encoding = encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
 @app.route(f'/{Endpoint.window}')
 @session_required
 @auth_required
@@ -728,9 +887,11 @@ def run_app() -> None:
     if args.debug:
         app.run(host=args.host, port=args.port, debug=args.debug)
     elif args.unix_socket:
-        waitress.serve(app, unix_socket=args.unix_socket, unix_socket_perms=args.unix_socket_perms)
+        waitress.serve(app, unix_socket=args.unix_socket, unix_socket_perms=args.unix_socket_perms,
+                       threads=app.config['WORKER_THREADS'])
     else:
         waitress.serve(
             app,
             listen="{}:{}".format(args.host, args.port),
-            url_prefix=os.environ.get('WHOOGLE_URL_PREFIX', ''))
+            url_prefix=os.environ.get('WHOOGLE_URL_PREFIX', ''),
+            threads=app.config['WORKER_THREADS'])
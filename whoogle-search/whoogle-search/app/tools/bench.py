@@ -0,0 +1,327 @@
+"""Benchmarks the filter and search pipeline over the corpus of upstream
+result pages (see app.tools.corpus), without any network access.
+
+Each stage is measured on every page of the corpus: filtering the page
+(Filter.clean), highlighting the query (bold_search_terms), finding currency
+conversions (check_currency) and rendering a whole html or json /search
+response with upstream requests stubbed out. Query generation (gen_query)
+and tab rendering (get_tabs_content) are measured once per search type.
+
+Results are written as JSON, and can be compared with an earlier run:
+
+    python -m app.tools.bench --output before.json
+    python -m app.tools.bench --output after.json --compare before.json
+"""
+import argparse
+from contextlib import contextmanager, redirect_stdout
+from datetime import datetime, timezone
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from typing import Callable
+
+from app.tools.corpus import DEFAULT_QUERY, RECORD_USER_AGENTS, TABS, \
+    CorpusPage, load_corpus
+
+# Changes in the median smaller than this (as a fraction) aren't reported as
+# regressions or improvements when comparing runs
+DEFAULT_THRESHOLD = 0.1
+
+
+def summarize(timings: list) -> dict:
+    """Summarizes the timings of a benchmark
+
+    Args:
+        timings: The time of each iteration, in seconds
+
+    Returns:
+        dict: The statistics of the timings, in milliseconds
+
+    """
+    timings = sorted(_ * 1000 for _ in timings)
+    return {
+        'iterations': len(timings),
+        'mean_ms': round(statistics.fmean(timings), 4),
+        'median_ms': round(statistics.median(timings), 4),
+        'p95_ms': round(timings[min(len(timings) - 1,
+                                    int(len(timings) * 0.95))], 4),
+        'min_ms': round(timings[0], 4),
+        'max_ms': round(timings[-1], 4),
+        'stdev_ms': round(statistics.stdev(timings), 4)
+        if len(timings) > 1 else 0.0
+    }
+
+
+def measure(func: Callable, iterations: int,
+            setup: Callable = None) -> list:
+    """Times a function, after a warm up run
+
+    Args:
+        func: The function to time, which is passed the result of setup
+        iterations: The number of timed runs
+        setup: Prepares the input of each run, outside of the timing
+
+    Returns:
+        list: The time of each run, in seconds
+
+    """
+    timings = []
+    for idx in range(iterations + 1):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        func(arg) if setup else func()
+        if idx:
+            timings.append(time.perf_counter() - start)
+    return timings
+
+
+@contextmanager
+def stub_upstream(pages: dict):
+    """Replaces upstream requests with pages from the corpus
+
+    Args:
+        pages: The CorpusPage to respond with, by search type and device
+
+    """
+    from requests.models import Response
+    from app.request import Request
+
+    def send(self, base_url='', query='', *args, **kwargs) -> Response:
+        search_type = ''
+        for tbm in TABS:
+            if tbm and f'tbm={tbm}' in query:
+                search_type = tbm
+        page = pages[(search_type, 'mobile' if self.mobile else 'desktop')]
+        response = Response()
+        response.status_code = 200
+        response._content = page.html.encode()
+        response.encoding = 'utf-8'
+        response.verdict = 'ok'
+        return response
+
+    original_send = Request.send
+    Request.send = send
+    try:
+        yield
+    finally:
+        Request.send = original_send
+
+
+def bench_page(app, page: CorpusPage, iterations: int,
+               query: str = DEFAULT_QUERY) -> list:
+    """Benchmarks the stages that work on a page of results
+
+    Args:
+        app: The Flask app
+        page: The corpus page
+        iterations: The number of timed runs of each stage
+        query: The query the page is for
+
+    Returns:
+        list: The results of each stage
+
+    """
+    from bs4 import BeautifulSoup
+    from app.filter import Filter
+    from app.models.config import Config
+    from app.utils.results import bold_search_terms, check_currency
+
+    results = []
+
+    def add(name: str, timings: list) -> None:
+        results.append({'name': name, 'page': page.name, **summarize(timings)})
+
+    path = f'/search?q={query}&tbm={page.search_type}'
+    with app.test_request_context(path):
+        config = Config(**{})
+
+        def clean(soup) -> BeautifulSoup:
+            return Filter(app.enc_key, config=config,
+                          root_url='http://localhost:5000/',
+                          mobile=page.mobile, query=query).clean(soup)
+
+        add('filter_clean', measure(
+            clean, iterations,
+            setup=lambda: BeautifulSoup(page.html, 'html.parser')))
+
+        cleaned = str(clean(BeautifulSoup(page.html, 'html.parser')))
+        add('bold_search_terms', measure(
+            lambda: bold_search_terms(cleaned, query), iterations))
+        add('check_currency', measure(
+            lambda: check_currency(cleaned), iterations))
+
+    client = app.test_client()
+    headers = {'User-Agent': RECORD_USER_AGENTS[page.device]}
+    with stub_upstream({(page.search_type, page.device): page}):
+        for name, url in (('search_html', path),
+                          ('search_json', path + '&format=json')):
+            def search() -> None:
+                rv = client.get(url, headers=headers)
+                assert rv.status_code == 200, rv.status_code
+
+            add(name, measure(search, iterations))
+    return results
+
+
+def bench_queries(app, iterations: int, query: str = DEFAULT_QUERY) -> list:
+    """Benchmarks the stages that only depend on the query and search type
+
+    Args:
+        app: The Flask app
+        iterations: The number of timed runs of each stage
+        query: The query to benchmark
+
+    Returns:
+        list: The results of each stage
+
+    """
+    from werkzeug.datastructures import MultiDict
+    from app.models.config import Config
+    from app.request import gen_query
+    from app.utils.results import get_tabs_content
+
+    results = []
+    translation = app.config['TRANSLATIONS']['lang_en']
+    with app.test_request_context('/search'):
+        config = Config(**{})
+        for search_type, tab in TABS.items():
+            args = MultiDict({'q': query, 'tbm': search_type, 'start': '10'}
+                             if search_type else {'q': query})
+            full_query = gen_query(query, args, config)
+            for name, func in (
+                    ('gen_query', lambda: gen_query(query, args, config)),
+                    ('get_tabs_content', lambda: get_tabs_content(
+                        app.config['HEADER_TAB_TEMPLATES'], full_query,
+                        search_type, config.preferences, translation))):
+                results.append({'name': name, 'page': tab,
+                                **summarize(measure(func, iterations))})
+    return results
+
+
+def run(iterations: int = 20, corpus_dir: str = '', only: str = '') -> dict:
+    """Runs the benchmarks
+
+    Args:
+        iterations: The number of timed runs of each benchmark
+        corpus_dir: A directory of recorded pages to use (see
+                    app.tools.corpus)
+        only: Only run benchmarks whose name or page contains this
+
+    Returns:
+        dict: The environment and results of the run
+
+    """
+    # Favicons are fetched from upstream, unless they're disabled
+    os.environ['WHOOGLE_SHOW_FAVICONS'] = '0'
+    from app import app
+    from app.utils.search import page_cache
+
+    # Every iteration is measured from the upstream page onwards
+    page_cache.enabled = False
+
+    results = bench_queries(app, iterations)
+    for page in load_corpus(corpus_dir):
+        results += bench_page(app, page, iterations)
+    if only:
+        results = [_ for _ in results
+                   if only in _['name'] or only in _['page']]
+
+    return {
+        'version': app.config['VERSION_NUMBER'],
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'iterations': iterations,
+        'recorded_corpus': bool(corpus_dir),
+        'results': results
+    }
+
+
+def compare(baseline: dict, current: dict,
+            threshold: float = DEFAULT_THRESHOLD) -> list:
+    """Compares the median times of two runs
+
+    Args:
+        baseline: The earlier run
+        current: The new run
+        threshold: The fraction that a median has to change by to count as
+                   a regression or improvement
+
+    Returns:
+        list: The name, page, medians, ratio and verdict ("regression",
+              "improvement" or "same") of each benchmark in both runs
+
+    """
+    earlier = {(_['name'], _['page']): _ for _ in baseline['results']}
+    rows = []
+    for result in current['results']:
+        before = earlier.get((result['name'], result['page']))
+        if before is None or not before['median_ms']:
+            continue
+        ratio = result['median_ms'] / before['median_ms']
+        verdict = 'same'
+        if ratio > 1 + threshold:
+            verdict = 'regression'
+        elif ratio < 1 - threshold:
+            verdict = 'improvement'
+        rows.append({'name': result['name'],
+                     'page': result['page'],
+                     'before_ms': before['median_ms'],
+                     'after_ms': result['median_ms'],
+                     'ratio': round(ratio, 3),
+                     'verdict': verdict})
+    return rows
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=20,
+                        help='Timed runs of each benchmark (default 20)')
+    parser.add_argument('--corpus', default='',
+                        help='A directory of recorded pages to use instead '
+                             'of the generated pages')
+    parser.add_argument('--only', default='',
+                        help='Only run benchmarks whose name or page '
+                             'contains this (i.e. "filter" or "news")')
+    parser.add_argument('--output', default='',
+                        help='Write the results to this file, instead of '
+                             'stdout')
+    parser.add_argument('--compare', default='',
+                        help='Compare the results with an earlier run')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='The fraction a median has to change by to be '
+                             'reported when comparing (default 0.1)')
+    args = parser.parse_args()
+
+    # Anything printed while the benchmarks run is kept out of the results
+    with redirect_stdout(sys.stderr):
+        report = run(args.iterations, args.corpus, args.only)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+
+    for result in report['results']:
+        print(f"{result['name']:>18} {result['page']:>18} "
+              f"{result['median_ms']:9.3f} ms (p95 {result['p95_ms']:.3f})",
+              file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            rows = compare(json.load(baseline_file), report, args.threshold)
+        changed = [_ for _ in rows if _['verdict'] != 'same']
+        for row in changed:
+            print(f"{row['verdict']:>11}: {row['name']} {row['page']} "
+                  f"{row['before_ms']:.3f} -> {row['after_ms']:.3f} ms "
+                  f"({row['ratio']:.2f}x)", file=sys.stderr)
+        if any(_['verdict'] == 'regression' for _ in changed):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+"""Builds the corpus of upstream result pages used by the benchmarks and the
+upstream stub server.
+
+By default, the corpus is generated in the markup of Google's basic (gbv=1)
+result pages: one page for each tab (web, images, news and videos), device
+(desktop and mobile) and size (10 and 100 results). Pages recorded from
+Google can be used instead by recording them into a directory:
+
+    python -m app.tools.corpus record --out corpus/
+
+and passing that directory to the tools that use the corpus. Recorded pages
+replace the generated pages with the same name (i.e. "news-mobile-10.html").
+"""
+import argparse
+import html
+import os
+import random
+import re
+from typing import NamedTuple
+
+# Tab names, by search type (tbm)
+TABS = {'': 'web', 'isch': 'images', 'nws': 'news', 'vid': 'videos'}
+DEVICES = ('desktop', 'mobile')
+SIZES = (10, 100)
+
+DEFAULT_QUERY = 'whoogle'
+
+# User agents used when recording pages for each device
+RECORD_USER_AGENTS = {
+    'desktop': 'Mozilla/5.0 (X11; Linux x86_64; rv:120.0) Gecko/20100101 '
+               'Firefox/120.0',
+    'mobile': 'Mozilla/5.0 (Android 14; Mobile; rv:120.0) Gecko/120.0 '
+              'Firefox/120.0'
+}
+
+WORDS = ('self-hosted', 'search', 'engine', 'privacy', 'metasearch',
+         'ad-free', 'open', 'source', 'results', 'proxy', 'python', 'flask',
+         'release', 'docker', 'instance', 'configuration', 'tor', 'guide',
+         'review', 'news', 'video', 'update', 'project', 'community')
+SITES = ('github.com', 'pypi.org', 'wikipedia.org', 'reddit.com',
+         'news.ycombinator.com', 'youtube.com', 'medium.com', 'dev.to',
+         'theverge.com', 'arstechnica.com')
+
+PAGE_TEMPLATE = '''<!DOCTYPE html>
+<html lang="en"><head><meta charset="UTF-8">
+<title>{query} - Google Search</title>
+<style>{style}</style></head>
+<body><header><div><a href="/">Google</a></div>
+<form action="/search"><div><input name="q" value="{query}"></div></form>
+</header>
+<div id="main"><div id="st-card"><div><a href="/search?q={query}&amp;\
+tbs=qdr:d">Past 24 hours</a></div></div>{results}</div>
+<footer><div><a href="/search?q={query}&amp;start={next_start}&amp;sa=N">
+Next &gt;</a></div></footer></body></html>'''
+
+STYLE = ('.ZINbbc{margin:0 0 8px;background:#fff}'
+         '.kCrYT{padding:12px 16px}.BNeawe{font-size:14px}'
+         '.ezO2md{padding:10px}'
+         '.isv-r{display:inline-block}'
+         '.x54gtf{height:1px;background:url(/images/line.png)}')
+
+CURRENCY_CARD = (
+    '<div class="ZINbbc xpd O9g5cc uUPGi"><div class="kCrYT">'
+    '<div class="BNeawe vvjwJb AP7Wnd">1 United States Dollar =</div>'
+    '<div class="BNeawe iBp4i AP7Wnd">83.12 Indian Rupee</div></div>'
+    '<div class="nXE3Ob"><a href="https://g.co/gfd">Disclaimer</a></div>'
+    '</div>')
+
+
+class CorpusPage(NamedTuple):
+    search_type: str
+    device: str
+    num_results: int
+    html: str
+    recorded: bool = False
+
+    @property
+    def name(self) -> str:
+        return page_name(self.search_type, self.device, self.num_results)
+
+    @property
+    def mobile(self) -> bool:
+        return self.device == 'mobile'
+
+
+def page_name(search_type: str, device: str, num_results: int) -> str:
+    return f'{TABS[search_type]}-{device}-{num_results}'
+
+
+def _text(rng: random.Random, words: int) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def _web_result(rng: random.Random, idx: int, query: str,
+                mobile: bool, extra: str = '') -> str:
+    site = SITES[idx % len(SITES)]
+    url = f'https://{site}/{idx}/{query}'
+    title = html.escape(f'{query} {_text(rng, 5)}'.capitalize())
+    snippet = html.escape(f'{_text(rng, 20)} {query} {_text(rng, 10)}.')
+    crumbs = f'{site} › {idx} › {query}'
+
+    if mobile:
+        return (
+            f'<div class="ezO2md"><div><a class="fuLhoc ZWRArf" '
+            f'href="/url?q={url}&amp;sa=U&amp;ved={idx}">'
+            f'<span class="CVA68e qXLe6d">{title}</span> '
+            f'<span class="qXLe6d dXDvrc"><span class="fYyStc">{crumbs}'
+            f'</span></span></a><span class="qXLe6d FrIlee">'
+            f'<span class="fYyStc">{extra}{snippet}</span></span></div></div>')
+
+    sitelinks = ''
+    if idx % 3 == 0:
+        sitelinks = (
+            f'<div class="BNeawe s3v9rd AP7Wnd">'
+            f'<a class="fl" href="/url?q={url}/docs&amp;sa=U">'
+            f'<span>Docs</span></a> · '
+            f'<a class="fl" href="/url?q={url}/about&amp;sa=U">'
+            f'<span>About</span></a></div>')
+    return (
+        f'<div class="ZINbbc xpd O9g5cc uUPGi"><div class="kCrYT">'
+        f'<a href="/url?q={url}&amp;sa=U&amp;ved={idx}">'
+        f'<h3 class="zBAuLc l97dzf"><div class="BNeawe vvjwJb AP7Wnd">'
+        f'{title}</div></h3><div class="BNeawe UPmit AP7Wnd lRVwie">'
+        f'{crumbs}</div></a></div><div class="x54gtf"></div>'
+        f'<div class="kCrYT"><div><div class="BNeawe s3v9rd AP7Wnd">'
+        f'{extra}{snippet}</div></div>{sitelinks}</div></div>')
+
+
+def _image_result(rng: random.Random, idx: int, query: str) -> str:
+    site = SITES[idx % len(SITES)]
+    title = html.escape(f'{query} {_text(rng, 4)}')
+    return (
+        f'<div class="isv-r"><a href="/imgres?imgurl=https://{site}/img/'
+        f'{idx}.jpg&amp;imgrefurl=https://{site}/{idx}">'
+        f'<img src="https://encrypted-tbn0.gstatic.com/images?q=tbn:{idx}" '
+        f'alt="{title}"></a>'
+        f'<a href="/url?q=https://{site}/{idx}&amp;sa=U">'
+        f'<div>{title}</div><div>{site}</div></a></div>')
+
+
+def build_page(search_type: str = '', mobile: bool = False,
+               num_results: int = 10, query: str = DEFAULT_QUERY,
+               seed: int = 0) -> str:
+    """Builds an upstream results page in the markup of Google's basic
+    result pages. Pages are the same for the same arguments.
+
+    Args:
+        search_type: The search type (tbm) of the page
+        mobile: Build the page served to mobile user agents
+        num_results: The number of results on the page
+        query: The query the results are for
+        seed: Varies the generated text
+
+    Returns:
+        str: The page html
+
+    """
+    rng = random.Random(f'{search_type}-{mobile}-{num_results}-{seed}')
+    results = []
+    if search_type == 'isch':
+        results.append('<div id="islmp">')
+        results += [_image_result(rng, idx, query)
+                    for idx in range(num_results)]
+        results.append('</div>')
+    else:
+        if not search_type:
+            results.append(CURRENCY_CARD)
+        for idx in range(num_results):
+            extra = ''
+            if search_type == 'nws':
+                extra = f'{SITES[idx % len(SITES)]} · {idx + 1} hours ago · '
+            elif search_type == 'vid':
+                extra = (f'<img src="https://i.ytimg.com/vi/{idx}/default'
+                         f'.jpg" alt=""> {idx % 50 + 1}:{idx % 60:02d} · ')
+            results.append(_web_result(rng, idx, query, mobile, extra))
+
+    return PAGE_TEMPLATE.format(query=html.escape(query),
+                                style=STYLE,
+                                results=''.join(results),
+                                next_start=num_results)
+
+
+def load_corpus(corpus_dir: str = '', query: str = DEFAULT_QUERY) -> list:
+    """Loads the corpus, preferring recorded pages where there are any
+
+    Args:
+        corpus_dir: A directory of recorded pages, if any
+        query: The query of generated pages
+
+    Returns:
+        list: The CorpusPage for each tab, device and size
+
+    """
+    pages = []
+    for search_type in TABS:
+        for device in DEVICES:
+            for num_results in SIZES:
+                name = page_name(search_type, device, num_results)
+                path = os.path.join(corpus_dir, f'{name}.html')
+                if corpus_dir and os.path.exists(path):
+                    with open(path, encoding='utf-8') as page_file:
+                        pages.append(CorpusPage(search_type, device,
+                                                num_results,
+                                                page_file.read(), True))
+                    continue
+                pages.append(CorpusPage(
+                    search_type, device, num_results,
+                    build_page(search_type, device == 'mobile', num_results,
+                               query)))
+    return pages
+
+
+def record_corpus(out_dir: str, query: str = DEFAULT_QUERY) -> list:
+    """Records the corpus pages from Google, which requires network access
+    (and is subject to Google's rate limits)
+
+    Args:
+        out_dir: The directory to write the pages to
+        query: The query to record results for
+
+    Returns:
+        list: The paths of the recorded pages
+
+    """
+    from app import app
+    from app.models.config import Config
+    from app.request import Request, gen_query
+
+    os.makedirs(out_dir, exist_ok=True)
+    paths = []
+    with app.app_context():
+        for search_type in TABS:
+            for device in DEVICES:
+                user_agent = RECORD_USER_AGENTS[device]
+                config = Config(**{'user_agent': 'custom',
+                                   'custom_user_agent': user_agent})
+                user_request = Request(user_agent, 'http://localhost:5000',
+                                       config=config)
+                for num_results in SIZES:
+                    params = {'tbm': search_type} if search_type else {}
+                    user_request.search_url = re.sub(
+                        r'num=\d+', f'num={num_results}',
+                        user_request.search_url)
+                    response = user_request.send(
+                        query=gen_query(query, params, config))
+                    path = os.path.join(
+                        out_dir,
+                        f'{page_name(search_type, device, num_results)}.html')
+                    with open(path, 'w', encoding='utf-8') as page_file:
+                        page_file.write(response.text)
+                    paths.append(path)
+    return paths
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='Builds or records the corpus of upstream result pages')
+    parser.add_argument('action', choices=['build', 'record'],
+                        help='Write the generated pages, or record them '
+                             'from Google')
+    parser.add_argument('--out', required=True,
+                        help='The directory to write the pages to')
+    parser.add_argument('--query', default=DEFAULT_QUERY,
+                        help=f'The query of the pages (default '
+                             f'"{DEFAULT_QUERY}")')
+    args = parser.parse_args()
+
+    if args.action == 'record':
+        paths = record_corpus(args.out, args.query)
+    else:
+        os.makedirs(args.out, exist_ok=True)
+        paths = []
+        for page in load_corpus(query=args.query):
+            path = os.path.join(args.out, f'{page.name}.html')
+            with open(path, 'w', encoding='utf-8') as page_file:
+                page_file.write(page.html)
+            paths.append(path)
+    print('\n'.join(paths))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,775 @@
+"""Generates load against a whoogle instance, and reports the throughput,
+latency percentiles and error rate of each route, along with the resources
+the server used.
+
+Load is a mix of /search, /autocomplete, /element and /window requests, sent
+by a fixed number of concurrent clients (each sending its next request as
+soon as the last one is answered), or at a fixed rate. At a fixed rate,
+latencies are measured from when each request was due to be sent, so that a
+server that falls behind isn't flattered by the requests it delayed.
+
+Instances are best run against the upstream stand-in (see
+app.tools.upstream_stub), which the load generator can start itself, along
+with an instance of any checkout of whoogle:
+
+    python -m app.tools.loadgen run --build . --concurrency 16
+    python -m app.tools.loadgen run --target http://localhost:5000 --rps 20
+    python -m app.tools.loadgen compare --baseline ../whoogle-main \\
+        --candidate .
+
+Server resource usage is read from the instance's /metrics endpoint, or from
+/proc when metrics are disabled and the server's pid is known.
+"""
+import argparse
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import json
+import math
+import os
+import queue
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import quote
+
+import requests
+
+from app.tools.corpus import SITES, WORDS
+
+ROUTES = ('search', 'autocomplete', 'element', 'window')
+DEFAULT_MIX = 'search=70,autocomplete=20,element=8,window=2'
+PERCENTILES = (50, 95, 99)
+
+# Changes smaller than this (as a fraction) aren't reported as regressions
+# or improvements when comparing runs, and neither are changes in the error
+# rate smaller than ERROR_RATE_THRESHOLD
+DEFAULT_THRESHOLD = 0.1
+ERROR_RATE_THRESHOLD = 0.01
+
+METRIC_LINE = re.compile(r'^([a-zA-Z_:][\w:]*)(\{[^}]*\})? (\S+)$')
+
+
+def parse_mix(spec: str) -> dict:
+    """Parses a traffic mix, given as comma separated "<route>=<weight>"
+    pairs (i.e. "search=70,autocomplete=30")
+
+    Args:
+        spec: The traffic mix
+
+    Returns:
+        dict: The weight of each route
+
+    Raises:
+        ValueError: if the mix isn't valid
+
+    """
+    mix = {}
+    for pair in filter(None, (_.strip() for _ in spec.split(','))):
+        route, _, weight = pair.partition('=')
+        if route not in ROUTES:
+            raise ValueError(f'Unknown route "{route}", routes are: '
+                             f'{", ".join(ROUTES)}')
+        mix[route] = float(weight or 1)
+    if not mix or sum(mix.values()) <= 0:
+        raise ValueError(f'No traffic in mix "{spec}"')
+    return mix
+
+
+def make_queries(count: int, rng: random.Random) -> list:
+    return [' '.join(rng.sample(WORDS, rng.randint(1, 3)))
+            for _ in range(count)]
+
+
+def make_path(route: str, rng: random.Random, queries: list) -> str:
+    """Builds a request for a route
+
+    Args:
+        route: One of ROUTES
+        rng: The random number generator of the client
+        queries: The queries that searches are picked from
+
+    Returns:
+        str: The path and query string of the request
+
+    """
+    site = rng.choice(SITES)
+    if route == 'search':
+        return f'/search?q={quote(rng.choice(queries))}'
+    elif route == 'autocomplete':
+        query = rng.choice(queries)
+        return f'/autocomplete?q={quote(query[:rng.randint(1, len(query))])}'
+    elif route == 'element':
+        url = quote(f'https://{site}/favicon.ico', safe='')
+        return f'/element?url={url}&type=image/png'
+    url = quote(f'https://{site}/{rng.randint(0, 99)}', safe='')
+    return f'/window?location={url}'
+
+
+def percentile(values: list, pct: float) -> float:
+    """The nearest-rank percentile of sorted values"""
+    if not values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100 * len(values)))
+    return values[min(rank, len(values)) - 1]
+
+
+def summarize(latencies: list, errors: int, duration: float) -> dict:
+    """Summarizes the requests to a route
+
+    Args:
+        latencies: The latency of each request, in seconds
+        errors: The number of requests that failed
+        duration: The length of the measured run, in seconds
+
+    Returns:
+        dict: The throughput, error rate and latency percentiles (in ms)
+
+    """
+    latencies = sorted(latencies)
+    summary = {
+        'requests': len(latencies),
+        'errors': errors,
+        'error_rate': round(errors / len(latencies), 4) if latencies else 0.0,
+        'throughput_rps': round(len(latencies) / duration, 3)
+        if duration else 0.0,
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3)
+        if latencies else 0.0
+    }
+    for pct in PERCENTILES:
+        summary[f'p{pct}_ms'] = round(percentile(latencies, pct) * 1000, 3)
+    summary['max_ms'] = round(latencies[-1] * 1000, 3) if latencies else 0.0
+    return summary
+
+
+def parse_metrics(text: str) -> dict:
+    """Parses metrics in the Prometheus text exposition format
+
+    Args:
+        text: The metrics
+
+    Returns:
+        dict: The value of each sample, by its name and labels
+
+    """
+    samples = {}
+    for line in text.splitlines():
+        match = METRIC_LINE.match(line)
+        if match:
+            name, labels, value = match.groups()
+            try:
+                samples[name + (labels or '')] = float(value)
+            except ValueError:
+                continue
+    return samples
+
+
+def sum_samples(samples: dict, name: str) -> float:
+    return sum(value for key, value in samples.items()
+               if key == name or key.startswith(name + '{'))
+
+
+def read_proc(pid: int) -> dict:
+    """Reads the resource usage of a local process from /proc
+
+    Args:
+        pid: The process id
+
+    Returns:
+        dict: The process's CPU time, resident memory and threads
+
+    """
+    with open(f'/proc/{pid}/stat') as stat_file:
+        # The process name can contain spaces, so fields are counted from
+        # the end of it
+        fields = stat_file.read().rsplit(')', 1)[1].split()
+    ticks = os.sysconf('SC_CLK_TCK')
+    return {'cpu_seconds': (int(fields[11]) + int(fields[12])) / ticks,
+            'rss_bytes': int(fields[21]) * os.sysconf('SC_PAGE_SIZE'),
+            'threads': int(fields[17])}
+
+
+class ResourceSampler:
+    """Samples the resource usage of the server while load is generated
+
+    Attributes:
+        target: The base url of the instance
+        pid: The server's process id, used when its metrics are disabled
+        interval: The time between samples, in seconds
+    """
+
+    def __init__(self, target: str, pid: int = None,
+                 interval: float = 1.0) -> None:
+        self.target = target
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self._session = requests.Session()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self) -> dict:
+        """Reads the server's current resource usage
+
+        Returns:
+            dict: The server's resource usage, or None if it can't be read
+
+        """
+        try:
+            response = self._session.get(f'{self.target}/metrics',
+                                         allow_redirects=False, timeout=5)
+            if response.status_code == 200:
+                metrics = parse_metrics(response.text)
+                if 'process_cpu_seconds_total' in metrics:
+                    return {
+                        'cpu_seconds': metrics['process_cpu_seconds_total'],
+                        'rss_bytes': metrics['process_resident_memory_bytes'],
+                        'threads': metrics.get('whoogle_threads', 0),
+                        'in_flight': metrics.get(
+                            'whoogle_http_requests_in_flight', 0),
+                        'upstream_requests': sum_samples(
+                            metrics, 'whoogle_upstream_responses_total'),
+                        'cache_hits': metrics.get(
+                            'whoogle_cache_requests_total{cache="page",'
+                            'result="hits"}', 0)
+                    }
+        except requests.RequestException:
+            pass
+
+        if self.pid:
+            try:
+                return read_proc(self.pid)
+            except (OSError, ValueError, IndexError):
+                pass
+        return None
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            sample = self.sample()
+            if sample:
+                self.samples.append(sample)
+
+    def start(self) -> None:
+        sample = self.sample()
+        if sample:
+            self.samples.append(sample)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self, duration: float) -> dict:
+        """Stops sampling
+
+        Args:
+            duration: The length of the run, in seconds
+
+        Returns:
+            dict: The server's resource usage during the run, or None if it
+                  couldn't be read
+
+        """
+        self._stop.set()
+        self._thread.join()
+        sample = self.sample()
+        if sample:
+            self.samples.append(sample)
+        if len(self.samples) < 2:
+            return None
+
+        first, last = self.samples[0], self.samples[-1]
+        cpu_seconds = last['cpu_seconds'] - first['cpu_seconds']
+        usage = {
+            'cpu_seconds': round(cpu_seconds, 3),
+            # As a fraction of one core
+            'cpu_utilization': round(cpu_seconds / duration, 3),
+            'rss_bytes_start': int(first['rss_bytes']),
+            'rss_bytes_peak': int(max(_['rss_bytes'] for _ in self.samples)),
+            'threads_peak': int(max(_['threads'] for _ in self.samples))
+        }
+        if 'in_flight' in last:
+            usage['in_flight_peak'] = int(max(_['in_flight']
+                                              for _ in self.samples))
+            usage['upstream_requests'] = int(last['upstream_requests'] -
+                                             first['upstream_requests'])
+            usage['page_cache_hits'] = int(last['cache_hits'] -
+                                           first['cache_hits'])
+        return usage
+
+
+def run_load(target: str, duration: float = 30, mix: dict = None,
+             concurrency: int = 8, rps: float = 0, warmup: float = 5,
+             seed: int = 0, timeout: float = 30, pid: int = None) -> dict:
+    """Generates load against an instance
+
+    Args:
+        target: The base url of the instance
+        duration: The length of the measured run, in seconds
+        mix: The weight of each route, as returned by parse_mix
+        concurrency: The number of concurrent clients
+        rps: Send requests at this rate, instead of as fast as the clients
+             are answered
+        warmup: Requests sent in this many seconds before the measured run
+                aren't counted
+        seed: Seeds the requests that are sent
+        timeout: Requests that take longer than this fail
+        pid: The server's process id, used to read its resource usage when
+             its metrics are disabled
+
+    Returns:
+        dict: The settings and results of the run
+
+    """
+    target = target.rstrip('/')
+    mix = mix or parse_mix(DEFAULT_MIX)
+    routes, weights = list(mix), list(mix.values())
+    queries = make_queries(500, random.Random(seed))
+
+    results = {route: ([], [0], {}) for route in routes}
+    lock = threading.Lock()
+    start = time.monotonic() + 0.1
+    measure_from = start + warmup
+    end = measure_from + duration
+    due = queue.Queue(maxsize=max(1, concurrency) * 4)
+
+    def send(client: requests.Session, rng: random.Random,
+             sent_at: float) -> None:
+        route = rng.choices(routes, weights)[0]
+        try:
+            response = client.get(target + make_path(route, rng, queries),
+                                  allow_redirects=False, timeout=timeout)
+            status, error = str(response.status_code), \
+                response.status_code >= 400
+        except requests.RequestException as e:
+            status, error = type(e).__name__, True
+        finished = time.monotonic()
+        # Requests sent during the measured run are counted even if they're
+        # answered after it, so that the slowest aren't left out
+        if sent_at < measure_from:
+            return
+
+        latencies, errors, statuses = results[route]
+        with lock:
+            latencies.append(finished - sent_at)
+            errors[0] += error
+            statuses[status] = statuses.get(status, 0) + 1
+
+    def client_loop(idx: int) -> None:
+        client = requests.Session()
+        rng = random.Random(f'{seed}-{idx}')
+        while True:
+            if rps:
+                sent_at = due.get()
+                if sent_at is None:
+                    return
+            else:
+                sent_at = time.monotonic()
+                if sent_at >= end:
+                    return
+            send(client, rng, sent_at)
+
+    def dispatch() -> None:
+        idx = 0
+        while True:
+            sent_at = start + idx / rps
+            if sent_at >= end:
+                break
+            time.sleep(max(0.0, sent_at - time.monotonic()))
+            due.put(sent_at)
+            idx += 1
+        for _ in range(concurrency):
+            due.put(None)
+
+    sampler = ResourceSampler(target, pid)
+    clients = [threading.Thread(target=client_loop, args=(idx,), daemon=True)
+               for idx in range(concurrency)]
+    if rps:
+        clients.append(threading.Thread(target=dispatch, daemon=True))
+
+    time.sleep(max(0.0, start - time.monotonic()))
+    for thread in clients:
+        thread.start()
+    time.sleep(max(0.0, measure_from - time.monotonic()))
+    sampler.start()
+    for thread in clients:
+        thread.join()
+    server = sampler.stop(duration)
+
+    report = {
+        'target': target,
+        'time': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'mode': 'rps' if rps else 'concurrency',
+        'concurrency': concurrency,
+        'rps': rps,
+        'duration': duration,
+        'warmup': warmup,
+        'seed': seed,
+        'mix': mix,
+        'routes': {},
+        'server': server
+    }
+    all_latencies, all_errors = [], 0
+    for route, (latencies, errors, statuses) in results.items():
+        report['routes'][route] = {**summarize(latencies, errors[0],
+                                               duration),
+                                   'statuses': statuses}
+        all_latencies += latencies
+        all_errors += errors[0]
+    report['total'] = summarize(all_latencies, all_errors, duration)
+    return report
+
+
+def compare(baseline: dict, current: dict,
+            threshold: float = DEFAULT_THRESHOLD) -> list:
+    """Compares the throughput, latency percentiles and error rates of two
+    runs, in total and for each route
+
+    Args:
+        baseline: The earlier run
+        current: The new run
+        threshold: The fraction that a value has to change by to count as a
+                   regression or improvement
+
+    Returns:
+        list: The route, measure, values and verdict ("regression",
+              "improvement" or "same") of each comparison
+
+    """
+    rows = []
+    pairs = [('total', baseline['total'], current['total'])]
+    pairs += [(route, baseline['routes'][route], summary)
+              for route, summary in current['routes'].items()
+              if route in baseline['routes']]
+    for route, before, after in pairs:
+        if not before['requests'] or not after['requests']:
+            continue
+        for measure in ['throughput_rps', 'error_rate'] + \
+                [f'p{_}_ms' for _ in PERCENTILES] + ['max_ms']:
+            old, new = before[measure], after[measure]
+            if measure == 'error_rate':
+                change = new - old
+                worse = change > ERROR_RATE_THRESHOLD
+                better = change < -ERROR_RATE_THRESHOLD
+            else:
+                ratio = new / old if old else 1.0
+                # Lower latencies are better, but higher throughput is
+                if measure == 'throughput_rps':
+                    ratio = 1 / ratio if ratio else float('inf')
+                worse = ratio > 1 + threshold
+                better = ratio < 1 - threshold
+            # Maximum latencies are too noisy to fail a comparison on
+            verdict = 'same'
+            if worse:
+                verdict = 'regression' if measure != 'max_ms' else 'slower'
+            elif better:
+                verdict = 'improvement'
+            rows.append({'route': route, 'measure': measure,
+                         'before': old, 'after': new, 'verdict': verdict})
+    return rows
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@contextmanager
+def spawn_instance(build_dir: str, upstream_url: str, port: int = 0,
+                   env: dict = None, ready_timeout: float = 60):
+    """Runs an instance of a whoogle checkout (through run_app), with its
+    upstream requests sent to a stand-in, and its own config directory
+
+    Args:
+        build_dir: The checkout to run
+        upstream_url: The address of the upstream stand-in
+        port: The port to listen on (any free port by default)
+        env: Extra environment variables for the instance
+        ready_timeout: How long to wait for the instance to start
+
+    Yields:
+        tuple: The base url and process of the instance
+
+    """
+    port = port or free_port()
+    url = f'http://127.0.0.1:{port}'
+    with tempfile.TemporaryDirectory() as config_dir:
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'app', '--port', str(port)],
+            cwd=build_dir,
+            env={**os.environ,
+                 'CONFIG_VOLUME': config_dir,
+                 'WHOOGLE_UPSTREAM_URL': upstream_url,
+                 **(env or {})},
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+        try:
+            deadline = time.monotonic() + ready_timeout
+            while True:
+                if process.poll() is not None:
+                    raise RuntimeError(f'Instance in {build_dir} exited with '
+                                       f'status {process.returncode}')
+                try:
+                    if requests.get(f'{url}/healthz',
+                                    timeout=1).status_code == 200:
+                        break
+                except requests.RequestException:
+                    pass
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f'Instance in {build_dir} did not '
+                                       f'start in {ready_timeout}s')
+                time.sleep(0.2)
+            yield url, process
+        finally:
+            process.terminate()
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+
+@contextmanager
+def upstream(args: argparse.Namespace):
+    """Starts the upstream stand-in, unless the address of a running one is
+    given
+
+    Args:
+        args: The load generator's arguments
+
+    Yields:
+        UpstreamStub: The stand-in, or None if one is already running
+
+    """
+    if args.upstream_url:
+        yield None
+        return
+
+    from app.tools.upstream_stub import StubBehaviour, UpstreamStub
+    stub = UpstreamStub(('127.0.0.1', 0), StubBehaviour(
+        search_latency=args.search_latency,
+        suggest_latency=args.suggest_latency,
+        element_latency=args.element_latency,
+        captcha_rate=args.captcha_rate,
+        error_rate=args.error_rate,
+        seed=args.seed)).start()
+    try:
+        yield stub
+    finally:
+        stub.stop()
+
+
+def upstream_searches(stub, upstream_url: str) -> int:
+    """The number of searches the upstream stand-in has answered"""
+    if stub:
+        stats = stub.stats_snapshot()
+    else:
+        stats = requests.get(f'{upstream_url}/_stub/stats', timeout=5).json()
+    return sum(stats.get('search', {}).values())
+
+
+def load_build(build_dir: str, args: argparse.Namespace) -> dict:
+    """Runs the load against an instance of a checkout, with its own
+    upstream stand-in
+
+    Args:
+        build_dir: The checkout to run
+        args: The load generator's arguments
+
+    Returns:
+        dict: The report of the run
+
+    Raises:
+        RuntimeError: if the instance doesn't send its searches to the
+                      stand-in
+
+    """
+    with upstream(args) as stub:
+        upstream_url = stub.url if stub else args.upstream_url
+        # Upstream pacing caps upstream requests at WHOOGLE_UPSTREAM_RATE,
+        # which would be measured instead of the instance
+        env = {'WHOOGLE_UPSTREAM_PACING': '1' if args.pacing else '0',
+               'WHOOGLE_METRICS': '1'}
+        if args.threads:
+            env['WHOOGLE_WORKER_THREADS'] = str(args.threads)
+        with spawn_instance(build_dir, upstream_url, env=env) as (
+                url, process):
+            # Checkouts that predate WHOOGLE_UPSTREAM_URL would send the
+            # load to Google instead, so one search is tried first
+            searches = upstream_searches(stub, upstream_url)
+            try:
+                requests.get(f'{url}/search?q=whoogle',
+                             allow_redirects=False, timeout=args.timeout)
+            except requests.RequestException:
+                pass
+            if upstream_searches(stub, upstream_url) == searches:
+                raise RuntimeError(f'Instance in {build_dir} did not send '
+                                   f'its search to the stand-in at '
+                                   f'{upstream_url}')
+            report = run_load(url, args.duration, parse_mix(args.mix),
+                              args.concurrency, args.rps, args.warmup,
+                              args.seed, args.timeout, process.pid)
+        report['build'] = os.path.abspath(build_dir)
+        if stub:
+            report['upstream'] = stub.stats_snapshot()
+    return report
+
+
+def print_report(report: dict, title: str = '') -> None:
+    out = sys.stderr
+    if title:
+        print(title, file=out)
+    print(f"{'route':>13} {'requests':>9} {'rps':>8} {'errors':>7} "
+          f"{'p50':>9} {'p95':>9} {'p99':>9} {'max':>9} (ms)", file=out)
+    for route, summary in list(report['routes'].items()) + [
+            ('total', report['total'])]:
+        print(f"{route:>13} {summary['requests']:>9} "
+              f"{summary['throughput_rps']:>8.2f} "
+              f"{summary['error_rate']:>7.2%} "
+              f"{summary['p50_ms']:>9.1f} {summary['p95_ms']:>9.1f} "
+              f"{summary['p99_ms']:>9.1f} {summary['max_ms']:>9.1f}",
+              file=out)
+    server = report.get('server')
+    if server:
+        print(f"server: {server['cpu_utilization']:.0%} cpu, "
+              f"{server['rss_bytes_peak'] / 2 ** 20:.1f} MiB peak rss, "
+              f"{server['threads_peak']} threads", file=out)
+
+
+def print_comparison(rows: list) -> bool:
+    """Prints the changes between two runs
+
+    Returns:
+        bool: True if there was a regression
+
+    """
+    for row in rows:
+        if row['verdict'] != 'same':
+            print(f"{row['verdict']:>11}: {row['route']} {row['measure']} "
+                  f"{row['before']} -> {row['after']}", file=sys.stderr)
+    return any(_['verdict'] == 'regression' for _ in rows)
+
+
+def write_report(report: dict, path: str) -> None:
+    output = json.dumps(report, indent=2)
+    if path:
+        with open(path, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser(
+        'run', help='Generate load against one instance')
+    compare_parser = commands.add_parser(
+        'compare', help='Generate the same load against two checkouts, and '
+                        'report regressions')
+
+    target = run_parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--target',
+                        help='The base url of a running instance')
+    target.add_argument('--build',
+                        help='Start an instance of this checkout, with its '
+                             'upstream sent to a stand-in')
+    run_parser.add_argument('--pid', type=int, default=None,
+                            help='The process id of the running instance, '
+                                 'to read its resource usage from /proc when '
+                                 'its metrics are disabled')
+    run_parser.add_argument('--compare', default='',
+                            help='Compare the results with an earlier run')
+    compare_parser.add_argument('--baseline', required=True,
+                                help='The checkout to compare against')
+    compare_parser.add_argument('--candidate', default='.',
+                                help='The checkout to test (default the '
+                                     'current directory)')
+
+    for sub in (run_parser, compare_parser):
+        sub.add_argument('--duration', type=float, default=30,
+                         help='Seconds of measured load (default 30)')
+        sub.add_argument('--warmup', type=float, default=5,
+                         help='Seconds of load before measuring (default 5)')
+        sub.add_argument('--concurrency', type=int, default=8,
+                         help='Concurrent clients (default 8)')
+        sub.add_argument('--rps', type=float, default=0,
+                         help='Send requests at this rate instead of as '
+                              'fast as the clients are answered')
+        sub.add_argument('--mix', default=DEFAULT_MIX,
+                         help=f'Weights of each route (default '
+                              f'"{DEFAULT_MIX}")')
+        sub.add_argument('--timeout', type=float, default=30,
+                         help='Seconds before a request fails (default 30)')
+        sub.add_argument('--seed', type=int, default=0,
+                         help='Seeds the requests that are sent')
+        sub.add_argument('--output', default='',
+                         help='Write the results to this file, instead of '
+                              'stdout')
+        sub.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                         help='The fraction a value has to change by to be '
+                              'reported when comparing (default 0.1)')
+        stand_in = sub.add_argument_group(
+            'started instances', 'Used when the load generator starts the '
+                                 'instances, which send their upstream '
+                                 'requests to a stand-in (see '
+                                 'app.tools.upstream_stub)')
+        stand_in.add_argument('--upstream-url', default='',
+                              help='Use a running stand-in, instead of '
+                                   'starting one')
+        stand_in.add_argument('--threads', type=int, default=0,
+                              help='Worker threads of the instance')
+        stand_in.add_argument('--pacing', action='store_true',
+                              help='Keep upstream pacing enabled in the '
+                                   'instance')
+        for route, default in (('search', 'lognormal:0.3,0.5'),
+                               ('suggest', 'lognormal:0.05,0.5'),
+                               ('element', 'lognormal:0.05,0.5')):
+            stand_in.add_argument(f'--{route}-latency', default=default,
+                                  help=f'Latency of upstream {route} '
+                                       f'responses (default "{default}")')
+        stand_in.add_argument('--captcha-rate', type=float, default=0.0,
+                              help='Fraction of upstream searches answered '
+                                   'with a captcha')
+        stand_in.add_argument('--error-rate', type=float, default=0.0,
+                              help='Fraction of upstream responses that are '
+                                   'errors')
+    args = parser.parse_args()
+
+    try:
+        parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.command == 'run':
+        if args.build:
+            report = load_build(args.build, args)
+        else:
+            report = run_load(args.target, args.duration, parse_mix(args.mix),
+                              args.concurrency, args.rps, args.warmup,
+                              args.seed, args.timeout, args.pid)
+        write_report(report, args.output)
+        print_report(report)
+        if args.compare:
+            with open(args.compare) as baseline_file:
+                rows = compare(json.load(baseline_file), report,
+                               args.threshold)
+            if print_comparison(rows):
+                sys.exit(1)
+        return
+
+    baseline = load_build(args.baseline, args)
+    candidate = load_build(args.candidate, args)
+    rows = compare(baseline, candidate, args.threshold)
+    write_report({'baseline': baseline, 'candidate': candidate,
+                  'comparison': rows}, args.output)
+    print_report(baseline, f'baseline ({baseline["build"]})')
+    print_report(candidate, f'candidate ({candidate["build"]})')
+    if print_comparison(rows):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
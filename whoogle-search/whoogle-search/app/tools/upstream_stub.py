@@ -0,0 +1,444 @@
+"""A stand-in for the upstream servers that whoogle sends requests to, for
+load and latency testing without hitting Google (or its rate limits).
+
+Searches are answered with pages from the corpus (see app.tools.corpus),
+suggestions with a list of completions, and favicons, images and pages
+opened in a window with local files. Responses can be slowed down, and
+replaced with errors, captchas, redirects to the "sorry" page or connection
+resets, to reproduce upstream slowness and captcha storms locally.
+
+Whoogle sends its upstream requests to the stand-in when WHOOGLE_UPSTREAM_URL
+is set to its address:
+
+    python -m app.tools.upstream_stub --port 5050 --search-latency \\
+        lognormal:0.4,0.5 --captcha-rate 0.05
+    WHOOGLE_UPSTREAM_URL=http://localhost:5050 ./run
+
+The behaviour can be changed while the stand-in is running (i.e. to start a
+captcha storm part way through a load test) by posting any of the options to
+/_stub/config as JSON, and the responses it has given are counted at
+/_stub/stats.
+"""
+import argparse
+from functools import lru_cache
+import html
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import math
+import os
+import random
+import socket
+import struct
+import threading
+import time
+from typing import Callable
+from urllib.parse import parse_qs, quote, urlparse
+
+from app.tools.corpus import DEVICES, SIZES, TABS, WORDS, build_page, \
+    load_corpus
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'static', 'img')
+FAVICON_FILE = os.path.join(STATIC_DIR, 'favicon', 'favicon-32x32.png')
+IMAGE_FILE = os.path.join(STATIC_DIR, 'logo.png')
+
+HTML_TYPE = 'text/html; charset=UTF-8'
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.webp')
+
+CAPTCHA_PAGE = '''<!DOCTYPE html>
+<html><head><title>https://www.google.com/search</title></head>
+<body><div id="main"><form id="captcha-form" action="index" method="post">
+<div class="g-recaptcha" data-sitekey="stand-in"></div>
+<input type="submit" name="submit"></form></div></body></html>'''
+
+WINDOW_PAGE = '''<!DOCTYPE html>
+<html><head><title>{title}</title><link rel="stylesheet" href="/style.css">
+</head><body><h1>{title}</h1><img src="/images/header.png" alt="">
+<p>{text}</p><a href="/about">About</a></body></html>'''
+
+# The responses that can be injected in place of the normal response, in the
+# order they're picked in
+FAULTS = ('reset', 'error', 'block', 'captcha')
+
+
+def parse_latency(spec: str) -> Callable[[random.Random], float]:
+    """Parses a latency distribution, in seconds. Distributions are given as
+    "fixed:<seconds>", "uniform:<min>-<max>", "exp:<mean>" or
+    "lognormal:<median>,<sigma>" (a bare number is a fixed latency).
+
+    Args:
+        spec: The distribution
+
+    Returns:
+        Callable: Draws a latency from the distribution, given a random
+                  number generator
+
+    Raises:
+        ValueError: if the distribution isn't valid
+
+    """
+    kind, _, args = (spec or '0').partition(':')
+    if not args:
+        kind, args = 'fixed', kind
+
+    if kind == 'fixed':
+        value = float(args)
+        return lambda rng: value
+    elif kind == 'uniform':
+        low, high = (float(_) for _ in args.split('-'))
+        return lambda rng: rng.uniform(low, high)
+    elif kind == 'exp':
+        mean = float(args)
+        return lambda rng: rng.expovariate(1 / mean) if mean else 0.0
+    elif kind == 'lognormal':
+        median, sigma = (float(_) for _ in args.split(','))
+        return lambda rng: rng.lognormvariate(math.log(median), sigma)
+    raise ValueError(f'Unknown latency distribution: {spec}')
+
+
+class StubBehaviour:
+    """How the stand-in responds, which can be changed while it's running
+
+    Attributes:
+        latency: The latency distribution of each route (search, suggest and
+                 element), as given to parse_latency
+        error_rate: The fraction of responses that are server errors
+        error_status: The status code of injected errors
+        captcha_rate: The fraction of searches answered with a captcha page
+        block_rate: The fraction of searches redirected to the "sorry" page
+        reset_rate: The fraction of connections reset without a response
+    """
+    OPTIONS = ('search_latency', 'suggest_latency', 'element_latency',
+               'error_rate', 'error_status', 'captcha_rate', 'block_rate',
+               'reset_rate')
+
+    def __init__(self, search_latency: str = '0', suggest_latency: str = '0',
+                 element_latency: str = '0', error_rate: float = 0.0,
+                 error_status: int = 503, captcha_rate: float = 0.0,
+                 block_rate: float = 0.0, reset_rate: float = 0.0,
+                 seed: int = None) -> None:
+        self._lock = threading.Lock()
+        self._rng = random.Random(seed)
+        self.latency = {}
+        self.update(search_latency=search_latency,
+                    suggest_latency=suggest_latency,
+                    element_latency=element_latency,
+                    error_rate=error_rate,
+                    error_status=error_status,
+                    captcha_rate=captcha_rate,
+                    block_rate=block_rate,
+                    reset_rate=reset_rate)
+
+    def update(self, **options) -> None:
+        """Changes the behaviour
+
+        Args:
+            options: Any of the OPTIONS
+
+        Raises:
+            ValueError: if an option isn't valid
+
+        """
+        unknown = set(options) - set(self.OPTIONS)
+        if unknown:
+            raise ValueError(f'Unknown options: {", ".join(sorted(unknown))}')
+
+        latency = {}
+        for name, value in options.items():
+            if name.endswith('_latency'):
+                latency[name[:-len('_latency')]] = (str(value),
+                                                    parse_latency(str(value)))
+        with self._lock:
+            self.latency.update(latency)
+            for name in ('error_rate', 'captcha_rate', 'block_rate',
+                         'reset_rate'):
+                if name in options:
+                    setattr(self, name, float(options[name]))
+            if 'error_status' in options:
+                self.error_status = int(options['error_status'])
+
+    def draw(self, route: str) -> tuple:
+        """Decides how to respond to a request
+
+        Args:
+            route: The route of the request (search, suggest or element)
+
+        Returns:
+            tuple: The latency, in seconds, and the fault to inject (one of
+                   FAULTS), or None to respond normally
+
+        """
+        with self._lock:
+            latency = max(0.0, self.latency[route][1](self._rng))
+            rates = {'reset': self.reset_rate, 'error': self.error_rate}
+            if route == 'search':
+                rates['block'] = self.block_rate
+                rates['captcha'] = self.captcha_rate
+
+            draw = self._rng.random()
+            for fault in FAULTS:
+                draw -= rates.get(fault, 0.0)
+                if draw < 0:
+                    return latency, fault
+        return latency, None
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {**{f'{route}_latency': spec
+                       for route, (spec, _) in self.latency.items()},
+                    'error_rate': self.error_rate,
+                    'error_status': self.error_status,
+                    'captcha_rate': self.captcha_rate,
+                    'block_rate': self.block_rate,
+                    'reset_rate': self.reset_rate}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Handles requests to the stand-in"""
+    protocol_version = 'HTTP/1.1'
+    server_version = 'gws'
+
+    def log_message(self, format, *args) -> None:
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self) -> None:
+        parsed = urlparse(self.path)
+        args = {key: values[-1]
+                for key, values in parse_qs(parsed.query).items()}
+
+        if parsed.path == '/_stub/stats':
+            return self.respond(200, json.dumps(self.server.stats_snapshot()),
+                                'application/json')
+        elif parsed.path == '/_stub/config':
+            return self.respond(200, json.dumps(self.server.behaviour
+                                                .to_dict()),
+                                'application/json')
+        elif parsed.path.startswith('/sorry/'):
+            return self.respond(429, CAPTCHA_PAGE)
+
+        if parsed.path == '/search':
+            route, handler = 'search', self.search
+        elif parsed.path == '/complete/search':
+            route, handler = 'suggest', self.suggest
+        elif parsed.path == '/element':
+            route, handler = 'element', self.element
+        else:
+            self.server.count('other', 'not_found')
+            return self.respond(404, 'Not Found', 'text/plain')
+
+        latency, fault = self.server.behaviour.draw(route)
+        if latency:
+            time.sleep(latency)
+        self.server.count(route, fault or 'ok')
+
+        if fault == 'reset':
+            # Closing with a zero linger time resets the connection
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                       struct.pack('ii', 1, 0))
+            self.close_connection = True
+            return
+        elif fault == 'error':
+            return self.respond(self.server.behaviour.error_status,
+                                '<html><body>Server Error</body></html>')
+        elif fault == 'block':
+            self.send_response(302)
+            self.send_header('Location', '/sorry/index?continue=' +
+                             quote(self.path, safe=''))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        elif fault == 'captcha':
+            return self.respond(200, CAPTCHA_PAGE)
+        handler(args)
+
+    def do_POST(self) -> None:
+        if urlparse(self.path).path != '/_stub/config':
+            return self.respond(404, 'Not Found', 'text/plain')
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            self.server.behaviour.update(**json.loads(self.rfile.read(length)
+                                                      or b'{}'))
+        except (TypeError, ValueError) as e:
+            return self.respond(400, str(e), 'text/plain')
+        self.respond(200, json.dumps(self.server.behaviour.to_dict()),
+                     'application/json')
+
+    def respond(self, status: int, body,
+                content_type: str = HTML_TYPE) -> None:
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def search(self, args: dict) -> None:
+        user_agent = self.headers.get('User-Agent', '')
+        mobile = 'Android' in user_agent or 'iPhone' in user_agent
+        search_type = args.get('tbm', '')
+        if search_type not in TABS:
+            search_type = ''
+        try:
+            num_results = max(1, min(int(args.get('num', 10)), 100))
+            start = int(args.get('start', 0))
+        except ValueError:
+            num_results, start = 10, 0
+        self.respond(200, self.server.page(search_type, mobile, num_results,
+                                           args.get('q', ''), start))
+
+    def suggest(self, args: dict) -> None:
+        query = html.escape(args.get('q', ''))
+        suggestions = ''.join(
+            f'<CompleteSuggestion><suggestion data="{_}"/>'
+            f'</CompleteSuggestion>'
+            for _ in [query] + [f'{query} {word}' for word in WORDS[:9]])
+        self.respond(200, f'<?xml version="1.0"?><toplevel>{suggestions}'
+                          f'</toplevel>', 'text/xml; charset=UTF-8')
+
+    def element(self, args: dict) -> None:
+        path = urlparse(args.get('url', '')).path.lower()
+        if path.endswith('.ico') or 'favicon' in path:
+            self.respond(200, self.server.files[FAVICON_FILE], 'image/png')
+        elif path.endswith(IMAGE_EXTENSIONS) or '/images' in path:
+            self.respond(200, self.server.files[IMAGE_FILE], 'image/png')
+        else:
+            title = path.strip('/').replace('/', ' ') or 'Home'
+            self.respond(200, WINDOW_PAGE.format(
+                title=title, text=' '.join(WORDS * 4)))
+
+
+class UpstreamStub(ThreadingHTTPServer):
+    """The stand-in server
+
+    Attributes:
+        behaviour: How the stand-in responds
+        pages: Recorded corpus pages, by search type, device and size, which
+               are served in place of generated pages
+        verbose: Log each request
+    """
+    daemon_threads = True
+
+    def __init__(self, address: tuple = ('127.0.0.1', 5050),
+                 behaviour: StubBehaviour = None, corpus_dir: str = '',
+                 verbose: bool = False) -> None:
+        super().__init__(address, StubHandler)
+        self.behaviour = behaviour or StubBehaviour()
+        self.verbose = verbose
+        self.pages = {(page.search_type, page.device, page.num_results):
+                      page.html for page in load_corpus(corpus_dir)
+                      if page.recorded}
+        self.files = {}
+        for path in (FAVICON_FILE, IMAGE_FILE):
+            with open(path, 'rb') as image_file:
+                self.files[path] = image_file.read()
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def page(self, search_type: str, mobile: bool, num_results: int,
+             query: str, start: int) -> str:
+        device = DEVICES[int(mobile)]
+        if self.pages:
+            size = min(SIZES, key=lambda _: abs(_ - num_results))
+            recorded = self.pages.get((search_type, device, size))
+            if recorded:
+                return recorded
+        return generate_page(search_type, mobile, num_results, query, start)
+
+    def count(self, route: str, outcome: str) -> None:
+        with self._stats_lock:
+            key = (route, outcome)
+            self._stats[key] = self._stats.get(key, 0) + 1
+
+    def stats_snapshot(self) -> dict:
+        """The responses given so far, by route and outcome"""
+        stats = {}
+        with self._stats_lock:
+            for (route, outcome), count in sorted(self._stats.items()):
+                stats.setdefault(route, {})[outcome] = count
+        return stats
+
+    def start(self) -> 'UpstreamStub':
+        """Serves requests in a background thread"""
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+        if self._thread:
+            self._thread.join()
+
+
+@lru_cache(maxsize=512)
+def generate_page(search_type: str, mobile: bool, num_results: int,
+                  query: str, start: int) -> str:
+    return build_page(search_type, mobile, num_results, query or 'whoogle',
+                      seed=start)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        epilog='Latencies are distributions in seconds: "fixed:<seconds>", '
+               '"uniform:<min>-<max>", "exp:<mean>" or '
+               '"lognormal:<median>,<sigma>"')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='The address to listen on (default 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=5050,
+                        help='The port to listen on (default 5050)')
+    parser.add_argument('--corpus', default='',
+                        help='A directory of recorded pages to serve instead '
+                             'of generated pages')
+    for route in ('search', 'suggest', 'element'):
+        parser.add_argument(f'--{route}-latency', default='0',
+                            help=f'The latency of {route} responses')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='The fraction of responses that are errors')
+    parser.add_argument('--error-status', type=int, default=503,
+                        help='The status code of errors (default 503)')
+    parser.add_argument('--captcha-rate', type=float, default=0.0,
+                        help='The fraction of searches answered with a '
+                             'captcha page')
+    parser.add_argument('--block-rate', type=float, default=0.0,
+                        help='The fraction of searches redirected to the '
+                             '"sorry" page')
+    parser.add_argument('--reset-rate', type=float, default=0.0,
+                        help='The fraction of connections reset without a '
+                             'response')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Seeds the latencies and injected faults')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Log each request')
+    args = parser.parse_args()
+
+    try:
+        behaviour = StubBehaviour(
+            **{_: getattr(args, _) for _ in StubBehaviour.OPTIONS},
+            seed=args.seed)
+    except ValueError as e:
+        parser.error(str(e))
+
+    server = UpstreamStub((args.host, args.port), behaviour, args.corpus,
+                          args.verbose)
+    print(f'Upstream stand-in listening on {server.url}, set '
+          f'WHOOGLE_UPSTREAM_URL={server.url} to use it')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
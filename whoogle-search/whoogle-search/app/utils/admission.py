@@ -0,0 +1,234 @@
+import heapq
+import itertools
+import threading
+import time
+
+from requests.exceptions import RequestException
+
+# Priorities of upstream requests, from most to least urgent. Requests that
+# are waiting to be sent are admitted in priority order.
+PRIORITY_SEARCH = 0
+PRIORITY_AUTOCOMPLETE = 1
+PRIORITY_ELEMENT = 2
+PRIORITY_BACKGROUND = 3
+
+
+class AdmissionError(RequestException):
+    """Raised when an upstream request isn't admitted, either because it
+    waited too long for its turn, or because its egress identity is blocked
+    and the request is only a background one
+    """
+
+
+class EgressLimiter:
+    """Paces the upstream requests sent from one egress identity (i.e. the
+    direct connection, a proxy or a Tor circuit) with a token bucket, whose
+    rate adapts to captchas with AIMD (additive increase, multiplicative
+    decrease):
+
+    - Each successful response raises the rate by `increase`, up to the
+      maximum rate.
+    - Each captcha multiplies the rate by `decrease`, down to the minimum
+      rate, empties the bucket, and marks the identity as blocked for the
+      cooldown. Background requests aren't sent while it's blocked.
+
+    Requests that arrive when the bucket is empty queue for a token, and
+    are admitted in priority order (first come, first served within a
+    priority).
+
+    Attributes:
+        name: The egress identity
+        rate: The current rate, in requests per second
+        max_rate: The rate that the limiter recovers to
+        min_rate: The lowest rate that captchas can reduce the rate to
+        burst: The maximum number of requests that can be sent at once
+        increase: Requests per second added to the rate after each success
+        decrease: The factor the rate is multiplied by after a captcha
+        cooldown: Seconds that the identity is blocked after a captcha
+    """
+
+    def __init__(self,
+                 name: str,
+                 max_rate: float = 10,
+                 min_rate: float = 0.2,
+                 burst: float = 20,
+                 increase: float = 0.05,
+                 decrease: float = 0.5,
+                 cooldown: float = 60) -> None:
+        self.name = name
+        self.rate = max_rate
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.burst = max(burst, 1)
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.admitted = 0
+        self.rejected = 0
+        self.captchas = 0
+        self.verdicts = {}
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+
+    @property
+    def blocked(self) -> bool:
+        return time.monotonic() < self._blocked_until
+
+    def acquire(self, priority: int = PRIORITY_SEARCH,
+                timeout: float = 10) -> float:
+        """Waits for a turn to send an upstream request
+
+        Args:
+            priority: The priority of the request (one of the PRIORITY_*
+                      values)
+            timeout: The maximum number of seconds to wait
+
+        Returns:
+            float: The number of seconds spent waiting
+
+        Raises:
+            AdmissionError: if the request wasn't admitted
+
+        """
+        start = time.monotonic()
+        deadline = start + timeout
+        with self._cond:
+            if priority >= PRIORITY_BACKGROUND and self.blocked:
+                self.rejected += 1
+                raise AdmissionError(f'{self.name} is blocked by a captcha')
+
+            ticket = (priority, next(self._sequence))
+            heapq.heappush(self._waiters, ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    is_next = self._waiters[0] == ticket
+                    if is_next and self._tokens >= 1:
+                        self._tokens -= 1
+                        heapq.heappop(self._waiters)
+                        self.admitted += 1
+                        return now - start
+
+                    if now >= deadline:
+                        self.rejected += 1
+                        raise AdmissionError(
+                            f'Timed out waiting to send a request from '
+                            f'{self.name}')
+
+                    # The next request in line waits for its token, and the
+                    # rest wait for it to be admitted
+                    wait = deadline - now
+                    if is_next:
+                        wait = min(wait, (1 - self._tokens) / self.rate)
+                    self._cond.wait(wait)
+            finally:
+                if ticket in self._waiters:
+                    self._waiters.remove(ticket)
+                    heapq.heapify(self._waiters)
+                self._cond.notify_all()
+
+    def on_response(self, verdict: str) -> None:
+        """Updates the rate from the verdict of an upstream response's
+        classifier (see app.request.classify_response)
+
+        Args:
+            verdict: The verdict of the response
+
+        """
+        with self._cond:
+            self.verdicts[verdict] = self.verdicts.get(verdict, 0) + 1
+        if verdict in ('captcha', 'blocked'):
+            self.on_captcha()
+        elif verdict == 'ok':
+            self.on_success()
+
+    def on_success(self) -> None:
+        with self._cond:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_captcha(self) -> None:
+        with self._cond:
+            self.captchas += 1
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self._tokens = 0
+            self._updated = time.monotonic()
+            self._blocked_until = self._updated + self.cooldown
+
+    def reset(self) -> None:
+        """Restores the full rate (i.e. once a Tor circuit is replaced)"""
+        with self._cond:
+            self.rate = self.max_rate
+            self._tokens = self.burst
+            self._blocked_until = 0.0
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        with self._cond:
+            self._refill(time.monotonic())
+            return {
+                'rate': round(self.rate, 3),
+                'tokens': round(self._tokens, 3),
+                'queue_depth': len(self._waiters),
+                'blocked': self.blocked,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'captchas': self.captchas,
+                'verdicts': dict(self.verdicts)
+            }
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+class UpstreamScheduler:
+    """Admits upstream requests through an EgressLimiter for each egress
+    identity, which are created as identities are first used.
+
+    Attributes:
+        enabled: If False, requests are sent without waiting
+        max_wait: The maximum seconds a request waits for its turn
+        limiter_args: Keyword arguments for new EgressLimiters
+    """
+
+    def __init__(self, max_wait: float = 1, enabled: bool = True,
+                 **limiter_args) -> None:
+        self.enabled = enabled
+        self.max_wait = max_wait
+        self.limiter_args = limiter_args
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def get_limiter(self, identity: str) -> EgressLimiter:
+        with self._lock:
+            limiter = self._limiters.get(identity)
+            if limiter is None:
+                limiter = self._limiters[identity] = EgressLimiter(
+                    identity, **self.limiter_args)
+            return limiter
+
+    def acquire(self, identity: str, priority: int = PRIORITY_SEARCH) -> float:
+        if not self.enabled:
+            return 0.0
+        return self.get_limiter(identity).acquire(priority, self.max_wait)
+
+    def on_response(self, identity: str, verdict: str) -> None:
+        if self.enabled:
+            self.get_limiter(identity).on_response(verdict)
+
+    def reset(self, identity: str) -> None:
+        with self._lock:
+            limiter = self._limiters.get(identity)
+        if limiter is not None:
+            limiter.reset()
+
+    def stats(self) -> dict:
+        with self._lock:
+            limiters = list(self._limiters.values())
+        return {_.name: _.stats() for _ in limiters}
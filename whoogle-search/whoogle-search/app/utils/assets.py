@@ -0,0 +1,173 @@
+import gzip
+import json
+import os
+import tempfile
+
+import brotli
+from werkzeug.datastructures import Accept
+
+from app.utils.misc import gen_file_hash
+
+# Persisted between runs, so that only static files that have changed since
+# the last run need to be hashed again
+MANIFEST_FILE = 'manifest.json'
+
+# Precompressed variants of hashed assets, in order of preference
+COMPRESSED_VARIANTS = [
+    ('br', '.br', lambda data: brotli.compress(data, quality=11)),
+    ('gzip', '.gz', lambda data: gzip.compress(data, 9, mtime=0))
+]
+
+
+def load_manifest(build_folder: str) -> dict:
+    try:
+        with open(os.path.join(build_folder, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    return manifest if isinstance(manifest, dict) else {}
+
+
+def save_manifest(build_folder: str, manifest: dict) -> None:
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=build_folder, prefix='.manifest-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, os.path.join(build_folder, MANIFEST_FILE))
+    except OSError:
+        # The build folder may be read-only, in which case files will just be
+        # hashed again on the next run
+        pass
+
+
+def write_compressed_variants(src_path: str, build_path: str) -> None:
+    """Writes the precompressed variants of a hashed asset alongside it in
+    the build folder. Since hashed file names change with their contents,
+    variants that already exist are up to date and are left alone.
+
+    Variants that wouldn't be smaller than the original file are skipped.
+
+    Args:
+        src_path: The path to the original asset
+        build_path: The path of the asset's hashed link in the build folder
+
+    Returns:
+        None
+
+    """
+    data = None
+    for _, suffix, compress in COMPRESSED_VARIANTS:
+        variant_path = build_path + suffix
+        if os.path.exists(variant_path):
+            continue
+
+        if data is None:
+            with open(src_path, 'rb') as f:
+                data = f.read()
+
+        compressed = compress(data)
+        if len(compressed) >= len(data):
+            continue
+
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(build_path),
+                                            prefix='.asset-')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(compressed)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, variant_path)
+        except OSError:
+            # The build folder may be read-only, in which case the
+            # uncompressed asset is served instead
+            return
+
+
+def get_asset_variant(build_folder: str,
+                      filename: str,
+                      accept_encodings: Accept) -> tuple[str, str]:
+    """Picks the best precompressed variant of a hashed asset that the
+    client accepts.
+
+    Args:
+        build_folder: The build folder the asset is in
+        filename: The hashed file name of the asset
+        accept_encodings: The client's parsed Accept-Encoding header
+
+    Returns:
+        tuple[str, str]: The file name to serve, and its content encoding
+                         (or None if the original file should be served)
+
+    """
+    for encoding, suffix, _ in COMPRESSED_VARIANTS:
+        if not accept_encodings[encoding]:
+            continue
+
+        variant = filename + suffix
+        if os.path.isfile(os.path.join(build_folder, variant)):
+            return variant, encoding
+
+    return filename, None
+
+
+def build_cache_busting_map(static_folder: str,
+                            build_folder: str,
+                            app_root: str,
+                            cb_dirs: list) -> dict:
+    """Creates hashed links in the build folder for all static files in the
+    cache busting dirs, and maps each file name to its hashed url.
+
+    Files are only hashed again if their size or modification time has
+    changed since the last run. Brotli and gzip variants of each hashed file
+    are written alongside it, to be served to clients that accept them.
+
+    Args:
+        static_folder: The path to the static folder
+        build_folder: The path to create hashed file links in
+        app_root: The app root, which urls are made relative to
+        cb_dirs: The static folder subdirectories to include
+
+    Returns:
+        dict: The file names mapped to their relative cache busting urls
+
+    """
+    manifest = load_manifest(build_folder)
+    new_manifest = {}
+    cb_map = {}
+
+    for cb_dir in cb_dirs:
+        full_cb_dir = os.path.join(static_folder, cb_dir)
+        for cb_file in os.listdir(full_cb_dir):
+            full_cb_path = os.path.join(full_cb_dir, cb_file)
+            stat = os.stat(full_cb_path)
+            manifest_key = f'{cb_dir}/{cb_file}'
+            file_state = [stat.st_size, stat.st_mtime_ns]
+
+            entry = manifest.get(manifest_key)
+            if entry and entry[:2] == file_state:
+                cb_file_link = entry[2]
+            else:
+                # Create hash from current file state
+                cb_file_link = gen_file_hash(full_cb_dir, cb_file)
+
+            new_manifest[manifest_key] = file_state + [cb_file_link]
+            build_path = os.path.join(build_folder, cb_file_link)
+
+            try:
+                os.symlink(full_cb_path, build_path)
+            except FileExistsError:
+                # Symlink hasn't changed, ignore
+                pass
+
+            write_compressed_variants(full_cb_path, build_path)
+
+            # Create mapping for relative path urls
+            map_path = build_path.replace(app_root, '')
+            if map_path.startswith('/'):
+                map_path = map_path[1:]
+            cb_map[cb_file] = map_path
+
+    if new_manifest != manifest:
+        save_manifest(build_folder, new_manifest)
+
+    return cb_map
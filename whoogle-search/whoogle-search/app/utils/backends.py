@@ -0,0 +1,294 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextvars import copy_context
+import threading
+import time
+from typing import Callable
+
+from app.utils.tracing import tracer
+
+# Seconds after a backend blocks a request that it counts as blocking, and
+# is hedged right away instead of after the hedge delay
+BLOCK_WINDOW = 5 * 60
+
+
+class BackendBlocked(Exception):
+    """Raised by a backend when its response is blocked (i.e. by a captcha)"""
+
+
+class SearchBackend:
+    """An upstream search backend, which fetches result pages for queries.
+
+    Result pages are extracted and rendered from Google's basic HTML
+    markup, so every backend must return pages in that markup (i.e. another
+    Google domain, or a relay or mirror of it).
+
+    Attributes:
+        name: The name of the backend
+        attempts: The number of pages requested from the backend
+        wins: The number of requests that were answered by this backend
+        blocks: The number of requests that the backend blocked
+        errors: The number of requests that failed for other reasons
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.attempts = 0
+        self.wins = 0
+        self.blocks = 0
+        self.errors = 0
+        self.last_blocked = None
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({self.name!r})'
+
+    def fetch(self, search, user_request, full_query: str,
+              priority: int) -> str:
+        """Fetches the result page for a query
+
+        Args:
+            search: The Search that the page is for
+            user_request: The user's outbound request handler
+            full_query: The full query string (see app.request.gen_query)
+            priority: The priority of the upstream request
+
+        Returns:
+            str: The result page html
+
+        Raises:
+            BackendBlocked: if the backend blocked the request
+
+        """
+        raise NotImplementedError
+
+    def is_blocking(self) -> bool:
+        return self.last_blocked is not None and \
+            time.monotonic() - self.last_blocked < BLOCK_WINDOW
+
+    def stats(self) -> dict:
+        return {
+            'attempts': self.attempts,
+            'wins': self.wins,
+            'blocks': self.blocks,
+            'errors': self.errors,
+            'blocking': self.is_blocking()
+        }
+
+
+class GoogleBackend(SearchBackend):
+    """The default backend, which fetches pages from Google through the
+    user's request handler
+    """
+
+    def __init__(self, name: str = 'google') -> None:
+        super().__init__(name)
+
+    def fetch(self, search, user_request, full_query: str,
+              priority: int) -> str:
+        return search._fetch_upstream(user_request, full_query, priority)
+
+
+class UrlBackend(SearchBackend):
+    """A backend that fetches pages from a search url, which the full query
+    is appended to (in the same form as the default Google search url, i.e.
+    "https://www.google.co.uk/search?gbv=1&q=")
+
+    Attributes:
+        search_url: The url to append queries to
+    """
+
+    def __init__(self, name: str, search_url: str) -> None:
+        super().__init__(name)
+        self.search_url = search_url
+
+    def fetch(self, search, user_request, full_query: str,
+              priority: int) -> str:
+        from app.request import classify_response, BLOCKED_VERDICTS
+
+        response = user_request.send(base_url=self.search_url,
+                                     query=full_query,
+                                     force_mobile=search.config.view_image,
+                                     user_agent=search.user_agent,
+                                     priority=priority)
+        if classify_response(response) in BLOCKED_VERDICTS:
+            raise BackendBlocked(self.name)
+        return response.text
+
+
+def parse_backends(value: str) -> list:
+    """Parses secondary backends, in the form of:
+
+        name=https://host/search?q=,other=https://other/search?q=
+
+    Args:
+        value: The backends to parse
+
+    Returns:
+        list: A UrlBackend for each backend, in order
+
+    """
+    backends = []
+    for item in value.replace(' ', '').split(','):
+        if not item:
+            continue
+        name, _, url = item.partition('=')
+        backends.append(UrlBackend(name, url))
+    return backends
+
+
+class BackendPool:
+    """Fetches pages from the primary backend, hedging with the secondary
+    backends when it's slow or blocking.
+
+    A hedged request is sent to the next backend each time the hedge delay
+    passes without a usable page, or a backend fails. Backends that are
+    currently blocking are hedged right away. The first usable page wins,
+    and the pages of slower backends are discarded.
+
+    Attempts run on a pool of worker threads, which slower attempts keep
+    holding until they finish. Attempts are never queued for a worker:
+    while every worker is busy, searches are sent to the primary backend on
+    the caller's own thread, without hedging.
+
+    Attributes:
+        backends: The backends, with the primary backend first
+        hedge_delay: Seconds to wait for a backend before hedging
+        max_workers: The number of attempts that can run at once
+    """
+
+    def __init__(self, backends: list, hedge_delay: float = 2.0,
+                 max_workers: int = 8) -> None:
+        self.backends = backends
+        self.hedge_delay = hedge_delay
+        self.max_workers = max_workers
+        self._executor = None
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    @property
+    def primary(self) -> SearchBackend:
+        return self.backends[0]
+
+    def fetch(self,
+              fetch: Callable[[SearchBackend], str],
+              is_valid: Callable[[str], bool],
+              hedge: bool = True) -> str:
+        """Fetches a page from the backends
+
+        Args:
+            fetch: Fetches the page from a backend
+            is_valid: Checks if a fetched page is usable
+            hedge: If False, only the primary backend is used (i.e. for
+                   background requests)
+
+        Returns:
+            str: The first usable page, or the primary backend's unusable
+                 page if no backend returned a usable one
+
+        Raises:
+            Exception: the primary backend's error, if no backend returned
+                       a page
+
+        """
+        pending = {}
+        outcomes = {}
+        candidates = list(self.backends)
+
+        def launch_next() -> bool:
+            if not candidates:
+                return False
+            future = self._submit(candidates[0], fetch, is_valid)
+            if future is None:
+                return False
+            pending[future] = candidates.pop(0)
+            return True
+
+        if not hedge or len(self.backends) == 1 or not launch_next():
+            page, _, error = self._attempt(self.primary, fetch, is_valid)
+            if error is not None:
+                raise error
+            return page
+
+        while pending:
+            # Blocking backends are hedged without waiting for them
+            waiting_on = list(pending.values())
+            delay = 0 if all(_.is_blocking() for _ in waiting_on) \
+                else self.hedge_delay
+            done, _ = wait(pending, timeout=delay, return_when=FIRST_COMPLETED)
+            if not done:
+                if not launch_next():
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                backend = pending.pop(future)
+                page, usable, error = future.result()
+                if usable:
+                    with self._lock:
+                        backend.wins += 1
+                    return page
+                outcomes[backend] = (page, error)
+                launch_next()
+
+        page, error = outcomes[self.primary]
+        if error is not None:
+            raise error
+        return page
+
+    def _submit(self, backend: SearchBackend,
+                fetch: Callable[[SearchBackend], str],
+                is_valid: Callable[[str], bool]):
+        """Starts an attempt on a worker thread, if one is free
+
+        Returns:
+            Future: The attempt's outcome, or None if every worker is busy
+
+        """
+        with self._lock:
+            if self._in_flight >= self.max_workers:
+                return None
+            self._in_flight += 1
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix='backend')
+
+        def attempt() -> tuple:
+            try:
+                return self._attempt(backend, fetch, is_valid)
+            finally:
+                with self._lock:
+                    self._in_flight -= 1
+
+        # Each attempt runs in a copy of the caller's context, so that it's
+        # traced as part of the caller's request
+        return self._executor.submit(copy_context().run, attempt)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {_.name: _.stats() for _ in self.backends}
+
+    def _attempt(self, backend: SearchBackend,
+                 fetch: Callable[[SearchBackend], str],
+                 is_valid: Callable[[str], bool]) -> tuple:
+        with self._lock:
+            backend.attempts += 1
+        try:
+            with tracer.span('backend.fetch', **{'whoogle.backend':
+                                                 backend.name}):
+                page = fetch(backend)
+        except BackendBlocked as e:
+            self._record_block(backend)
+            return None, False, e
+        except Exception as e:
+            with self._lock:
+                backend.errors += 1
+            return None, False, e
+
+        if not is_valid(page):
+            self._record_block(backend)
+            return page, False, None
+        return page, True, None
+
+    def _record_block(self, backend: SearchBackend) -> None:
+        with self._lock:
+            backend.blocks += 1
+            backend.last_blocked = time.monotonic()
@@ -0,0 +1,172 @@
+from bisect import bisect_left
+import json
+import mmap
+import os
+import struct
+import tempfile
+
+# Store layout (all integers are unsigned 32 bit little endian):
+#   magic | version | signature length | signature | bang count |
+#   record offsets (count + 1) | records
+# where each record is "<operator>\0<url>\0<suggestion>" in utf-8, and records
+# are sorted by operator.
+STORE_MAGIC = b'WBNG'
+STORE_VERSION = 1
+
+_U32 = struct.Struct('<I')
+_HEADER = struct.Struct('<4sII')
+
+
+def get_sources_signature(bang_files: list[str]) -> bytes:
+    """Creates a signature for the state of a set of bang source files, used
+    to determine if a compiled store is out of date.
+
+    Args:
+        bang_files: The bang json files, in load order
+
+    Returns:
+        bytes: The signature of the files' paths, sizes and mtimes
+
+    """
+    sources = []
+    for bang_file in bang_files:
+        stat = os.stat(bang_file)
+        sources.append([bang_file, stat.st_size, stat.st_mtime_ns])
+
+    return json.dumps(sources).encode()
+
+
+def write_bang_store(store_file: str, bangs: dict, signature: bytes) -> None:
+    """Compiles a dict of bangs into a store file. The file is written to a
+    temporary location first and then moved into place, so that processes
+    which have the previous store mapped are unaffected.
+
+    Args:
+        store_file: The path to write the store to
+        bangs: The dict of bang operators to their url/suggestion
+        signature: The signature of the sources the bangs were loaded from
+
+    Returns:
+        None
+
+    """
+    records = bytearray()
+    offsets = [0]
+    for operator in sorted(bangs):
+        bang = bangs[operator]
+        records += '\0'.join(
+            [operator, bang['url'], bang['suggestion']]).encode()
+        offsets.append(len(records))
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(store_file),
+                                    prefix='.bangs-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_HEADER.pack(STORE_MAGIC, STORE_VERSION, len(signature)))
+            f.write(signature)
+            f.write(_U32.pack(len(bangs)))
+            f.write(struct.pack(f'<{len(offsets)}I', *offsets))
+            f.write(records)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, store_file)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+class BangStore:
+    """A read-only, memory-mapped bang store. Since the store is mapped from
+    a file, its pages are shared between all worker processes, and bangs are
+    only decoded when looked up.
+
+    Provides the same lookups as bangs.BangIndex.
+
+    Attributes:
+        signature: The signature of the sources the store was built from
+    """
+    __slots__ = ('signature', '_mm', '_count', '_offsets', '_records')
+
+    def __init__(self, store_file: str) -> None:
+        with open(store_file, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # Stores can be truncated (i.e. by a full disk), so every section is
+        # checked to fit in the file before it's read
+        size = len(self._mm)
+        invalid = ValueError(f'Invalid bang store: {store_file}')
+        if size < _HEADER.size:
+            raise invalid
+
+        magic, version, sig_len = _HEADER.unpack_from(self._mm, 0)
+        if magic != STORE_MAGIC or version != STORE_VERSION:
+            raise invalid
+
+        pos = _HEADER.size
+        if pos + sig_len + _U32.size > size:
+            raise invalid
+        self.signature = self._mm[pos:pos + sig_len]
+        pos += sig_len
+
+        self._count = _U32.unpack_from(self._mm, pos)[0]
+        self._offsets = pos + _U32.size
+        self._records = self._offsets + (self._count + 1) * _U32.size
+        if self._records > size or \
+                self._record_offset(self._count) > size:
+            raise invalid
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __contains__(self, operator: str) -> bool:
+        return self._find(operator) is not None
+
+    def __getitem__(self, idx: int) -> str:
+        # Indexed access to the sorted operators, used for bisecting
+        start = self._record_offset(idx)
+        end = self._mm.find(b'\0', start)
+        return self._mm[start:end].decode()
+
+    def _record_offset(self, idx: int) -> int:
+        return self._records + _U32.unpack_from(
+            self._mm, self._offsets + idx * _U32.size)[0]
+
+    def _record(self, idx: int) -> list[str]:
+        start = self._record_offset(idx)
+        end = self._record_offset(idx + 1)
+        return self._mm[start:end].decode().split('\0')
+
+    def _find(self, operator: str):
+        idx = bisect_left(self, operator, 0, self._count)
+        if idx < self._count and self[idx] == operator:
+            return idx
+        return None
+
+    def get(self, operator: str, default=None):
+        idx = self._find(operator)
+        if idx is None:
+            return default
+
+        _, url, suggestion = self._record(idx)
+        return {'url': url, 'suggestion': suggestion}
+
+    def suggest(self, prefix: str, limit: int) -> list[str]:
+        """Finds the suggestions for bang operators starting with a prefix
+
+        Args:
+            prefix: The partial bang operator
+            limit: The max number of suggestions to return
+
+        Returns:
+            list[str]: The suggestions, in the operators' sorted order
+
+        """
+        suggestions = []
+        idx = bisect_left(self, prefix, 0, self._count)
+        while idx < self._count and len(suggestions) < limit:
+            operator, _, suggestion = self._record(idx)
+            if not operator.startswith(prefix):
+                break
+            suggestions.append(suggestion)
+            idx += 1
+
+        return suggestions
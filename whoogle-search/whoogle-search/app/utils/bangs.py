@@ -1,29 +1,109 @@
+from app.utils.bang_store import BangStore, get_sources_signature, \
+    write_bang_store
+from bisect import bisect_left
+import contextlib
 import json
+import struct
 import requests
 import urllib.parse as urlparse
 import os
 import glob
+import sys
+import tempfile
+import time
+import traceback
 
-bangs_dict = {}
 DDG_BANGS = 'https://duckduckgo.com/bang.js'
 
+# Compiled store of all bang files, kept alongside them
+BANG_STORE_FILE = 'bangs.bin'
 
-def load_all_bangs(ddg_bangs_file: str, ddg_bangs: dict = {}):
+# Minimum number of bangs for a downloaded DDG bang list to be used
+MIN_DDG_BANGS = 1000
+
+BANG_REQUEST_TIMEOUT = 30
+
+# Seconds between checks for changed bang files, and between attempts to
+# download the DDG bang list after a failure
+BANG_WATCH_INTERVAL = 60
+BANG_RETRY_INTERVAL = 15 * 60
+
+# Max number of suggestions returned for a partial bang
+BANG_SUGGESTION_LIMIT = 10
+
+
+class BangIndex:
+    """A read-only snapshot of all loaded bangs, with the bang operators kept
+    in a sorted array for prefix lookups. Used when bangs can't be compiled
+    into a BangStore.
+
+    Attributes:
+        bangs: The dict of bang operators to their url/suggestion
+        keys: The sorted list of bang operators
+        signature: The signature of the sources the bangs were loaded from
+    """
+    __slots__ = ('bangs', 'keys', 'signature')
+
+    def __init__(self, bangs: dict, signature: bytes = b'') -> None:
+        self.bangs = bangs
+        self.keys = sorted(bangs)
+        self.signature = signature
+
+    def __contains__(self, operator: str) -> bool:
+        return operator in self.bangs
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def get(self, operator: str, default=None):
+        return self.bangs.get(operator, default)
+
+    def suggest(self, prefix: str, limit: int) -> list[str]:
+        """Finds the suggestions for bang operators starting with a prefix
+
+        Args:
+            prefix: The partial bang operator
+            limit: The max number of suggestions to return
+
+        Returns:
+            list[str]: The suggestions, in the operators' sorted order
+
+        """
+        suggestions = []
+        idx = bisect_left(self.keys, prefix)
+        while idx < len(self.keys) and len(suggestions) < limit:
+            key = self.keys[idx]
+            if not key.startswith(prefix):
+                break
+            suggestions.append(self.bangs[key]['suggestion'])
+            idx += 1
+
+        return suggestions
+
+
+# Replaced as a whole whenever bangs are (re)loaded, so lookups always see a
+# fully built index
+bangs_index = BangIndex({})
+
+
+def load_all_bangs(ddg_bangs_file: str, ddg_bangs: dict = {},
+                   reload: bool = False):
     """Loads all the bang files in alphabetical order
 
     Args:
         ddg_bangs_file: The str path to the new DDG bangs json file
         ddg_bangs: The dict of ddg bangs. If this is empty, it will load the
                    bangs from the file
+        reload: Reload bangs from the files even if bangs are already loaded
 
     Returns:
         None
 
     """
-    global bangs_dict
+    global bangs_index
     ddg_bangs_file = os.path.normpath(ddg_bangs_file)
 
-    if (bangs_dict and not ddg_bangs) or os.path.getsize(ddg_bangs_file) <= 4:
+    if len(bangs_index) and not ddg_bangs and not reload:
         return
 
     bangs = {}
@@ -36,11 +116,24 @@ def load_all_bangs(ddg_bangs_file: str, ddg_bangs: dict = {}):
     # Move the ddg bangs file to the beginning
     bang_files = sorted([f for f in bang_files if f != ddg_bangs_file])
 
+    store_file = os.path.join(bangs_dir, BANG_STORE_FILE)
+    signature = get_sources_signature([ddg_bangs_file] + bang_files)
+
+    # Map the compiled store directly if none of the bang files have changed
+    # since it was built
+    if not ddg_bangs:
+        with contextlib.suppress(OSError, ValueError, struct.error):
+            store = BangStore(store_file)
+            if store.signature == signature:
+                bangs_index = store
+                return
+
     if ddg_bangs:
         bangs |= ddg_bangs
     else:
         bang_files.insert(0, ddg_bangs_file)
 
+    complete = True
     for i, bang_file in enumerate(bang_files):
         try:
             bangs |= json.load(open(bang_file))
@@ -49,57 +142,171 @@ def load_all_bangs(ddg_bangs_file: str, ddg_bangs: dict = {}):
             # occur if file is still being written
             if i != 0:
                 raise
+            complete = False
 
-    bangs_dict = dict(sorted(bangs.items()))
+    if not complete:
+        # Files are only loaded again once they change, i.e. when the DDG
+        # bangs file has finished being written
+        bangs_index = BangIndex(bangs, signature)
+        return
 
+    try:
+        write_bang_store(store_file, bangs, signature)
+        bangs_index = BangStore(store_file)
+    except OSError:
+        # Keep bangs in memory if the store can't be written (i.e. a
+        # read-only bangs directory)
+        bangs_index = BangIndex(bangs, signature)
 
-def gen_bangs_json(bangs_file: str) -> None:
-    """Generates a json file from the DDG bangs list
 
-    Args:
-        bangs_file: The str path to the new DDG bangs json file
+def fetch_ddg_bangs() -> dict:
+    """Downloads the DDG bangs list and converts it to Whoogle's bang format
 
     Returns:
-        None
+        dict: The dict of DDG bang operators to their url/suggestion
+
+    Raises:
+        ValueError: If the downloaded list isn't a valid bang list
 
     """
-    try:
-        # Request full list from DDG
-        r = requests.get(DDG_BANGS)
-        r.raise_for_status()
-    except requests.exceptions.HTTPError as err:
-        raise SystemExit(err)
+    # Request full list from DDG
+    r = requests.get(DDG_BANGS, timeout=BANG_REQUEST_TIMEOUT)
+    r.raise_for_status()
 
     # Convert to json
     data = json.loads(r.text)
+    if not isinstance(data, list):
+        raise ValueError('Unexpected DDG bangs format')
 
     # Set up a json object (with better formatting) for all available bangs
     bangs_data = {}
 
     for row in data:
-        bang_command = '!' + row['t']
-        bangs_data[bang_command] = {
-            'url': row['u'].replace('{{{s}}}', '{}'),
-            'suggestion': bang_command + ' (' + row['s'] + ')'
-        }
+        try:
+            bang_command = '!' + row['t']
+            bangs_data[bang_command] = {
+                'url': row['u'].replace('{{{s}}}', '{}'),
+                'suggestion': bang_command + ' (' + row['s'] + ')'
+            }
+        except (KeyError, TypeError):
+            continue
+
+    # Guard against replacing the current bangs with a truncated list
+    if len(bangs_data) < MIN_DDG_BANGS:
+        raise ValueError(f'Only {len(bangs_data)} valid DDG bangs found')
+
+    return bangs_data
+
+
+def gen_bangs_json(bangs_file: str) -> bool:
+    """Generates a json file from the DDG bangs list, and reloads bangs
+
+    The file is only replaced once the new list has been downloaded and
+    validated, and is replaced atomically so it can never be read while
+    partially written.
+
+    Args:
+        bangs_file: The str path to the new DDG bangs json file
+
+    Returns:
+        bool: True if the bangs were updated
+
+    """
+    try:
+        bangs_data = fetch_ddg_bangs()
+    except (requests.exceptions.RequestException, ValueError) as err:
+        print(f'* Unable to update ddg bangs: {err}', file=sys.stderr)
+        return False
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(bangs_file),
+                                    prefix='.bangs-', suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(bangs_data, f)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, bangs_file)
 
-    json.dump(bangs_data, open(bangs_file, 'w'))
     print('* Finished creating ddg bangs json')
     load_all_bangs(bangs_file, bangs_data)
+    return True
+
+
+class BangRefresher:
+    """Keeps bangs up to date when run periodically as a background task
+    (see Scheduler), so that requests never wait on a bang download or
+    reload.
+
+    The DDG bang list is re-downloaded once the bangs file is older than the
+    refresh interval (or empty), and otherwise the bang directory is checked
+    for changed custom bang files. New bangs are always fully loaded before
+    replacing the current ones.
 
+    Attributes:
+        bangs_file: The str path to the DDG bangs json file
+        refresh_interval: Seconds between DDG bang list downloads, or 0 to
+                          only download the list if it's missing
+    """
+
+    def __init__(self, bangs_file: str, refresh_interval: int) -> None:
+        self.bangs_file = os.path.normpath(bangs_file)
+        self.refresh_interval = refresh_interval
+        self._next_download = 0.0
+
+    def needs_download(self) -> bool:
+        if time.time() < self._next_download:
+            return False
+
+        try:
+            stat = os.stat(self.bangs_file)
+        except FileNotFoundError:
+            return True
+
+        if stat.st_size <= 4:
+            return True
+
+        return bool(self.refresh_interval) and (
+            time.time() - stat.st_mtime > self.refresh_interval)
+
+    def files_changed(self) -> bool:
+        bang_files = glob.glob(
+            os.path.join(os.path.dirname(self.bangs_file), '*.json'))
+        bang_files = sorted([os.path.normpath(f) for f in bang_files
+                             if os.path.normpath(f) != self.bangs_file])
 
-def suggest_bang(query: str) -> list[str]:
+        try:
+            signature = get_sources_signature([self.bangs_file] + bang_files)
+        except FileNotFoundError:
+            # A bang file was removed while checking, try again next time
+            return False
+
+        return signature != bangs_index.signature
+
+    def check(self) -> None:
+        """Downloads a new DDG bang list if needed, otherwise reloads bangs
+        if any of the bang files have changed
+        """
+        try:
+            if self.needs_download():
+                if not gen_bangs_json(self.bangs_file):
+                    self._next_download = time.time() + BANG_RETRY_INTERVAL
+            elif self.files_changed():
+                load_all_bangs(self.bangs_file, reload=True)
+        except Exception:
+            # Keep the current bangs, and try again on the next check
+            print(traceback.format_exc(), file=sys.stderr)
+
+
+def suggest_bang(query: str, limit: int = BANG_SUGGESTION_LIMIT) -> list[str]:
     """Suggests bangs for a user's query
 
     Args:
         query: The search query
+        limit: The max number of suggestions to return
 
     Returns:
         list[str]: A list of bang suggestions
 
     """
-    global bangs_dict
-    return [bangs_dict[_]['suggestion'] for _ in bangs_dict if _.startswith(query)]
+    return bangs_index.suggest(query, limit)
 
 
 def resolve_bang(query: str) -> str:
@@ -113,12 +320,12 @@ def resolve_bang(query: str) -> str:
              wasn't a match or didn't contain a bang operator
 
     """
-    global bangs_dict
-
     #if ! not in query simply return (speed up processing)
     if '!' not in query:
         return ''
 
+    # Use the same index for every lookup, even if bangs are reloaded
+    bangs = bangs_index
     split_query = query.strip().split(' ')
 
     # look for operator in query if one is found, list operator should be of
@@ -126,7 +333,7 @@ def resolve_bang(query: str) -> str:
     operator = [
         word
         for word in split_query
-        if word.lower() in bangs_dict
+        if word.lower() in bangs
     ]
     if len(operator) == 1:
         # get operator
@@ -139,7 +346,7 @@ def resolve_bang(query: str) -> str:
         bang_query = ' '.join(split_query).strip()
 
         # Check if operator is a key in bangs and get bang if exists
-        bang = bangs_dict.get(operator.lower(), None)
+        bang = bangs.get(operator.lower(), None)
         if bang:
             bang_url = bang['url']
 
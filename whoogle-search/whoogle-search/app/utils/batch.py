@@ -0,0 +1,132 @@
+from concurrent.futures import Executor, FIRST_COMPLETED, wait
+from contextvars import copy_context
+from itertools import islice
+import threading
+import time
+from typing import Iterator
+
+from werkzeug.datastructures import MultiDict
+
+
+class BatchError(ValueError):
+    """Raised when a batch request can't be parsed"""
+
+
+class RateLimiter:
+    """Spaces out the start of upstream queries so that no more than `rate`
+    are started per second. Callers that arrive early are put to sleep
+    until their turn, rather than being rejected.
+
+    Attributes:
+        interval: Minimum seconds between the start of two queries (0 if
+                  unlimited)
+    """
+
+    def __init__(self, rate: float = 0) -> None:
+        self.interval = 1 / rate if rate > 0 else 0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self) -> float:
+        """Blocks until the caller is allowed to start a query
+
+        Returns:
+            float: The number of seconds spent waiting
+
+        """
+        if not self.interval:
+            return 0.0
+
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+
+        delay = start - now
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+
+def parse_batch_queries(data, max_queries: int) -> list:
+    """Parses the queries of a batch request body, in the form of:
+
+        {"queries": ["query", {"q": "query", "tbm": "nws", "start": 10}]}
+
+    Args:
+        data: The decoded JSON request body
+        max_queries: The maximum number of queries allowed in one batch
+
+    Returns:
+        list: A MultiDict of search params for each query, in order
+
+    Raises:
+        BatchError: if the body isn't a valid batch of queries
+
+    """
+    queries = data.get('queries') if isinstance(data, dict) else None
+    if not isinstance(queries, list) or not queries:
+        raise BatchError('Expected a non-empty list of queries')
+    if len(queries) > max_queries:
+        raise BatchError(f'Batches are limited to {max_queries} queries')
+
+    params = []
+    for idx, query in enumerate(queries):
+        if isinstance(query, str):
+            query = {'q': query}
+        if not isinstance(query, dict) or not isinstance(query.get('q'), str):
+            raise BatchError(f'Query {idx} is missing a "q" string')
+
+        start = query.get('start', 0)
+        if not isinstance(start, int) or isinstance(start, bool) or start < 0:
+            raise BatchError(f'Query {idx} has an invalid "start" value')
+
+        query_params = MultiDict({'q': query['q']})
+        if query.get('tbm'):
+            query_params['tbm'] = str(query['tbm'])
+        if start:
+            query_params['start'] = str(start)
+        params.append(query_params)
+
+    return params
+
+
+def run_batch(tasks: list, executor: Executor,
+              concurrency: int) -> Iterator[tuple]:
+    """Runs a list of tasks on a pool of threads shared by every batch,
+    yielding their results as each one finishes. Tasks should catch their
+    own errors, so that one failed task doesn't end the batch.
+
+    No more than `concurrency` tasks of a batch are submitted at once, so
+    concurrent batches take turns on the pool rather than each adding their
+    own threads. Tasks that haven't started yet are cancelled if the
+    generator is closed early (i.e. if the client disconnects).
+
+    Args:
+        tasks: The functions to run, which take no arguments
+        executor: The pool that batch tasks are run on
+        concurrency: The maximum number of tasks of the batch to run at once
+
+    Yields:
+        tuple: The index of the finished task and its result, in the order
+               that tasks finish
+
+    """
+    upcoming = enumerate(tasks)
+    pending = {}
+    try:
+        while True:
+            for idx, task in islice(upcoming,
+                                    max(1, concurrency) - len(pending)):
+                # Tasks run in the context of the batch's request
+                future = executor.submit(copy_context().run, task)
+                pending[future] = idx
+            if not pending:
+                return
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+    finally:
+        for future in pending:
+            future.cancel()
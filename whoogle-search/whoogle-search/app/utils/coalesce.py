@@ -0,0 +1,123 @@
+import threading
+from typing import Callable, Hashable
+import urllib.parse as urlparse
+
+
+class Flight:
+    """A call that is in progress, along with its outcome once finished.
+
+    Attributes:
+        done: Set once the call has finished
+        result: The value returned by the call
+        error: The exception raised by the call, or None
+        waiters: The number of duplicate calls waiting on this one
+    """
+    __slots__ = ('done', 'result', 'error', 'waiters')
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Coalesces identical calls that are made at the same time, so that only
+    the first one (the leader) is run. Duplicates that arrive while the
+    leader is running wait for its result, or its error, instead of making
+    the call again.
+
+    Waits are bounded: a duplicate that has waited for longer than the
+    timeout stops waiting and makes the call itself.
+
+    Attributes:
+        enabled: If False, every call is run on its own
+        timeout: Seconds that duplicates wait for the leader
+        leaders: The number of calls that were run
+        coalesced: The number of calls that used a leader's result
+        timeouts: The number of calls that gave up waiting on a leader
+    """
+
+    def __init__(self, timeout: float = 10, enabled: bool = True) -> None:
+        self.enabled = enabled
+        self.timeout = timeout
+        self.leaders = 0
+        self.coalesced = 0
+        self.timeouts = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, func: Callable):
+        """Runs func, unless a call with the same key is already in progress,
+        in which case that call's result is returned
+
+        Args:
+            key: Identifies calls that have the same result
+            func: The function to run, which takes no arguments
+
+        Returns:
+            The result of func (or of the call in progress)
+
+        """
+        if not self.enabled:
+            return func()
+
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = Flight()
+                self.leaders += 1
+                leader = True
+            else:
+                flight.waiters += 1
+                leader = False
+
+        if leader:
+            try:
+                flight.result = func()
+            except BaseException as e:
+                flight.error = e
+                raise
+            finally:
+                with self._lock:
+                    del self._flights[key]
+                flight.done.set()
+            return flight.result
+
+        if not flight.done.wait(self.timeout):
+            with self._lock:
+                self.timeouts += 1
+            return func()
+
+        with self._lock:
+            self.coalesced += 1
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'leaders': self.leaders,
+                'coalesced': self.coalesced,
+                'timeouts': self.timeouts,
+                'in_flight': len(self._flights)
+            }
+
+
+def normalize_url(url: str) -> str:
+    """Normalizes a url for comparison, so that urls that only differ in the
+    case of their scheme/host or the order of their params are the same
+
+    Args:
+        url: The url to normalize
+
+    Returns:
+        str: The normalized url
+
+    """
+    parts = urlparse.urlsplit(url)
+    query = urlparse.urlencode(
+        sorted(urlparse.parse_qsl(parts.query, keep_blank_values=True)))
+    return urlparse.urlunsplit((parts.scheme.lower(), parts.netloc.lower(),
+                                parts.path, query, ''))
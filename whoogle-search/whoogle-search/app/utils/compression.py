@@ -0,0 +1,247 @@
+import zlib
+
+import brotli
+from werkzeug.http import parse_accept_header
+
+# Responses are only compressed if they're one of these types
+COMPRESSIBLE_TYPES = (
+    'text/',
+    'application/json',
+    'application/javascript',
+    'application/x-ndjson',
+    'application/xml',
+    'application/opensearchdescription+xml',
+    'image/svg+xml'
+)
+
+
+class BrotliEncoder:
+    def __init__(self, level: int) -> None:
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush()
+
+    def finish(self) -> bytes:
+        return self._compressor.finish()
+
+
+class GzipEncoder:
+    def __init__(self, level: int) -> None:
+        # A wbits value of 16 + MAX_WBITS writes a gzip header and trailer
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                            16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+class CompressionMiddleware:
+    """WSGI middleware that compresses responses with brotli or gzip,
+    depending on what the client accepts.
+
+    Responses are compressed as they're streamed, rather than being
+    buffered in full. Streamed responses (those without a Content-Length)
+    aren't held back to check their size, and are flushed after each chunk,
+    so that clients can render them as they arrive. Anything the app passes
+    to the write callable is sent ahead of the chunks that follow it.
+
+    Responses that already have a Content-Encoding, aren't a compressible
+    type, or are under the minimum size are passed through unchanged.
+    """
+
+    def __init__(self,
+                 wsgi_app,
+                 br_level: int = 4,
+                 gzip_level: int = 6,
+                 min_size: int = 1024,
+                 exclude_paths: list = None) -> None:
+        self.wsgi_app = wsgi_app
+        self.encoders = [
+            ('br', lambda: BrotliEncoder(br_level)),
+            ('gzip', lambda: GzipEncoder(gzip_level))
+        ]
+        self.min_size = min_size
+        self.exclude_paths = tuple(exclude_paths or [])
+
+    def get_encoding(self, environ: dict):
+        """Picks the preferred encoding that the client accepts
+
+        Args:
+            environ: The WSGI environ of the request
+
+        Returns:
+            tuple: The encoding name and a factory for its encoder, or None
+                   if the response shouldn't be compressed
+
+        """
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            return None
+
+        if environ.get('PATH_INFO', '').startswith(self.exclude_paths):
+            return None
+
+        accepted = parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING'))
+        for encoding, make_encoder in self.encoders:
+            if accepted[encoding]:
+                return encoding, make_encoder
+
+        return None
+
+    def __call__(self, environ, start_response):
+        encoding = self.get_encoding(environ)
+        if encoding is None:
+            return self.wsgi_app(environ, start_response)
+
+        return self._compress(environ, start_response, *encoding)
+
+    def _compress(self, environ, start_response, encoding, make_encoder):
+        response = {}
+        written = []
+
+        def capture_start_response(status, headers, exc_info=None):
+            if exc_info and response.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+
+            response['status'] = status
+            response['headers'] = headers
+            response['exc_info'] = exc_info
+            return written.append
+
+        app_iter = self.wsgi_app(environ, capture_start_response)
+        chunks = _with_written(app_iter, written)
+
+        try:
+            # Apps may wait until they're iterated to start the response, so
+            # the body is read until they do
+            pending = []
+            size = 0
+            ended = False
+            while 'status' not in response:
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    ended = True
+                    break
+                pending.append(chunk)
+                size += len(chunk)
+
+            headers = response['headers']
+            compress = self._should_compress(response['status'], headers,
+                                             size, ended)
+            if compress:
+                headers = self._update_headers(headers, encoding)
+
+            response['sent'] = True
+            start_response(response['status'], headers,
+                           response['exc_info'])
+        except BaseException:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+            raise
+
+        if not compress:
+            return self._passthrough(app_iter, chunks, pending)
+
+        return self._encode(app_iter, chunks, pending, make_encoder(),
+                            streamed=not _get_header(headers,
+                                                     'Content-Length'))
+
+    def _should_compress(self, status: str, headers: list,
+                         size: int, ended: bool) -> bool:
+        if status[:3] in ('204', '206', '304') or status[0] == '1':
+            return False
+
+        if _get_header(headers, 'Content-Encoding'):
+            return False
+
+        content_type = _get_header(headers, 'Content-Type') or ''
+        if not content_type.startswith(COMPRESSIBLE_TYPES):
+            return False
+
+        content_length = _get_header(headers, 'Content-Length')
+        if content_length and content_length.isdigit():
+            return int(content_length) >= self.min_size
+
+        return not ended or size >= self.min_size
+
+    @staticmethod
+    def _update_headers(headers: list, encoding: str) -> list:
+        updated = []
+        vary = []
+        for name, value in headers:
+            lower_name = name.lower()
+            if lower_name == 'content-length':
+                continue
+            elif lower_name == 'vary':
+                vary.append(value)
+                continue
+            elif lower_name == 'etag' and not value.startswith('W/'):
+                # The compressed body is no longer byte-for-byte identical
+                value = f'W/{value}'
+            updated.append((name, value))
+
+        if not any('accept-encoding' in _.lower() for _ in vary):
+            vary.append('Accept-Encoding')
+        updated.append(('Vary', ', '.join(vary)))
+        updated.append(('Content-Encoding', encoding))
+        return updated
+
+    @staticmethod
+    def _passthrough(app_iter, chunks, pending):
+        try:
+            yield from pending
+            yield from chunks
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+    @staticmethod
+    def _encode(app_iter, chunks, pending, encoder, streamed: bool):
+        try:
+            data = encoder.compress(b''.join(pending))
+            if streamed:
+                data += encoder.flush()
+            if data:
+                yield data
+
+            for chunk in chunks:
+                data = encoder.compress(chunk)
+                if streamed:
+                    data += encoder.flush()
+                if data:
+                    yield data
+
+            yield encoder.finish()
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+
+def _with_written(app_iter, written: list):
+    """Yields the chunks of a response, preceded by anything the app
+    passed to the write callable while producing them"""
+    for chunk in app_iter:
+        if written:
+            yield from written
+            written.clear()
+        yield chunk
+    yield from written
+    written.clear()
+
+
+def _get_header(headers: list, name: str):
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
@@ -0,0 +1,127 @@
+from functools import lru_cache
+from types import SimpleNamespace
+
+from flask import current_app, render_template
+from markupsafe import escape
+
+from app.utils.results import get_tab_links, get_tabs_layout
+
+FRAGMENT_CACHE_SIZE = 256
+
+# Query-dependent parts of cached fragments are rendered as slots, which are
+# filled in for each request. Slots are wrapped in a null character, which
+# can't appear in rendered template output otherwise.
+SLOT_MARK = '\0'
+QUERY_SLOT = 'query'
+
+# The config attributes used by header.html (and logo.html). The rendered
+# header is cached on these, so this must list every config attribute that
+# the templates use.
+HEADER_CONFIG_KEYS = ('dark', 'get_only', 'preferences', 'country', 'tbs')
+
+
+def slot(name: str) -> str:
+    return f'{SLOT_MARK}{name}{SLOT_MARK}'
+
+
+def tab_slot_name(tab_id: str) -> str:
+    return f'tab-{tab_id}'
+
+
+@lru_cache(maxsize=8)
+def render_logo(dark: bool = False) -> str:
+    """Renders the logo, which doesn't change between requests
+
+    Args:
+        dark: If the dark theme is enabled
+
+    Returns:
+        str: The rendered logo
+    """
+    return render_template('logo.html', dark=dark)
+
+
+@lru_cache(maxsize=FRAGMENT_CACHE_SIZE)
+def render_header_fragment(lang: str,
+                           mobile: bool,
+                           search_type: str,
+                           config_values: tuple) -> tuple[str, ...]:
+    """Renders the results page header with slots in place of the query and
+    tab links, and splits it on the slots.
+
+    Args:
+        lang: The localization language
+        mobile: If the mobile header should be rendered
+        search_type: The current search_type
+        config_values: The values of HEADER_CONFIG_KEYS for the user's config
+
+    Returns:
+        tuple[str, ...]: The rendered header split on its slots, so that the
+                         slot names are at odd indices
+    """
+    config = SimpleNamespace(**dict(zip(HEADER_CONFIG_KEYS, config_values)))
+    translation = current_app.config['TRANSLATIONS'][lang]
+
+    tabs = get_tabs_layout(current_app.config['HEADER_TAB_TEMPLATES'],
+                           search_type,
+                           translation)
+    for tab_id, tab_content in tabs.items():
+        tab_content['href'] = slot(tab_slot_name(tab_id))
+
+    home_url = (f'home?preferences={config.preferences}'
+                if config.preferences else 'home')
+    header = render_template(
+        'header.html',
+        home_url=home_url,
+        config=config,
+        translation=translation,
+        languages=current_app.config['LANGUAGES'],
+        countries=current_app.config['COUNTRIES'],
+        time_periods=current_app.config['TIME_PERIODS'],
+        logo=render_logo(config.dark),
+        query=slot(QUERY_SLOT),
+        search_type=search_type,
+        mobile=mobile,
+        tabs=tabs)
+
+    return tuple(header.split(SLOT_MARK))
+
+
+def render_search_header(config,
+                         lang: str,
+                         mobile: bool,
+                         query: str,
+                         full_query: str,
+                         search_type: str) -> str:
+    """Renders the results page header from its cached fragment, filling in
+    the parts that depend on the query.
+
+    Args:
+        config: The user's config
+        lang: The localization language
+        mobile: If the mobile header should be rendered
+        query: The unquoted search query
+        full_query: The original search query (used for tab links)
+        search_type: The current search_type
+
+    Returns:
+        str: The rendered header
+    """
+    parts = render_header_fragment(
+        lang,
+        bool(mobile),
+        search_type,
+        tuple(getattr(config, key) for key in HEADER_CONFIG_KEYS))
+
+    # Filled in the same way as the template would ({{ clean_query(query) }})
+    clean_query = current_app.jinja_env.globals['clean_query']
+    values = {QUERY_SLOT: escape(clean_query(query))}
+    links = get_tab_links(current_app.config['HEADER_TAB_TEMPLATES'],
+                          full_query,
+                          search_type,
+                          config.preferences)
+    for tab_id, href in links.items():
+        values[tab_slot_name(tab_id)] = escape(href)
+
+    return ''.join(
+        values[part] if idx % 2 else part for idx, part in enumerate(parts))
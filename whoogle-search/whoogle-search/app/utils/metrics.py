@@ -0,0 +1,453 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+import os
+import threading
+import time
+from typing import Callable, Iterable
+import weakref
+
+# Upper bounds of the default histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _ShardOwner:
+    """Holds a thread's shard of a metric. Only the thread refers to it, so
+    it's released when the thread exits."""
+    __slots__ = ('shard', '__weakref__')
+
+    def __init__(self) -> None:
+        self.shard = {}
+
+
+class Metric:
+    """A metric that is recorded by many threads at once.
+
+    Each thread records into its own shard, so that recording never waits on
+    a lock (the lock is only taken when a thread records its first value).
+    Shards are summed when the metric is collected. When a thread exits, its
+    shard is folded into a base shard, so that short-lived threads don't
+    leave shards behind.
+
+    Attributes:
+        name: The metric name
+        help: A description of the metric
+        labelnames: The names of the metric's labels
+    """
+    type = ''
+
+    def __init__(self, name: str, help: str,
+                 labelnames: Iterable[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._base = {}
+        self._shards = []
+        self._lock = threading.Lock()
+
+    def _shard(self) -> dict:
+        owner = getattr(self._local, 'owner', None)
+        if owner is None:
+            owner = self._local.owner = _ShardOwner()
+            with self._lock:
+                self._shards.append(owner.shard)
+            weakref.finalize(owner, self._retire, owner.shard).atexit = False
+        return owner.shard
+
+    def _retire(self, shard: dict) -> None:
+        with self._lock:
+            self._shards = [_ for _ in self._shards if _ is not shard]
+            for labels, value in shard.items():
+                self._base[labels] = self._merge(self._base.get(labels),
+                                                 value)
+
+    @staticmethod
+    def _merge(total, value):
+        return (total or 0) + value
+
+    def _collect_shards(self) -> list:
+        with self._lock:
+            shards = list(self._shards)
+            base = self._base.copy()
+        # Copying a dict doesn't release the GIL, so copies are consistent
+        # even while the owning thread keeps recording
+        return [base] + [_.copy() for _ in shards]
+
+    def samples(self) -> list:
+        """Collects the metric's samples
+
+        Returns:
+            list: (name suffix, label names, label values, value) tuples
+
+        """
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """A value that only goes up (i.e. the number of requests handled)"""
+    type = 'counter'
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def get(self, *labels) -> float:
+        return sum(_.get(labels, 0) for _ in self._collect_shards())
+
+    def samples(self) -> list:
+        totals = {}
+        for shard in self._collect_shards():
+            for labels, value in shard.items():
+                totals[labels] = totals.get(labels, 0) + value
+        return [('', self.labelnames, labels, value)
+                for labels, value in sorted(totals.items())]
+
+
+class Gauge(Counter):
+    """A value that goes up and down (i.e. the number of requests in
+    progress)
+    """
+    type = 'gauge'
+
+    def dec(self, *labels, amount: float = 1) -> None:
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    """Counts observed values (i.e. durations) in buckets by their size
+
+    Attributes:
+        buckets: The upper bounds of the buckets
+    """
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str,
+                 labelnames: Iterable[str] = (),
+                 buckets: tuple = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels) -> None:
+        shard = self._shard()
+        # Bucket counts, followed by the +Inf bucket, the sum and the count
+        counts = shard.get(labels)
+        if counts is None:
+            counts = shard[labels] = [0] * (len(self.buckets) + 3)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    @staticmethod
+    def _merge(total, value):
+        if total is None:
+            return list(value)
+        return [a + b for a, b in zip(total, value)]
+
+    @contextmanager
+    def time(self, *labels):
+        """Observes the duration of the block, in seconds"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def samples(self) -> list:
+        totals = {}
+        for shard in self._collect_shards():
+            for labels, counts in shard.items():
+                total = totals.setdefault(labels, [0] * len(counts))
+                for idx, count in enumerate(list(counts)):
+                    total[idx] += count
+
+        samples = []
+        names = self.labelnames + ('le',)
+        for labels, total in sorted(totals.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), total):
+                cumulative += count
+                samples.append(('_bucket', names,
+                                labels + (format_value(bound),), cumulative))
+            samples.append(('_sum', self.labelnames, labels, total[-2]))
+            samples.append(('_count', self.labelnames, labels, total[-1]))
+        return samples
+
+
+class CallbackMetric(Metric):
+    """A metric whose values are read from elsewhere when it's collected
+    (i.e. the stats of a cache)
+
+    Attributes:
+        func: Returns the current values, as a number, or as a dict of label
+              values to numbers
+    """
+
+    def __init__(self, name: str, help: str, type: str,
+                 func: Callable, labelnames: Iterable[str] = ()) -> None:
+        super().__init__(name, help, labelnames)
+        self.type = type
+        self.func = func
+
+    def samples(self) -> list:
+        values = self.func()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [('', self.labelnames,
+                 labels if isinstance(labels, tuple) else (labels,), value)
+                for labels, value in values.items()]
+
+
+class Registry:
+    """The collection of metrics served by the metrics endpoint"""
+
+    def __init__(self) -> None:
+        self.metrics = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, *args, **kwargs) -> Counter:
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs) -> Gauge:
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs) -> Histogram:
+        return self.register(Histogram(*args, **kwargs))
+
+    def callback(self, *args, **kwargs) -> CallbackMetric:
+        return self.register(CallbackMetric(*args, **kwargs))
+
+    def render(self) -> str:
+        """Renders all metrics in the Prometheus text exposition format
+
+        Returns:
+            str: The rendered metrics
+
+        """
+        lines = []
+        for metric in self.metrics.values():
+            try:
+                samples = metric.samples()
+            except Exception:
+                # A broken source shouldn't take down the other metrics
+                continue
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for suffix, names, labels, value in samples:
+                lines.append(f'{metric.name}{suffix}'
+                             f'{format_labels(names, labels)} '
+                             f'{format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+http_requests = registry.counter(
+    'whoogle_http_requests_total',
+    'Requests handled, by route, method and status code',
+    ('route', 'method', 'status'))
+http_duration = registry.histogram(
+    'whoogle_http_request_duration_seconds',
+    'Time spent handling requests, by route',
+    ('route',))
+requests_in_flight = registry.gauge(
+    'whoogle_http_requests_in_flight',
+    'Requests currently being handled (each one occupies a worker thread)')
+stage_duration = registry.histogram(
+    'whoogle_stage_duration_seconds',
+    'Time spent in each stage of the search pipeline',
+    ('stage',))
+upstream_duration = registry.histogram(
+    'whoogle_upstream_request_duration_seconds',
+    'Time spent on upstream requests, by egress identity',
+    ('egress',))
+upstream_responses = registry.counter(
+    'whoogle_upstream_responses_total',
+    'Upstream responses, by egress identity and status code ("error" for '
+    'failed requests)',
+    ('egress', 'status'))
+upstream_verdicts = registry.counter(
+    'whoogle_upstream_verdicts_total',
+    'Upstream search responses, by egress identity and classifier verdict '
+    '(ok, captcha, blocked or error)',
+    ('egress', 'verdict'))
+
+
+def get_resident_memory() -> int:
+    """Reads the resident memory of the process
+
+    Returns:
+        int: The resident memory, in bytes (or the peak resident memory, on
+             systems without /proc)
+
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_session_store_size(session_dir: str) -> dict:
+    """Counts the sessions in the session store, and their total size
+
+    Args:
+        session_dir: The session file directory
+
+    Returns:
+        dict: The number of sessions and bytes
+
+    """
+    sessions = size = 0
+    try:
+        with os.scandir(session_dir) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    sessions += 1
+                    size += entry.stat().st_size
+    except OSError:
+        pass
+    return {'sessions': sessions, 'bytes': size}
+
+
+def register_app_metrics(app) -> None:
+    """Registers metrics that are read from the app's runtime objects (its
+    caches, upstream scheduler, session store, etc) when they're collected
+
+    Args:
+        app: The Flask app
+
+    """
+    from app.models.config import encode_preferences, decode_preferences
+    from app.utils import bangs
+    from app.utils.fragments import render_header_fragment, render_logo
+
+    def cache_requests() -> dict:
+        values = {}
+        page_cache = app.page_cache.stats()
+        for result in ('hits', 'stale_hits', 'error_hits', 'misses'):
+            values[('page', result)] = page_cache[result]
+        values[('page_records', 'hits')] = page_cache['record_hits']
+        values[('page_records', 'misses')] = page_cache['record_misses']
+        flights = app.upstream_flights.stats()
+        values[('upstream_flights', 'hits')] = flights['coalesced']
+        values[('upstream_flights', 'misses')] = flights['leaders']
+        for name, func in (('preferences_encode', encode_preferences),
+                           ('preferences_decode', decode_preferences),
+                           ('header_fragment', render_header_fragment),
+                           ('logo', render_logo)):
+            info = func.cache_info()
+            values[(name, 'hits')] = info.hits
+            values[(name, 'misses')] = info.misses
+        return values
+
+    registry.callback(
+        'whoogle_cache_requests_total',
+        'Cache lookups, by cache and result',
+        'counter', cache_requests, ('cache', 'result'))
+    registry.callback(
+        'whoogle_cache_entries',
+        'Entries held in each cache',
+        'gauge',
+        lambda: {
+            'page': app.page_cache.stats()['entries'],
+            'preferences_encode': encode_preferences.cache_info().currsize,
+            'preferences_decode': decode_preferences.cache_info().currsize,
+            'header_fragment': render_header_fragment.cache_info().currsize
+        }, ('cache',))
+
+    def prefetches() -> dict:
+        stats = app.prefetcher.stats()
+        values = {outcome: stats[outcome]
+                  for outcome in ('issued', 'completed', 'hits')}
+        for reason, count in stats['skipped'].items():
+            values[f'skipped_{reason}'] = count
+        return values
+
+    registry.callback(
+        'whoogle_prefetches_total',
+        'Next page prefetches, by outcome',
+        'counter', prefetches, ('outcome',))
+
+    def backend_requests() -> dict:
+        values = {}
+        for name, stats in app.backend_pool.stats().items():
+            for outcome in ('attempts', 'wins', 'blocks', 'errors'):
+                values[(name, outcome)] = stats[outcome]
+        return values
+
+    registry.callback(
+        'whoogle_backend_requests_total',
+        'Result page requests to each search backend, by outcome',
+        'counter', backend_requests, ('backend', 'outcome'))
+
+    def egress_stats(key: str) -> Callable:
+        return lambda: {name: float(stats[key]) for name, stats
+                        in app.upstream_scheduler.stats().items()}
+
+    registry.callback(
+        'whoogle_upstream_rate',
+        'Current upstream request rate limit per egress identity, in '
+        'requests per second',
+        'gauge', egress_stats('rate'), ('egress',))
+    registry.callback(
+        'whoogle_upstream_queue_depth',
+        'Upstream requests waiting for their turn, per egress identity',
+        'gauge', egress_stats('queue_depth'), ('egress',))
+    registry.callback(
+        'whoogle_upstream_blocked',
+        'Whether each egress identity is cooling down after a captcha',
+        'gauge', egress_stats('blocked'), ('egress',))
+    registry.callback(
+        'whoogle_upstream_captchas_total',
+        'Captchas returned by upstream, per egress identity',
+        'counter', egress_stats('captchas'), ('egress',))
+
+    registry.callback(
+        'whoogle_session_store',
+        'Sessions in the session store, and their total size in bytes',
+        'gauge',
+        lambda: get_session_store_size(app.config['SESSION_FILE_DIR']),
+        ('unit',))
+    registry.callback(
+        'whoogle_bangs',
+        'Bang operators in the bang index',
+        'gauge', lambda: len(bangs.bangs_index))
+    registry.callback(
+        'whoogle_worker_threads',
+        'Threads available to handle requests',
+        'gauge', lambda: app.config['WORKER_THREADS'])
+    registry.callback(
+        'whoogle_threads',
+        'Threads in the process, including background workers',
+        'gauge', threading.active_count)
+    registry.callback(
+        'process_cpu_seconds_total',
+        'CPU time used by the process, in seconds',
+        'counter', time.process_time)
+    registry.callback(
+        'process_resident_memory_bytes',
+        'Resident memory of the process, in bytes',
+        'gauge', get_resident_memory)
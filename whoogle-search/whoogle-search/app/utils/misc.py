@@ -2,17 +2,24 @@ import base64
 import hashlib
 import contextlib
 import io
+import logging
 import os
 import re
 
 from requests import exceptions, get
-from urllib.parse import urlparse
+from urllib.parse import quote, urlparse
 from bs4 import BeautifulSoup as bsoup
 from cryptography.fernet import Fernet
 from flask import Request
 
 ddg_favicon_site = 'http://icons.duckduckgo.com/ip2'
 
+# Upstream hosts whose paths are served as they are by the upstream stand-in
+# server (see route_upstream)
+STAND_IN_HOSTS = ('www.google.com', 'suggestqueries.google.com')
+
+UPDATE_CHECK_TIMEOUT = 10
+
 empty_gif = base64.b64decode(
     'R0lGODlhAQABAIAAAP///////yH5BAEKAAEALAAAAAABAAEAAAICTAEAOw==')
 
@@ -27,6 +34,30 @@ placeholder_img = base64.b64decode(
 )
 
 
+def route_upstream(url: str) -> str:
+    """Points an upstream URL at the stand-in server set by
+    WHOOGLE_UPSTREAM_URL (see app.tools.upstream_stub), if there is one.
+    Searches and suggestions keep their path, and anything else (images,
+    favicons, pages opened in a window) is requested from its element
+    endpoint.
+
+    Args:
+        url: The upstream URL
+
+    Returns:
+        str: The URL to send the request to
+
+    """
+    stand_in = os.environ.get('WHOOGLE_UPSTREAM_URL', '').rstrip('/')
+    if not stand_in or url.startswith(stand_in):
+        return url
+
+    parsed = urlparse(url)
+    if parsed.netloc in STAND_IN_HOSTS:
+        return stand_in + url[len(f'{parsed.scheme}://{parsed.netloc}'):]
+    return f'{stand_in}/element?url={quote(url, safe="")}'
+
+
 def fetch_favicon(url: str) -> bytes:
     """Fetches a favicon using DuckDuckGo's favicon retriever
 
@@ -36,7 +67,8 @@ def fetch_favicon(url: str) -> bytes:
         bytes - the favicon bytes, or a placeholder image if one
         was not returned
     """
-    response = get(f'{ddg_favicon_site}/{urlparse(url).netloc}.ico')
+    response = get(route_upstream(
+        f'{ddg_favicon_site}/{urlparse(url).netloc}.ico'))
 
     if response.status_code == 200 and len(response.content) > 0:
         tmp_mem = io.BytesIO()
@@ -47,6 +79,20 @@ def fetch_favicon(url: str) -> bytes:
     return placeholder_img
 
 
+def load_cssutils():
+    """Imports cssutils on first use, since it is slow to import and isn't
+    needed until a stylesheet has to be parsed.
+
+    Returns:
+        module: the cssutils module
+    """
+    import cssutils
+
+    # removes warnings from cssutils
+    cssutils.log.setLevel(logging.CRITICAL)
+    return cssutils
+
+
 def gen_file_hash(path: str, static_file: str) -> str:
     file_contents = open(os.path.join(path, static_file), 'rb').read()
     file_hash = hashlib.md5(file_contents).hexdigest()[:8]
@@ -97,8 +143,9 @@ def get_proxy_host_url(r: Request, default: str, root=False) -> str:
 def check_for_update(version_url: str, current: str) -> int:
     # Check for the latest version of Whoogle
     has_update = ''
-    with contextlib.suppress(exceptions.ConnectionError, AttributeError):
-        update = bsoup(get(version_url).text, 'html.parser')
+    with contextlib.suppress(exceptions.RequestException, AttributeError):
+        update = bsoup(get(version_url, timeout=UPDATE_CHECK_TIMEOUT).text,
+                       'html.parser')
         latest = update.select_one('[class="Link--primary"]').string[1:]
         current = int(''.join(filter(str.isdigit, current)))
         latest = int(''.join(filter(str.isdigit, latest)))
@@ -0,0 +1,326 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+from typing import Any, Callable, Hashable
+
+# The search type used for the windows of regular (tbm-less) searches
+DEFAULT_WINDOW = 'all'
+
+
+class CacheWindow:
+    """How long a cached page can be used for, by age in seconds.
+
+    Attributes:
+        fresh: Pages younger than this are served without refreshing them
+        stale: Pages younger than this are served while they're refreshed
+               in the background (stale-while-revalidate)
+        error: Pages younger than this are served if the upstream request
+               fails or is blocked by a captcha (stale-on-error)
+    """
+    __slots__ = ('fresh', 'stale', 'error')
+
+    def __init__(self, fresh: float, stale: float, error: float) -> None:
+        self.fresh = fresh
+        self.stale = max(stale, fresh)
+        self.error = max(error, self.stale)
+
+    def __repr__(self) -> str:
+        return f'CacheWindow({self.fresh}, {self.stale}, {self.error})'
+
+
+# Default windows per search type. News results go stale quicker than
+# regular results, and image results rarely change.
+DEFAULT_WINDOWS = {
+    DEFAULT_WINDOW: CacheWindow(60, 600, 24 * 60 * 60),
+    'nws': CacheWindow(30, 120, 60 * 60),
+    'isch': CacheWindow(300, 3600, 24 * 60 * 60)
+}
+
+
+class CacheEntry:
+    __slots__ = ('page', 'stored_at', 'refreshing', 'prefetched', 'records')
+
+    def __init__(self, page: str, prefetched: bool = False) -> None:
+        self.page = page
+        self.stored_at = time.monotonic()
+        self.refreshing = False
+        self.prefetched = prefetched
+        # The records extracted from the page, by extraction variant
+        self.records = {}
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.stored_at
+
+
+def parse_cache_windows(value: str) -> dict:
+    """Parses cache windows for each search type, in the form of:
+
+        all=60:600:86400,nws=30:120:3600
+
+    where each window is "fresh:stale:error" in seconds. Search types that
+    aren't listed use the default windows.
+
+    Args:
+        value: The windows to parse
+
+    Returns:
+        dict: The CacheWindow for each search type
+
+    """
+    windows = dict(DEFAULT_WINDOWS)
+    for item in value.replace(' ', '').split(','):
+        if not item:
+            continue
+        search_type, _, ages = item.partition('=')
+        ages = [float(_) for _ in ages.split(':')]
+        fresh = ages[0]
+        stale = ages[1] if len(ages) > 1 else fresh
+        error = ages[2] if len(ages) > 2 else stale
+        windows[search_type or DEFAULT_WINDOW] = CacheWindow(fresh, stale,
+                                                             error)
+    return windows
+
+
+class PageCache:
+    """A cache of upstream result pages, which are served according to the
+    cache window of their search type:
+
+    - Fresh pages are served from the cache.
+    - Stale pages are served from the cache right away, and refreshed in
+      the background for the next request.
+    - Older pages are fetched again before responding. If that fetch fails
+      or is blocked by a captcha, the old page is served instead, up to the
+      error window.
+
+    Pages that aren't valid (i.e. blocked by a captcha) are never cached.
+    The records extracted from a cached page are kept with it, so that each
+    page is only parsed once (see get_records).
+
+    Attributes:
+        enabled: If False, every page is fetched from upstream
+        windows: The CacheWindow for each search type
+        max_entries: The maximum number of pages to keep
+    """
+
+    def __init__(self,
+                 windows: dict = None,
+                 max_entries: int = 100,
+                 refresh_workers: int = 2,
+                 enabled: bool = True) -> None:
+        self.enabled = enabled
+        self.windows = windows or dict(DEFAULT_WINDOWS)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.stale_hits = 0
+        self.error_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.prefetch_hits = 0
+        self.record_hits = 0
+        self.record_misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._refresher = ThreadPoolExecutor(max_workers=refresh_workers,
+                                             thread_name_prefix='refresh')
+
+    def get_window(self, search_type: str) -> CacheWindow:
+        return self.windows.get(search_type or DEFAULT_WINDOW,
+                                self.windows[DEFAULT_WINDOW])
+
+    def get_page(self,
+                 key: Hashable,
+                 search_type: str,
+                 fetch: Callable[[], str],
+                 is_valid: Callable[[str], bool],
+                 refresh: Callable[[], str] = None) -> str:
+        """Gets a page from the cache, or from upstream if the cached page is
+        too old to be used
+
+        Args:
+            key: Identifies requests that get the same upstream page
+            search_type: The search type (tbm) of the page
+            fetch: Fetches the page from upstream
+            is_valid: Checks if a fetched page can be cached and served
+            refresh: Fetches the page from upstream in the background, if
+                     different from fetch (i.e. at a lower priority)
+
+        Returns:
+            str: The page (which is only invalid if there isn't a cached
+                 page to serve instead)
+
+        Raises:
+            Exception: any error raised by fetch, if there isn't a cached
+                       page to serve instead
+
+        """
+        if not self.enabled:
+            return fetch()
+
+        window = self.get_window(search_type)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                age = entry.age
+                if age < window.fresh:
+                    self.hits += 1
+                    self._count_prefetch_hit(entry)
+                    return entry.page
+                elif age < window.stale:
+                    self.stale_hits += 1
+                    self._count_prefetch_hit(entry)
+                    if not entry.refreshing:
+                        entry.refreshing = True
+                        self._refresher.submit(self._refresh, key, entry,
+                                               refresh or fetch, is_valid)
+                    return entry.page
+            self.misses += 1
+
+        try:
+            page = fetch()
+        except Exception:
+            stale_page = self._get_error_page(entry, window)
+            if stale_page is None:
+                raise
+            return stale_page
+
+        if not is_valid(page):
+            stale_page = self._get_error_page(entry, window)
+            return page if stale_page is None else stale_page
+
+        self.store(key, page)
+        return page
+
+    def get_records(self,
+                    key: Hashable,
+                    page: str,
+                    variant: Hashable,
+                    extract: Callable[[], Any]) -> Any:
+        """Gets the records extracted from a page returned by get_page,
+        extracting them if they aren't cached with the page yet. Cached
+        records are shared between requests, so they shouldn't be modified.
+
+        Args:
+            key: Identifies requests that get the same upstream page
+            page: The page, as returned by get_page
+            variant: Identifies the settings that change what is extracted
+                     from the page (i.e. blocked titles)
+            extract: Extracts the records from the page
+
+        Returns:
+            Any: The records
+
+        """
+        if not self.enabled:
+            return extract()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            # A page that has since been refreshed gets its own records
+            if entry is None or entry.page is not page:
+                entry = None
+            elif variant in entry.records:
+                self.record_hits += 1
+                return entry.records[variant]
+            self.record_misses += 1
+
+        records = extract()
+        if entry is not None:
+            with self._lock:
+                entry.records[variant] = records
+        return records
+
+    def contains(self, key: Hashable, search_type: str) -> bool:
+        """Checks if a page is cached, and can be served without fetching it
+        again first
+
+        Args:
+            key: Identifies requests that get the same upstream page
+            search_type: The search type (tbm) of the page
+
+        Returns:
+            bool: True if the page is cached and isn't too old to serve
+
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and \
+                entry.age < self.get_window(search_type).stale
+
+    def store(self, key: Hashable, page: str,
+              prefetched: bool = False) -> None:
+        """Adds a page to the cache
+
+        Args:
+            key: Identifies requests that get the same upstream page
+            page: The page
+            prefetched: If the page was fetched before it was requested, in
+                        which case the first request for it counts as a
+                        prefetch hit
+
+        """
+        with self._lock:
+            self._entries[key] = CacheEntry(page, prefetched)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def sweep(self) -> int:
+        """Removes pages that are too old to be served for any reason
+
+        Returns:
+            int: The number of pages removed
+
+        """
+        max_age = max(_.error for _ in self.windows.values())
+        with self._lock:
+            expired = [key for key, entry in self._entries.items()
+                       if entry.age >= max_age]
+            for key in expired:
+                del self._entries[key]
+        return len(expired)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'error_hits': self.error_hits,
+                'misses': self.misses,
+                'refreshes': self.refreshes,
+                'prefetch_hits': self.prefetch_hits,
+                'record_hits': self.record_hits,
+                'record_misses': self.record_misses
+            }
+
+    def _get_error_page(self, entry: CacheEntry, window: CacheWindow):
+        if entry is None or entry.age >= window.error:
+            return None
+
+        with self._lock:
+            self.error_hits += 1
+        return entry.page
+
+    def _count_prefetch_hit(self, entry: CacheEntry) -> None:
+        if entry.prefetched:
+            entry.prefetched = False
+            self.prefetch_hits += 1
+
+    def _refresh(self, key: Hashable, entry: CacheEntry,
+                 fetch: Callable[[], str],
+                 is_valid: Callable[[str], bool]) -> None:
+        try:
+            page = fetch()
+            if is_valid(page):
+                self.store(key, page)
+                with self._lock:
+                    self.refreshes += 1
+        except Exception:
+            # The stale page is kept, and the next request for it tries to
+            # refresh it again
+            pass
+        finally:
+            entry.refreshing = False
@@ -0,0 +1,173 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+import time
+from typing import Callable, Hashable
+
+from app.utils.page_cache import PageCache
+
+# Seconds after upstream returns a captcha that prefetching is paused for
+CAPTCHA_COOLDOWN = 5 * 60
+
+
+class TokenBucket:
+    """Allows up to `capacity` actions at once, refilled at `rate` actions
+    per second.
+    """
+
+    def __init__(self, capacity: float, rate: float) -> None:
+        self.capacity = capacity
+        self.rate = rate
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self) -> bool:
+        """Takes a token from the bucket, if there is one
+
+        Returns:
+            bool: True if a token was taken
+
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity,
+                self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+def get_load() -> float:
+    """Gets the 1 minute load average per CPU, or 0 where it isn't available
+
+    Returns:
+        float: The load average per CPU
+
+    """
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (AttributeError, OSError):
+        return 0.0
+
+
+class Prefetcher:
+    """Speculatively fetches pages (i.e. the next page of results) into the
+    page cache in the background, before they're requested.
+
+    Prefetches are limited by a global budget, and skipped while upstream is
+    returning captchas or the node is overloaded, so that they never compete
+    with the pages users are waiting on.
+
+    Attributes:
+        page_cache: The cache that prefetched pages are stored in
+        enabled: If False, nothing is prefetched
+        budget: The token bucket limiting prefetches
+        max_in_flight: The maximum number of prefetches running at once
+        max_load: Prefetches are skipped while the load average per CPU is
+                  above this (0 for no limit)
+    """
+
+    def __init__(self,
+                 page_cache: PageCache,
+                 budget: int = 30,
+                 max_in_flight: int = 2,
+                 max_load: float = 1.0,
+                 enabled: bool = True) -> None:
+        self.page_cache = page_cache
+        self.enabled = enabled
+        self.budget = TokenBucket(budget, budget / 60)
+        self.max_in_flight = max_in_flight
+        self.max_load = max_load
+        self.issued = 0
+        self.completed = 0
+        self.skipped = {'cached': 0, 'captcha': 0, 'load': 0, 'budget': 0}
+        self._in_flight = 0
+        self._captcha_at = None
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight,
+                                            thread_name_prefix='prefetch')
+
+    def note_captcha(self) -> None:
+        """Records that upstream returned a captcha, which pauses
+        prefetching for CAPTCHA_COOLDOWN seconds
+        """
+        self._captcha_at = time.monotonic()
+
+    @property
+    def under_captcha_pressure(self) -> bool:
+        return self._captcha_at is not None and \
+            time.monotonic() - self._captcha_at < CAPTCHA_COOLDOWN
+
+    def prefetch(self,
+                 key: Hashable,
+                 search_type: str,
+                 fetch: Callable[[], str],
+                 is_valid: Callable[[str], bool]) -> bool:
+        """Fetches a page into the page cache in the background, unless it's
+        already cached or prefetching is currently suppressed
+
+        Args:
+            key: The page cache key of the page
+            search_type: The search type (tbm) of the page
+            fetch: Fetches the page from upstream
+            is_valid: Checks if a fetched page can be cached
+
+        Returns:
+            bool: True if the prefetch was started
+
+        """
+        if not self.enabled or not self.page_cache.enabled:
+            return False
+
+        reason = None
+        if self.page_cache.contains(key, search_type):
+            reason = 'cached'
+        elif self.under_captcha_pressure:
+            reason = 'captcha'
+        elif self.max_load and get_load() > self.max_load:
+            reason = 'load'
+
+        with self._lock:
+            if reason is None and (self._in_flight >= self.max_in_flight
+                                   or not self.budget.take()):
+                reason = 'budget'
+            if reason is not None:
+                self.skipped[reason] += 1
+                return False
+            self._in_flight += 1
+            self.issued += 1
+
+        self._executor.submit(self._run, key, fetch, is_valid)
+        return True
+
+    def stats(self) -> dict:
+        hits = self.page_cache.stats()['prefetch_hits']
+        with self._lock:
+            return {
+                'issued': self.issued,
+                'completed': self.completed,
+                'hits': hits,
+                'hit_ratio': round(hits / self.completed, 3)
+                if self.completed else 0.0,
+                'skipped': dict(self.skipped)
+            }
+
+    def _run(self, key: Hashable, fetch: Callable[[], str],
+             is_valid: Callable[[str], bool]) -> None:
+        try:
+            page = fetch()
+            if is_valid(page):
+                self.page_cache.store(key, page, prefetched=True)
+                with self._lock:
+                    self.completed += 1
+        except Exception:
+            # Prefetches are best effort, and the page is fetched as usual
+            # if it's requested
+            pass
+        finally:
+            with self._lock:
+                self._in_flight -= 1
@@ -1,8 +1,9 @@
 from app.models.config import Config
 from app.models.endpoint import Endpoint
+from app.models.g_classes import GClasses
+from app.models.result import Card, Result, ResultPage
 from app.utils.misc import list_to_dict
-from bs4 import BeautifulSoup, NavigableString
-import copy
+from bs4 import BeautifulSoup, NavigableString, Tag
 from flask import current_app
 import html
 import os
@@ -71,18 +72,20 @@ def contains_cjko(s: str) -> bool:
     return bool(re.search(fr'[{unicode_ranges}]', s))
 
 
-def bold_search_terms(response: str, query: str) -> BeautifulSoup:
+def bold_search_terms(response, query: str) -> BeautifulSoup:
     """Wraps all search terms in bold tags (<b>). If any terms are wrapped
     in quotes, only that exact phrase will be made bold.
 
     Args:
-        response: The initial response body for the query
+        response: The initial response body for the query, either as a str
+                  or already parsed (in which case it's modified in place)
         query: The original search query
 
     Returns:
         BeautifulSoup: modified soup object with bold items
     """
-    response = BeautifulSoup(response, 'html.parser')
+    if isinstance(response, str):
+        response = BeautifulSoup(response, 'html.parser')
 
     def replace_any_case(element: NavigableString, target_word: str) -> None:
         # Replace all instances of the word, but maintaining the same case in
@@ -314,7 +317,20 @@ def check_currency(response: str) -> dict:
         dict: Consists of currency names and values
 
     """
-    soup = BeautifulSoup(response, 'html.parser')
+    return get_currency(BeautifulSoup(response, 'html.parser'))
+
+
+def get_currency(soup: BeautifulSoup) -> dict:
+    """Extracts the currency conversion from a parsed results page
+
+    Args:
+        soup: The parsed results page
+
+    Returns:
+        dict: Consists of currency names and values, or is empty if the page
+              has no currency conversion
+
+    """
     currency_link = soup.find('a', {'href': 'https://g.co/gfd'})
     if currency_link:
         while 'class' not in currency_link.attrs or \
@@ -421,7 +437,108 @@ def add_currency_card(soup: BeautifulSoup,
     return soup
 
 
-def get_tabs_content(tabs: dict,
+class TabTemplate:
+    """A header tab's link, precompiled from its href format string so that
+    it can be filled in with the query without reformatting the href.
+
+    Attributes:
+        tab_id: The id of the tab in header_tabs.json
+        tbm: The search type of the tab, or None
+        name: The default name of the tab
+        prefix: The part of the href before the query
+        param: The query placeholder used by the href ('query' or
+               'map_query')
+        suffix: The part of the href after the query
+    """
+    __slots__ = ('tab_id', 'tbm', 'name', 'prefix', 'param', 'suffix')
+
+    def __init__(self, tab_id: str, tab: dict) -> None:
+        self.tab_id = tab_id
+        self.tbm = tab['tbm']
+        self.name = tab['name']
+        self.param = 'map_query' if '{map_query}' in tab['href'] else 'query'
+        self.prefix, _, self.suffix = tab['href'].partition(
+            '{' + self.param + '}')
+
+    def link(self, query: str, map_query: str, preferences: str) -> str:
+        if self.param == 'map_query':
+            return self.prefix + map_query + self.suffix
+
+        if self.tbm is not None:
+            query = f'{query}&tbm={self.tbm}'
+
+        if preferences:
+            query = f'{query}&preferences={preferences}'
+
+        return self.prefix + query + self.suffix
+
+
+# Matches the start param, so that tabs always start from page 1
+TAB_START_PARAM = re.compile(r'&start=\d+|start=\d+&?')
+TAB_EXTRA_AMPERSANDS = re.compile(r'&{2,}')
+
+
+def compile_tabs(tabs: dict) -> list[TabTemplate]:
+    """Precompiles the default tabs content into tab link templates
+
+    Args:
+        tabs: The default content for the tabs (from header_tabs.json)
+
+    Returns:
+        list[TabTemplate]: The compiled tabs, in display order
+    """
+    return [TabTemplate(tab_id, tab) for tab_id, tab in tabs.items()]
+
+
+def get_tabs_layout(tab_templates: list[TabTemplate],
+                    search_type: str,
+                    translation: dict) -> dict:
+    """Gets the query-independent content of the tabs
+
+    Args:
+        tab_templates: The compiled tabs
+        search_type: The current search_type
+        translation: The translation to get the names of the tabs
+
+    Returns:
+        dict: contains the name and if the tab is selected or not
+    """
+    selected = next((tab.tab_id for tab in tab_templates
+                     if tab.tbm == search_type), 'all')
+    return {tab.tab_id: {
+        'name': translation.get(tab.tab_id, tab.name),
+        'selected': tab.tab_id == selected
+    } for tab in tab_templates}
+
+
+def get_tab_links(tab_templates: list[TabTemplate],
+                  full_query: str,
+                  search_type: str,
+                  preferences: str) -> dict:
+    """Fills in the link of each tab with the query
+
+    Args:
+        tab_templates: The compiled tabs
+        full_query: The original search query
+        search_type: The current search_type
+        preferences: The user's encoded preferences, if any
+
+    Returns:
+        dict: The tab ids mapped to their hrefs
+    """
+    map_query = full_query
+    if '-site:' in full_query:
+        map_query = full_query[:full_query.index('-site:')]
+
+    query = full_query.replace(f'&tbm={search_type}', '')
+    query = TAB_START_PARAM.sub('', query)
+    query = TAB_EXTRA_AMPERSANDS.sub('&', query).strip('&')
+
+    return {tab.tab_id: tab.link(query, map_query, preferences)
+            for tab in tab_templates}
+
+
+def get_tabs_content(tab_templates: list[TabTemplate],
                      full_query: str,
                      search_type: str,
                      preferences: str,
@@ -429,48 +546,187 @@ def get_tabs_content(tabs: dict,
     """Takes the default tabs content and updates it according to the query.
 
     Args:
-        tabs: The default content for the tabs
+        tab_templates: The compiled tabs
         full_query: The original search query
         search_type: The current search_type
+        preferences: The user's encoded preferences, if any
         translation: The translation to get the names of the tabs
 
     Returns:
         dict: contains the name, the href and if the tab is selected or not
     """
-    map_query = full_query
-    if '-site:' in full_query:
-        block_idx = full_query.index('-site:')
-        map_query = map_query[:block_idx]
-    tabs = copy.deepcopy(tabs)
+    tabs = get_tabs_layout(tab_templates, search_type, translation)
+    links = get_tab_links(tab_templates, full_query, search_type, preferences)
     for tab_id, tab_content in tabs.items():
-        # update name to desired language
-        if tab_id in translation:
-            tab_content['name'] = translation[tab_id]
-
-        # update href with query
-        query = full_query.replace(f'&tbm={search_type}', '')
-        
-        # Remove start parameter to ensure tabs always start from page 1
-        # This fixes the issue where switching tabs inherits page numbers
-        query = re.sub(r'&start=\d+', '', query)
-        query = re.sub(r'start=\d+&?', '', query)
-        
-        # Clean up any double ampersands that might result from parameter removal
-        query = re.sub(r'&+', '&', query)
-        query = query.strip('&')
-
-        if tab_content['tbm'] is not None:
-            query = f"{query}&tbm={tab_content['tbm']}"
+        tab_content['href'] = links[tab_id]
+    return tabs
 
-        if preferences:
-            query = f"{query}&preferences={preferences}"
 
-        tab_content['href'] = tab_content['href'].format(
-            query=query,
-            map_query=map_query)
+# Result container classes, mapped to the type of result they contain
+RESULT_CONTAINERS = {
+    GClasses.result_class_a: 'result',
+    'ezO2md': 'result',  # Mobile results
+    'isv-r': 'image'
+}
+
+# Result types for search types where all results are the same kind
+SEARCH_TYPE_RESULTS = {
+    'nws': 'news',
+    'vid': 'video'
+}
 
-        # update if selected tab (default all tab is selected)
-        if tab_content['tbm'] == search_type:
-            tabs['all']['selected'] = False
-            tab_content['selected'] = True
-    return tabs
+START_PARAM = re.compile(r'[?&]start=(\d+)')
+
+# Elements that don't contain any of a result's content
+SKIPPED_ELEMENTS = {'details', 'script', 'style'}
+
+
+def is_external_link(link: Tag) -> bool:
+    return link['href'].startswith(('http://', 'https://'))
+
+
+def walk_result(elem: Tag, in_link: bool = False):
+    """Walks the content of a result once, in document order, skipping
+    collapsed sections and non-text elements
+
+    Args:
+        elem: The element to walk
+        in_link: If the element is within a link
+
+    Yields:
+        tuple: Either a link (Tag) or a text string, and if it is within a
+               link
+    """
+    for child in elem.children:
+        if type(child) is NavigableString:
+            yield child, in_link
+        elif isinstance(child, Tag) and child.name not in SKIPPED_ELEMENTS:
+            if child.name == 'a' and child.has_attr('href'):
+                yield child, in_link
+                yield from walk_result(child, True)
+            else:
+                yield from walk_result(child, in_link)
+
+
+def extract_result(div: Tag, result_type: str, resolve_link=None):
+    """Extracts a result record from a result container
+
+    Args:
+        div: The result container
+        result_type: The type of result the container holds
+        resolve_link: A function to resolve link hrefs to their external
+                      url (or an empty string for internal links). Links are
+                      used as they are if not provided.
+
+    Returns:
+        Result: The extracted result, or None if the container doesn't link
+                to an external page
+
+    """
+    links = []
+    snippet = []
+    for elem, in_link in walk_result(div):
+        if isinstance(elem, Tag):
+            if resolve_link:
+                url = resolve_link(elem['href'])
+            else:
+                url = elem['href'] if is_external_link(elem) else ''
+
+            if url:
+                links.append((elem, url))
+        elif not in_link and any(c.isalnum() for c in elem):
+            # The snippet is all text in the result that isn't part of a
+            # link (skipping separators between links, such as " · ")
+            snippet.append(elem.strip())
+
+    if not links:
+        return None
+
+    main_link, main_url = links[0]
+    title_elem = main_link.find('h3') or div.find('h3')
+    if title_elem:
+        title = title_elem.get_text(' ', strip=True)
+    else:
+        title = main_link.get_text(' ', strip=True) or \
+            (main_link.find('img') or {}).get('alt', '')
+
+    # The display url (breadcrumbs) is the text of the main link that isn't
+    # part of the title
+    display_url = ' '.join(
+        _.strip() for _ in main_link.find_all(string=True)
+        if _.strip()
+        and not (title_elem and any(p is title_elem for p in _.parents)))
+
+    sitelinks = []
+    for link, url in links[1:]:
+        link_title = link.get_text(' ', strip=True)
+        if link_title and url != main_url:
+            sitelinks.append((link_title, url))
+
+    return Result(title=title,
+                  url=main_url,
+                  display_url=display_url,
+                  snippet=' '.join(snippet),
+                  type=result_type,
+                  sitelinks=sitelinks)
+
+
+def extract_results(soup: BeautifulSoup,
+                    search_type: str = '',
+                    start: int = 0,
+                    resolve_link=None) -> ResultPage:
+    """Extracts result records from a results page. This is meant to be run
+    once per page, so that later stages can work from the records instead of
+    scanning the page again.
+
+    Args:
+        soup: The results page (either cleaned, or straight from upstream
+              with a resolve_link function)
+        search_type: The current search_type
+        start: The result offset of the page
+        resolve_link: A function to resolve upstream link hrefs to their
+                      external url (see extract_result)
+
+    Returns:
+        ResultPage: The results, cards and pagination of the page
+
+    """
+    page = ResultPage(start=start)
+
+    # The currency conversion is extracted as a card instead of a result
+    currency_link = soup.find('a', {'href': 'https://g.co/gfd'})
+    skipped = set(map(id, currency_link.parents)) if currency_link else set()
+
+    for div in soup.find_all('div', class_=list(RESULT_CONTAINERS)):
+        classes = div.get('class', [])
+        container = next(_ for _ in classes if _ in RESULT_CONTAINERS)
+
+        # Skip containers within other results (i.e. nested cards)
+        if id(div) in skipped or \
+                div.find_parent('div', class_=list(RESULT_CONTAINERS)):
+            continue
+
+        result_type = RESULT_CONTAINERS[container]
+        if result_type == 'result':
+            result_type = SEARCH_TYPE_RESULTS.get(search_type, result_type)
+
+        result = extract_result(div, result_type, resolve_link)
+        if result:
+            page.results.append(result)
+
+    if currency := get_currency(soup):
+        page.cards.append(Card('currency', currency))
+
+    footer = soup.find('footer') or soup
+    starts = set()
+    for link in footer.find_all('a', href=True):
+        if match := START_PARAM.search(link['href']):
+            starts.add(int(match.group(1)))
+
+    page.next_start = min((_ for _ in starts if _ > start), default=None)
+    page.prev_start = max((_ for _ in starts if _ < start), default=None)
+    if page.prev_start is None and start > 0:
+        # Links back to the first page don't have a start param
+        page.prev_start = 0
+
+    return page
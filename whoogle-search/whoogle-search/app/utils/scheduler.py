@@ -0,0 +1,138 @@
+import sys
+import threading
+import time
+import traceback
+from typing import Callable
+
+
+class ScheduledTask:
+    """A periodic maintenance task, along with the results of its last run.
+
+    Attributes:
+        name: A unique name for the task
+        func: The function to run
+        interval: Seconds between runs of the task
+        next_run: The monotonic time the task is due to run next
+        runs: The number of times the task has been run
+        last_run: The wall clock time of the last run, or None
+        last_duration: The duration in seconds of the last run
+        last_error: The error raised by the last run, or an empty str
+    """
+    __slots__ = ('name', 'func', 'interval', 'next_run', 'runs', 'last_run',
+                 'last_duration', 'last_error')
+
+    def __init__(self, name: str, func: Callable[[], None],
+                 interval: float, delay: float) -> None:
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.next_run = time.monotonic() + delay
+        self.runs = 0
+        self.last_run = None
+        self.last_duration = 0.0
+        self.last_error = ''
+
+
+class Scheduler:
+    """Runs periodic maintenance tasks (update checks, bang refreshes,
+    session cleanup, etc) in a single background thread, so that none of
+    them are ever run as part of handling a request. Tasks should publish
+    their results somewhere for requests to read, rather than being called
+    from requests directly.
+    """
+
+    def __init__(self) -> None:
+        self._tasks = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+    def add_task(self, name: str, func: Callable[[], None],
+                 interval: float, delay: float = 0) -> None:
+        """Registers a task to be run every interval seconds
+
+        Args:
+            name: A unique name for the task (replaces any task with the
+                  same name)
+            func: The function to run, which takes no arguments
+            interval: Seconds between runs of the task
+            delay: Seconds to wait before the first run of the task
+
+        Returns:
+            None
+
+        """
+        with self._lock:
+            self._tasks[name] = ScheduledTask(name, func, interval, delay)
+        self._wakeup.set()
+
+    def remove_task(self, name: str) -> None:
+        with self._lock:
+            self._tasks.pop(name, None)
+
+    def start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='whoogle-scheduler',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped = True
+        self._wakeup.set()
+
+    def run_pending(self) -> None:
+        """Runs all tasks that are currently due"""
+        now = time.monotonic()
+        with self._lock:
+            due = [_ for _ in self._tasks.values() if _.next_run <= now]
+
+        for task in due:
+            start = time.monotonic()
+            task.last_run = time.time()
+            try:
+                task.func()
+                task.last_error = ''
+            except Exception as e:
+                task.last_error = repr(e)
+                print(traceback.format_exc(), file=sys.stderr)
+            finally:
+                task.runs += 1
+                task.last_duration = time.monotonic() - start
+                task.next_run = time.monotonic() + task.interval
+
+    def status(self) -> dict:
+        """Returns the results of the last run of each task
+
+        Returns:
+            dict: The task names mapped to their run count, last run time,
+                  last run duration and last error
+
+        """
+        with self._lock:
+            tasks = list(self._tasks.values())
+
+        return {task.name: {
+            'runs': task.runs,
+            'last_run': task.last_run,
+            'last_duration': task.last_duration,
+            'last_error': task.last_error
+        } for task in tasks}
+
+    def _time_until_next(self) -> float:
+        with self._lock:
+            next_run = min((_.next_run for _ in self._tasks.values()),
+                           default=None)
+        if next_run is None:
+            return None
+        return max(0.0, next_run - time.monotonic())
+
+    def _run(self) -> None:
+        while not self._stopped:
+            self.run_pending()
+            self._wakeup.wait(self._time_until_next())
+            self._wakeup.clear()
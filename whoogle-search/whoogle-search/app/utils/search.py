@@ -1,17 +1,53 @@
 import os
 import re
+from contextlib import contextmanager
+from functools import partial
 from typing import Any
 from app.filter import Filter
-from app.request import gen_query
+from app.request import gen_query, BLOCKED_VERDICTS, VERDICT_OK
+from app.utils.admission import PRIORITY_BACKGROUND, PRIORITY_SEARCH
+from app.utils.backends import BackendBlocked, BackendPool, GoogleBackend
+from app.utils.metrics import stage_duration
+from app.utils.tracing import tracer
 from app.utils.misc import get_proxy_host_url
-from app.utils.results import get_first_link
+from app.utils.page_cache import PageCache
+from app.utils.prefetch import Prefetcher
+from app.models.result import ResultPage
+from app.utils.results import extract_results, get_first_link
 from bs4 import BeautifulSoup as bsoup
 from cryptography.fernet import Fernet, InvalidToken
 from flask import g
+from werkzeug.datastructures import MultiDict
 
 TOR_BANNER = '<hr><h1 style="text-align: center">You are using Tor</h1><hr>'
 CAPTCHA = 'div class="g-recaptcha"'
 
+# Upstream result pages, shared between users, and the prefetcher that
+# fetches next pages into them (both disabled unless configured)
+page_cache = PageCache(enabled=False)
+prefetcher = Prefetcher(page_cache, enabled=False)
+
+# The backends that result pages are fetched from, which only has Google
+# unless secondary backends are configured to hedge with
+backend_pool = BackendPool([GoogleBackend()])
+
+
+class CaptchaError(BackendBlocked):
+    """Raised when the upstream results page is blocked by a captcha"""
+
+
+@contextmanager
+def pipeline_stage(name: str):
+    """Times a stage of the search pipeline for the metrics, and traces it
+    as a span (if the request is traced)
+
+    Args:
+        name: The stage name
+
+    """
+    with stage_duration.time(name), tracer.span(f'search.{name}'):
+        yield
+
 
 def needs_https(url: str) -> bool:
     """Checks if the current instance needs to be upgraded to HTTPS
@@ -33,6 +69,21 @@ def needs_https(url: str) -> bool:
     return (is_heroku and is_http) or (https_only and is_http)
 
 
+def protect_entities(html: str) -> str:
+    """Replaces escaped angle brackets in an upstream page, so that they
+    survive the page being parsed and serialized multiple times while it is
+    rendered
+
+    Args:
+        html: The page html
+
+    Returns:
+        str: The page html, with "&lt;" and "&gt;" replaced
+
+    """
+    return html.replace("&lt;", "andlt;").replace("&gt;", "andgt;")
+
+
 def has_captcha(results: str) -> bool:
     """Checks to see if the search results are blocked by a captcha
 
@@ -46,6 +97,23 @@ def has_captcha(results: str) -> bool:
     return CAPTCHA in results
 
 
+def is_valid_page(page: str) -> bool:
+    """Checks if an upstream page can be cached (i.e. isn't a captcha page),
+    and pauses prefetching if it is blocked
+
+    Args:
+        page: The upstream page html
+
+    Returns:
+        bool: True if the page isn't blocked by a captcha
+
+    """
+    if has_captcha(page):
+        prefetcher.note_captcha()
+        return False
+    return True
+
+
 class Search:
     """Search query preprocessor - used before submitting the query or
     redirecting to another site
@@ -54,11 +122,18 @@ class Search:
         request: the incoming flask request
         config: the current user config settings
         session_key: the flask user fernet key
+        params: search params to use instead of the request's own (used for
+                each query of a batch request)
     """
-    def __init__(self, request, config, session_key, cookies_disabled=False):
+    def __init__(self, request, config, session_key, cookies_disabled=False,
+                 params=None):
         method = request.method
         self.request = request
-        self.request_params = request.args if method == 'GET' else request.form
+        if params is not None:
+            self.request_params = params
+        else:
+            self.request_params = (request.args if method == 'GET'
+                                   else request.form)
         self.user_agent = request.headers.get('User-Agent')
         self.feeling_lucky = False
         self.config = config
@@ -68,6 +143,7 @@ class Search:
         self.cookies_disabled = cookies_disabled
         self.search_type = self.request_params.get(
             'tbm') if 'tbm' in self.request_params else ''
+        self.results = ResultPage()
 
     def __getitem__(self, name) -> Any:
         return getattr(self, name)
@@ -120,12 +196,16 @@ class Search:
                 self.query.lower()) else self.widget
         return self.query
 
-    def generate_response(self) -> str:
+    def generate_response(self):
         """Generates a response for the user's query
 
         Returns:
-            str: A string response to the search query, in the form of a URL
-                 or string representation of HTML content.
+            str | BeautifulSoup: The url to redirect to for "feeling lucky"
+                searches, or the cleaned results page. The page is returned
+                parsed, so that later stages don't need to parse it again.
+
+        Raises:
+            CaptchaError: if the upstream page is blocked by a captcha
 
         """
         mobile = 'Android' in self.user_agent or 'iPhone' in self.user_agent
@@ -152,18 +232,13 @@ class Search:
                       # and self.config.view_image
                       # and not g.user_request.mobile)
 
-        # For image searches, fetch multiple pages to get 100 images
-        if 'tbm=isch' in full_query and 'start=' not in full_query:
-            combined_html = self._fetch_multiple_image_pages(full_query)
-            html_soup = bsoup(combined_html, 'html.parser')
-        else:
-            get_body = g.user_request.send(query=full_query,
-                                           force_mobile=self.config.view_image,
-                                           user_agent=self.user_agent)
+        with pipeline_stage('fetch'):
+            page = self.fetch_page(full_query)
+        if has_captcha(page):
+            raise CaptchaError()
 
-            # Produce cleanable html soup from response
-            get_body_safed = get_body.text.replace("&lt;","andlt;").replace("&gt;","andgt;")
-            html_soup = bsoup(get_body_safed, 'html.parser')
+        with pipeline_stage('parse'):
+            html_soup = bsoup(page, 'html.parser')
 
         # Replace current soup if view_image is active
         # FIXME: Broken since the user agent changes as of 16 Jan 2025
@@ -174,9 +249,21 @@ class Search:
         if g.user_request.tor_valid:
             html_soup.insert(0, bsoup(TOR_BANNER, 'html.parser'))
 
-        formatted_results = content_filter.clean(html_soup)
+        with pipeline_stage('filter'):
+            formatted_results = content_filter.clean(html_soup)
+
+        # Results are extracted once here, for later stages to use
+        start = self.request_params.get('start', '0')
+        with pipeline_stage('extract'):
+            self.results = extract_results(
+                formatted_results,
+                self.search_type,
+                int(start) if start.isdigit() else 0)
+
         if self.feeling_lucky:
-            if lucky_link := get_first_link(formatted_results):
+            lucky_link = self.results.first_link or get_first_link(
+                formatted_results)
+            if lucky_link:
                 return lucky_link
 
             # Fall through to regular search if unable to find link
@@ -194,9 +281,146 @@ class Search:
                 continue
             link['href'] += param_str
 
-        return str(formatted_results)
+        # Only the search tool's time selector is used
+        for st_card in formatted_results.find_all(attrs={'id': 'st-card'}):
+            st_card.decompose()
+
+        return formatted_results
+
+    def generate_results(self) -> ResultPage:
+        """Generates structured results for the user's query, directly from
+        the upstream page. Unlike generate_response, none of the page's
+        presentation is updated (links aren't encrypted, terms aren't
+        highlighted, etc), since only the extracted records are used.
+
+        Records are cached along with the upstream page (if the page cache
+        is enabled), so a cached page is only parsed once for each set of
+        settings that change the records.
+
+        Returns:
+            ResultPage: The results extracted from the upstream page
+
+        Raises:
+            CaptchaError: if the upstream page is blocked by a captcha
+
+        """
+        self.full_query = gen_query(self.query,
+                                    self.request_params,
+                                    self.config)
+
+        with pipeline_stage('fetch'):
+            page = self.fetch_page(self.full_query, protect=False)
+        if has_captcha(page):
+            raise CaptchaError()
+
+        start = self.request_params.get('start', '0')
+        start = int(start) if start.isdigit() else 0
+        variant = (start, self.config.alts, self.config.block_title,
+                   self.config.block_url)
+        self.results = page_cache.get_records(
+            self._cache_key(g.user_request, self.full_query),
+            page,
+            variant,
+            partial(self._extract_records, page, start))
+        return self.results
+
+    def _extract_records(self, page: str, start: int) -> ResultPage:
+        content_filter = Filter(self.session_key,
+                                config=self.config,
+                                query=self.query)
+        with pipeline_stage('parse'):
+            html_soup = bsoup(page, 'html.parser')
+        with pipeline_stage('filter'):
+            html_soup = content_filter.prune(html_soup)
+        with pipeline_stage('extract'):
+            return extract_results(html_soup,
+                                   self.search_type,
+                                   start,
+                                   resolve_link=content_filter.resolve_link)
+
+    def fetch_page(self, full_query: str, protect: bool = True) -> str:
+        """Fetches the upstream results page for a query, or gets it from
+        the page cache
+
+        Args:
+            full_query: The full query string to send upstream
+            protect: Protect escaped entities in the page from being
+                     unescaped when the page is rendered
 
-    def _fetch_multiple_image_pages(self, base_query):
+        Returns:
+            str: The upstream page html
+
+        """
+        # The user's request handler is passed along explicitly, so that
+        # the page can also be refreshed outside of this request
+        user_request = g.user_request
+        page = page_cache.get_page(
+            self._cache_key(user_request, full_query),
+            self.search_type,
+            partial(self._fetch_from_backends, user_request, full_query),
+            is_valid_page,
+            refresh=partial(self._fetch_from_backends, user_request,
+                            full_query, PRIORITY_BACKGROUND))
+        return protect_entities(page) if protect else page
+
+    def prefetch_next_page(self) -> bool:
+        """Fetches the next page of results into the page cache in the
+        background, since it's likely to be requested next
+
+        Returns:
+            bool: True if the next page is being prefetched
+
+        """
+        if not prefetcher.enabled or self.results.next_start is None:
+            return False
+
+        params = MultiDict(self.request_params)
+        params['start'] = str(self.results.next_start)
+        full_query = gen_query(self.query, params, self.config)
+
+        user_request = g.user_request
+        return prefetcher.prefetch(
+            self._cache_key(user_request, full_query),
+            self.search_type,
+            partial(self._fetch_from_backends, user_request, full_query,
+                    PRIORITY_BACKGROUND),
+            is_valid_page)
+
+    def _cache_key(self, user_request, full_query: str) -> tuple:
+        agent_key = user_request.get_user_agent(self.config.view_image,
+                                                self.user_agent)[1]
+        return full_query, agent_key, user_request.lang_interface
+
+    def _fetch_from_backends(self, user_request, full_query: str,
+                             priority: int = PRIORITY_SEARCH) -> str:
+        # Only searches that a user is waiting on are hedged, since hedging
+        # adds upstream requests
+        return backend_pool.fetch(
+            lambda backend: backend.fetch(self, user_request, full_query,
+                                          priority),
+            is_valid_page,
+            hedge=priority == PRIORITY_SEARCH)
+
+    def _fetch_upstream(self, user_request, full_query: str,
+                        priority: int = PRIORITY_SEARCH) -> str:
+        # For image searches, fetch multiple pages to get 100 images
+        if 'tbm=isch' in full_query and 'start=' not in full_query:
+            return self._fetch_multiple_image_pages(user_request, full_query,
+                                                    priority)
+
+        response = user_request.send(query=full_query,
+                                     force_mobile=self.config.view_image,
+                                     user_agent=self.user_agent,
+                                     priority=priority)
+
+        # Blocked pages are thrown away before their body is even decoded
+        if getattr(response, 'verdict', VERDICT_OK) in BLOCKED_VERDICTS:
+            prefetcher.note_captcha()
+            raise CaptchaError()
+        return response.text
+
+    def _fetch_multiple_image_pages(self, user_request, base_query,
+                                    priority=PRIORITY_SEARCH):
         """Fetch multiple pages of image results and combine them"""
         all_image_results = []
         
@@ -206,13 +430,12 @@ class Search:
             page_query = base_query + f"&start={start_index}"
             
             try:
-                page_response = g.user_request.send(query=page_query,
-                                                   force_mobile=self.config.view_image,
-                                                   user_agent=self.user_agent)
+                page_response = user_request.send(query=page_query,
+                                                  force_mobile=self.config.view_image,
+                                                  user_agent=self.user_agent,
+                                                  priority=priority)
                 
-                # Clean the response
-                page_body_safed = page_response.text.replace("&lt;","andlt;").replace("&gt;","andgt;")
-                page_soup = bsoup(page_body_safed, 'html.parser')
+                page_soup = bsoup(page_response.text, 'html.parser')
                 
                 # Extract image results from this page
                 image_containers = page_soup.find_all('div', class_='isv-r')
@@ -229,11 +452,11 @@ class Search:
         # Create a new soup with all combined results
         if all_image_results:
             # Get the base structure from the first page
-            first_page_response = g.user_request.send(query=base_query,
-                                                     force_mobile=self.config.view_image,
-                                                     user_agent=self.user_agent)
-            first_page_body = first_page_response.text.replace("&lt;","andlt;").replace("&gt;","andgt;")
-            combined_soup = bsoup(first_page_body, 'html.parser')
+            first_page_response = user_request.send(query=base_query,
+                                                    force_mobile=self.config.view_image,
+                                                    user_agent=self.user_agent,
+                                                    priority=priority)
+            combined_soup = bsoup(first_page_response.text, 'html.parser')
             
             # Find the main image results container
             main_container = combined_soup.find('div', {'id': 'islmp'})
@@ -249,8 +472,9 @@ class Search:
             return str(combined_soup)
         else:
             # Fallback to single page if something went wrong
-            response = g.user_request.send(query=base_query,
-                                          force_mobile=self.config.view_image,
-                                          user_agent=self.user_agent)
-            return response.text.replace("&lt;","andlt;").replace("&gt;","andgt;")
+            response = user_request.send(query=base_query,
+                                         force_mobile=self.config.view_image,
+                                         user_agent=self.user_agent,
+                                         priority=priority)
+            return response.text
 
@@ -1,5 +1,7 @@
 from cryptography.fernet import Fernet
 from flask import current_app as app
+import os
+import pickle
 
 REQUIRED_SESSION_VALUES = ['uuid', 'config', 'key', 'auth']
 
@@ -37,3 +39,44 @@ def valid_user_session(session: dict) -> bool:
             return False
 
     return True
+
+
+def clear_invalid_sessions(session_dir: str, max_size: int) -> None:
+    """Removes invalid session files from the session directory
+
+    Args:
+        session_dir: The directory containing session files
+        max_size: The max size of a session file, files larger than this
+                  are ignored
+
+    Returns:
+        None
+
+    """
+    invalid_sessions = []
+    for user_session in os.listdir(session_dir):
+        file_path = os.path.join(session_dir, user_session)
+
+        try:
+            # Ignore files that are larger than the max session file size
+            if os.path.getsize(file_path) > max_size:
+                continue
+
+            with open(file_path, 'rb') as session_file:
+                _ = pickle.load(session_file)
+                data = pickle.load(session_file)
+                if isinstance(data, dict) and 'valid' in data:
+                    continue
+                invalid_sessions.append(file_path)
+        except Exception:
+            # Broad exception handling here due to how instances installed
+            # with pip seem to have issues storing unrelated files in the
+            # same directory as sessions
+            pass
+
+    for invalid_session in invalid_sessions:
+        try:
+            os.remove(invalid_session)
+        except FileNotFoundError:
+            # Don't throw error if the invalid session has been removed
+            pass
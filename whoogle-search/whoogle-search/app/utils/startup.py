@@ -0,0 +1,73 @@
+from contextlib import contextmanager
+import importlib
+import threading
+import time
+
+# The time that the app started being imported
+IMPORT_START = time.perf_counter()
+
+# Modules that are slow to import, but aren't needed to serve the first
+# request. These are imported in the background after startup.
+DEFERRED_IMPORTS = ['cssutils', 'stem.control']
+
+
+class StartupReport:
+    """Records how long each phase of app initialization takes.
+
+    Attributes:
+        start: The perf_counter time that initialization started at
+        phases: A list of (phase name, seconds) tuples, in order
+    """
+
+    def __init__(self, start: float = None) -> None:
+        self.start = time.perf_counter() if start is None else start
+        self.phases = []
+        self._mark = self.start
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._mark = time.perf_counter()
+            self.phases.append((name, self._mark - start))
+
+    def mark(self, name: str) -> None:
+        """Records the time since the end of the last phase as a new phase
+        (used for phases that can't be wrapped, such as module imports)
+        """
+        now = time.perf_counter()
+        self.phases.append((name, now - self._mark))
+        self._mark = now
+
+    @property
+    def total(self) -> float:
+        return self._mark - self.start
+
+    def as_dict(self) -> dict:
+        return {name: round(seconds * 1000, 2)
+                for name, seconds in self.phases}
+
+    def format(self) -> str:
+        lines = ['* Startup timing (ms):']
+        for name, seconds in self.phases:
+            lines.append(f'    {name:<16} {seconds * 1000:8.1f}')
+        lines.append(f'    {"total":<16} {self.total * 1000:8.1f}')
+        return '\n'.join(lines)
+
+
+def import_deferred_modules() -> None:
+    for module in DEFERRED_IMPORTS:
+        importlib.import_module(module)
+
+
+def start_deferred_imports() -> threading.Thread:
+    """Imports DEFERRED_IMPORTS in a background thread, so that they are
+    usually loaded by the time they're first needed by a request.
+    """
+    thread = threading.Thread(target=import_deferred_modules,
+                              name='deferred-imports',
+                              daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,260 @@
+from contextlib import nullcontext
+from contextvars import ContextVar
+from functools import wraps
+import json
+import os
+import random
+import threading
+import time
+from typing import Callable
+
+# Requests with this header set to "1" are always traced (when tracing is
+# enabled), and traced responses include their trace id
+TRACE_HEADER = 'X-Whoogle-Trace'
+TRACE_ID_HEADER = 'X-Whoogle-Trace-Id'
+
+# Span kinds and status codes, as numbered by OTLP
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+# The span that new spans are created under, for the current thread (or the
+# context copied into a worker thread)
+current_span = ContextVar('current_span', default=None)
+
+_NOOP = nullcontext()
+
+
+def otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    elif isinstance(value, int):
+        return {'intValue': str(value)}
+    elif isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def otlp_attributes(attributes: dict) -> list:
+    return [{'key': key, 'value': otlp_value(value)}
+            for key, value in attributes.items()]
+
+
+class Trace:
+    """The spans of one traced request, which are exported together once the
+    root span ends. Spans that end after their root (i.e. slower hedged
+    requests) aren't exported.
+
+    Attributes:
+        trace_id: The trace id, as 32 hex digits
+        spans: The spans that have ended
+        export: Exports the spans once the root span ends
+    """
+    __slots__ = ('trace_id', 'spans', 'export')
+
+    def __init__(self, export: Callable[[list], None]) -> None:
+        self.trace_id = os.urandom(16).hex()
+        self.spans = []
+        self.export = export
+
+
+class Span:
+    """A timed operation within a trace, with attributes describing it.
+
+    Attributes:
+        name: The span name
+        trace: The trace that the span belongs to
+        span_id: The span id, as 16 hex digits
+        parent: The parent span, or None for the root span
+        kind: One of the SPAN_KIND_* values
+        attributes: The span's attributes
+    """
+    __slots__ = ('name', 'trace', 'span_id', 'parent', 'kind', 'attributes',
+                 'events', 'status', 'start_ns', 'end_ns', '_token')
+
+    def __init__(self, name: str, trace: Trace, parent=None,
+                 kind: int = SPAN_KIND_INTERNAL,
+                 attributes: dict = None) -> None:
+        self.name = name
+        self.trace = trace
+        self.span_id = os.urandom(8).hex()
+        self.parent = parent
+        self.kind = kind
+        self.attributes = attributes or {}
+        self.events = []
+        self.status = None
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self._token = current_span.set(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc is not None:
+            self.record_error(exc)
+        self.end()
+
+    def set_attributes(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def record_error(self, error: BaseException) -> None:
+        self.status = (STATUS_ERROR, str(error))
+        self.events.append({
+            'timeUnixNano': str(time.time_ns()),
+            'name': 'exception',
+            'attributes': otlp_attributes({
+                'exception.type': type(error).__name__,
+                'exception.message': str(error)
+            })
+        })
+
+    def end(self) -> None:
+        """Ends the span, making its parent the current span again"""
+        if self.end_ns is not None:
+            return
+        self.end_ns = time.time_ns()
+        try:
+            current_span.reset(self._token)
+        except ValueError:
+            # Ended in a different context than it was started in
+            current_span.set(self.parent)
+        self.trace.spans.append(self)
+        if self.parent is None:
+            try:
+                self.trace.export(list(self.trace.spans))
+            except OSError:
+                # Traces are best effort, and never fail the request
+                pass
+
+    def to_otlp(self) -> dict:
+        span = {
+            'traceId': self.trace.trace_id,
+            'spanId': self.span_id,
+            'parentSpanId': self.parent.span_id if self.parent else '',
+            'name': self.name,
+            'kind': self.kind,
+            'startTimeUnixNano': str(self.start_ns),
+            'endTimeUnixNano': str(self.end_ns),
+            'attributes': otlp_attributes(self.attributes),
+            'events': self.events
+        }
+        if self.status:
+            span['status'] = {'code': self.status[0],
+                              'message': self.status[1]}
+        return span
+
+
+class Tracer:
+    """Records traces of sampled requests, and writes each one as a line of
+    JSON to the trace file, in the shape of an OTLP/JSON export request (so
+    that the lines can be loaded into trace viewers without a collector).
+
+    Spans are only created within a sampled trace. Everywhere else, span()
+    returns a shared no-op context, so instrumented code costs next to
+    nothing while a request isn't traced.
+
+    Attributes:
+        enabled: If False, no requests are traced
+        path: The trace file
+        sample_rate: The fraction of requests to trace (0 to 1)
+        max_bytes: The trace file is rotated to "<path>.1" once it's larger
+                   than this
+        resource: Attributes of the traced service
+    """
+
+    def __init__(self, path: str = '', sample_rate: float = 0.0,
+                 max_bytes: int = 50 * 1024 * 1024,
+                 enabled: bool = False) -> None:
+        self.enabled = enabled
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.resource = {'service.name': 'whoogle'}
+        self._lock = threading.Lock()
+
+    def start_trace(self, name: str, force: bool = False,
+                    **attributes):
+        """Starts a trace with a root span, if the trace is sampled
+
+        Args:
+            name: The name of the root span
+            force: Trace regardless of the sample rate
+            attributes: Attributes of the root span
+
+        Returns:
+            Span: The root span, or None if the trace isn't sampled
+
+        """
+        if not self.enabled or not (
+                force or random.random() < self.sample_rate):
+            return None
+        return Span(name, Trace(self.export), kind=SPAN_KIND_SERVER,
+                    attributes=attributes)
+
+    def span(self, name: str, kind: int = SPAN_KIND_INTERNAL,
+             **attributes):
+        """Starts a span under the current span, to be used as a context
+        manager
+
+        Args:
+            name: The span name
+            kind: One of the SPAN_KIND_* values
+            attributes: Attributes of the span
+
+        Returns:
+            The span, or a no-op context if there's no trace to add it to
+
+        """
+        parent = current_span.get()
+        if parent is None:
+            return _NOOP
+        return Span(name, parent.trace, parent, kind, attributes)
+
+    def wrap(self, name: str, kind: int = SPAN_KIND_INTERNAL) -> Callable:
+        """Decorates a function to run it in a span"""
+        def decorator(func: Callable) -> Callable:
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if current_span.get() is None:
+                    return func(*args, **kwargs)
+                with self.span(name, kind):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def annotate(**attributes) -> None:
+        """Adds attributes to the current span, if there is one"""
+        span = current_span.get()
+        if span is not None:
+            span.set_attributes(**attributes)
+
+    def export(self, spans: list) -> None:
+        """Writes the spans of a trace to the trace file
+
+        Args:
+            spans: The spans of the trace
+
+        """
+        line = json.dumps({'resourceSpans': [{
+            'resource': {'attributes': otlp_attributes(self.resource)},
+            'scopeSpans': [{
+                'scope': {'name': 'whoogle'},
+                'spans': [_.to_otlp() for _ in spans]
+            }]
+        }]}, separators=(',', ':'))
+
+        with self._lock:
+            try:
+                if os.path.getsize(self.path) > self.max_bytes:
+                    os.replace(self.path, self.path + '.1')
+            except OSError:
+                pass
+            with open(self.path, 'a') as trace_file:
+                trace_file.write(line + '\n')
+
+
+tracer = Tracer()
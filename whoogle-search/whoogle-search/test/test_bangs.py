@@ -0,0 +1,139 @@
+import json
+import os
+
+from app.utils import bangs
+
+
+def write_bangs(bang_dir, name, operators):
+    bang_file = bang_dir / name
+    bang_file.write_text(json.dumps({
+        op: {'url': f'https://{op[1:]}.com/search?q={{}}',
+             'suggestion': f'{op} ({op[1:]})'}
+        for op in operators
+    }))
+    return bang_file
+
+
+def test_bang_index(tmp_path, monkeypatch):
+    monkeypatch.setattr(bangs, 'bangs_index', bangs.BangIndex({}))
+    ddg_file = write_bangs(tmp_path, 'bangs.json',
+                           ['!gh', '!g', '!gi', '!ghr', '!w'])
+    write_bangs(tmp_path, '01-custom.json', ['!gx'])
+    bangs.load_all_bangs(str(ddg_file))
+
+    assert len(bangs.bangs_index) == 6
+    assert bangs.suggest_bang('!gh') == ['!gh (gh)', '!ghr (ghr)']
+    assert bangs.suggest_bang('!g', limit=2) == ['!g (g)', '!gh (gh)']
+    assert bangs.suggest_bang('!z') == []
+
+    assert bangs.resolve_bang('!GX test').startswith('https://gx.com')
+    assert bangs.resolve_bang('test !w') == 'https://w.com/search?q=test'
+    assert bangs.resolve_bang('!nope test') == ''
+
+
+def test_bang_store(tmp_path, monkeypatch):
+    monkeypatch.setattr(bangs, 'bangs_index', bangs.BangIndex({}))
+    ddg_file = write_bangs(tmp_path, 'bangs.json', ['!gh', '!w'])
+    bangs.load_all_bangs(str(ddg_file))
+
+    store_file = tmp_path / bangs.BANG_STORE_FILE
+    assert isinstance(bangs.bangs_index, bangs.BangStore)
+    assert store_file.exists()
+
+    # The compiled store is reused as long as the sources are unchanged
+    monkeypatch.setattr(bangs, 'bangs_index', bangs.BangIndex({}))
+    monkeypatch.setattr(bangs.json, 'load', None)
+    bangs.load_all_bangs(str(ddg_file))
+    assert bangs.bangs_index.get('!w')['url'] == 'https://w.com/search?q={}'
+    assert '!gh' in bangs.bangs_index and '!g' not in bangs.bangs_index
+    monkeypatch.undo()
+
+    # ...and rebuilt once they change
+    monkeypatch.setattr(bangs, 'bangs_index', bangs.BangIndex({}))
+    write_bangs(tmp_path, '01-custom.json', ['!gx'])
+    bangs.load_all_bangs(str(ddg_file))
+    assert bangs.suggest_bang('!g') == ['!gh (gh)', '!gx (gx)']
+
+
+def test_bang_refresher(tmp_path, monkeypatch):
+    monkeypatch.setattr(bangs, 'bangs_index', bangs.BangIndex({}))
+    monkeypatch.setattr(bangs, 'MIN_DDG_BANGS', 2)
+    ddg_file = tmp_path / 'bangs.json'
+    ddg_file.write_text('{}')
+    write_bangs(tmp_path, '00-whoogle.json', ['!i'])
+    bangs.load_all_bangs(str(ddg_file))
+
+    # Custom bangs are available while the DDG list is downloading
+    assert bangs.suggest_bang('!') == ['!i (i)']
+
+    monkeypatch.setattr(bangs, 'fetch_ddg_bangs', lambda: {})
+    monkeypatch.setattr(bangs.requests, 'get', None)
+    refresher = bangs.BangRefresher(str(ddg_file), refresh_interval=0)
+    assert refresher.needs_download()
+
+    # Invalid downloads are discarded, and retried later
+    def invalid_list():
+        raise ValueError('Only 1 valid DDG bangs found')
+    monkeypatch.setattr(bangs, 'fetch_ddg_bangs', invalid_list)
+    refresher.check()
+    assert ddg_file.read_text() == '{}'
+    assert not refresher.needs_download()
+
+    refresher._next_download = 0
+    monkeypatch.setattr(bangs, 'fetch_ddg_bangs', lambda: {
+        '!gh': {'url': 'https://github.com/search?q={}',
+                'suggestion': '!gh (GitHub)'},
+        '!w': {'url': 'https://wikipedia.org/?q={}',
+               'suggestion': '!w (Wikipedia)'}})
+    refresher.check()
+    assert bangs.resolve_bang('!gh whoogle').startswith('https://github.com')
+    assert not refresher.needs_download()
+    assert not refresher.files_changed()
+
+    # Changes to custom bang files are picked up without a restart
+    write_bangs(tmp_path, '01-custom.json', ['!gx'])
+    assert refresher.files_changed()
+    refresher.check()
+    assert '!gx' in bangs.bangs_index
+
+
+def test_truncated_bang_store(tmp_path, monkeypatch):
+    monkeypatch.setattr(bangs, 'bangs_index', bangs.BangIndex({}))
+    ddg_file = write_bangs(tmp_path, 'bangs.json', ['!gh', '!w'])
+    bangs.load_all_bangs(str(ddg_file))
+
+    store_file = tmp_path / bangs.BANG_STORE_FILE
+    store = store_file.read_bytes()
+    for size in (0, 6, 20, 40, len(store) - 1):
+        store_file.write_bytes(store[:size])
+        try:
+            bangs.BangStore(str(store_file))
+            assert False, size
+        except ValueError:
+            pass
+
+        # Truncated stores are rebuilt from the bang files
+        monkeypatch.setattr(bangs, 'bangs_index', bangs.BangIndex({}))
+        bangs.load_all_bangs(str(ddg_file))
+        assert bangs.bangs_index.get('!w')['url'] == \
+            'https://w.com/search?q={}'
+        assert store_file.read_bytes() == store
+
+
+def test_partial_ddg_bangs(tmp_path, monkeypatch):
+    monkeypatch.setattr(bangs, 'bangs_index', bangs.BangIndex({}))
+    ddg_file = tmp_path / 'bangs.json'
+    ddg_file.write_text('{"!gh": {"url": ')
+    write_bangs(tmp_path, '00-whoogle.json', ['!i'])
+    bangs.load_all_bangs(str(ddg_file))
+    assert '!i' in bangs.bangs_index
+
+    # A partly written DDG bangs file isn't reloaded until it changes
+    refresher = bangs.BangRefresher(str(ddg_file), refresh_interval=0)
+    assert not refresher.files_changed()
+
+    write_bangs(tmp_path, 'bangs.json', ['!gh'])
+    os.utime(ddg_file, ns=(0, 0))
+    assert refresher.files_changed()
+    refresher.check()
+    assert '!gh' in bangs.bangs_index
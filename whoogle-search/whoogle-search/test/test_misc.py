@@ -1,8 +1,39 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import gzip
+import json
+import os
+import threading
+import time
+import zlib
+
+from bs4 import BeautifulSoup
 from cryptography.fernet import Fernet
 
 from app import app
+from app.filter import Filter
+from app.models.config import Config, decode_preferences, \
+    encode_preferences, get_config_defaults
 from app.models.endpoint import Endpoint
+from app.request import Request, classify_response, VERDICT_BLOCKED, \
+    VERDICT_CAPTCHA, VERDICT_ERROR, VERDICT_OK
+from requests.models import Response
+from app.utils.coalesce import SingleFlight, normalize_url
+from app.utils.admission import AdmissionError, EgressLimiter, \
+    PRIORITY_BACKGROUND, PRIORITY_ELEMENT, PRIORITY_SEARCH, UpstreamScheduler
+from app.utils.batch import run_batch
+from app.utils.backends import BackendBlocked, BackendPool, SearchBackend
+from app.utils.assets import build_cache_busting_map, load_manifest
+from app.utils.compression import CompressionMiddleware
+from app.utils.metrics import Registry, registry as metrics_registry
+from app.utils.tracing import Tracer, STATUS_ERROR
+from app.utils.page_cache import CacheWindow, PageCache, parse_cache_windows
+from app.utils.scheduler import Scheduler
+from app.utils.misc import route_upstream
 from app.utils.session import generate_key, valid_user_session
+from app.tools.bench import compare as compare_benchmarks
+from app.tools.loadgen import compare, parse_metrics, parse_mix, summarize
+from app.tools.corpus import DEFAULT_QUERY, TABS, load_corpus
 
 JAPAN_PREFS = 'uG7IBICwK7FgMJNpUawp2tKDb1Omuv_euy-cJHVZ' \
   + 'BSydthgwxRFIHxiVA8qUGavKaDXyiM5uNuPIjKbEAW-zB_vzNXWVaafFhW7k2' \
@@ -68,3 +99,653 @@ def test_prefs_url(client):
     assert rv._status_code == 200
     assert b'ja.wikipedia.org' in rv.data
 
+
+def test_config_overlay():
+    base = Config()
+    user = Config(**{'country': 'countryJP', 'dark': True})
+    user.from_params({'lang_search': 'lang_ja', 'unsafe': 'value'})
+
+    # Overrides only apply to the config they were set on
+    assert user.country == 'countryJP'
+    assert user.lang_search == 'lang_ja'
+    assert base.country != 'countryJP'
+    assert 'unsafe' not in user
+
+    # Bools that weren't passed through a custom config are disabled
+    assert not user.safe
+
+    assert user.as_dict()['country'] == 'countryJP'
+    assert get_config_defaults() is get_config_defaults()
+
+
+def test_preferences_codec():
+    preferences_json = json.dumps({'country': 'countryJP', 'dark': True})
+
+    # Unencrypted tokens round trip, and repeated calls are cache hits
+    token = encode_preferences(preferences_json, '')
+    hits = encode_preferences.cache_info().hits
+    assert encode_preferences(preferences_json, '') == token
+    assert encode_preferences.cache_info().hits == hits + 1
+
+    assert decode_preferences('u' + token, '') == preferences_json.encode()
+    hits = decode_preferences.cache_info().hits
+    assert decode_preferences('u' + token, '') == preferences_json.encode()
+    assert decode_preferences.cache_info().hits == hits + 1
+
+    # Encrypted tokens decode through the cache with their own key only
+    config = Config(**{'country': 'countryJP', 'dark': True,
+                       'preferences_encrypted': True,
+                       'preferences_key': 'secret'})
+    encrypted = config.preferences
+    assert encrypted.startswith('e') and encrypted != 'e' + token
+    for _ in range(2):
+        decoded = config._decode_preferences(encrypted)
+        assert decoded['country'] == 'countryJP' and decoded['dark']
+    assert decode_preferences(encrypted, 'other') == b''
+
+
+def test_shared_batch_pool():
+    executor = ThreadPoolExecutor(max_workers=2)
+    lock = threading.Lock()
+    running, peak, ran = [0], [0], []
+
+    def task(idx):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.01)
+        with lock:
+            running[0] -= 1
+            ran.append(idx)
+        return idx
+
+    # Concurrent batches share the pool's threads, instead of each running
+    # their full concurrency
+    results = []
+
+    def consume():
+        batch = run_batch([partial(task, _) for _ in range(6)], executor, 4)
+        results.append(sorted(batch))
+
+    consumers = [threading.Thread(target=consume) for _ in range(3)]
+    for thread in consumers:
+        thread.start()
+    for thread in consumers:
+        thread.join()
+    assert results == [[(_, _) for _ in range(6)]] * 3
+    assert peak[0] <= 2
+
+    # Only a batch's own concurrency is submitted at once, and tasks that
+    # haven't started are cancelled when the batch is closed
+    ran.clear()
+    batch = run_batch([partial(task, _) for _ in range(10)], executor, 2)
+    next(batch)
+    batch.close()
+    executor.shutdown(wait=True)
+    assert len(ran) <= 2
+
+
+def test_scheduler():
+    scheduler = Scheduler()
+    runs = []
+
+    def failing_task():
+        raise RuntimeError('failed')
+
+    scheduler.add_task('task', lambda: runs.append(1), interval=60)
+    scheduler.add_task('later', lambda: runs.append(2), interval=60, delay=60)
+    scheduler.add_task('failing', failing_task, interval=60)
+
+    scheduler.run_pending()
+    scheduler.run_pending()
+    assert runs == [1]
+
+    status = scheduler.status()
+    assert status['task']['runs'] == 1
+    assert status['later']['runs'] == 0
+    assert 'failed' in status['failing']['last_error']
+
+
+def test_cache_busting_manifest(tmp_path, monkeypatch):
+    static_folder = tmp_path / 'static'
+    build_folder = static_folder / 'build'
+    (static_folder / 'css').mkdir(parents=True)
+    build_folder.mkdir()
+    (static_folder / 'css' / 'main.css').write_text('body {}')
+
+    args = (str(static_folder), str(build_folder), str(tmp_path), ['css'])
+    cb_map = build_cache_busting_map(*args)
+    assert cb_map['main.css'].startswith('static/build/main.')
+    assert os.path.islink(os.path.join(tmp_path, cb_map['main.css']))
+    assert 'css/main.css' in load_manifest(str(build_folder))
+
+    # Unchanged files aren't hashed again
+    def fail_hash(*_):
+        raise AssertionError('file was hashed again')
+
+    monkeypatch.setattr('app.utils.assets.gen_file_hash', fail_hash)
+    assert build_cache_busting_map(*args) == cb_map
+
+
+def test_streamed_compression():
+    chunks = [b'<p>result</p>' * 100 for _ in range(5)]
+
+    def streaming_app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/html')])
+        yield from chunks
+
+    middleware = CompressionMiddleware(streaming_app, min_size=1024)
+    headers = {}
+
+    def start_response(status, response_headers, exc_info=None):
+        headers.update(response_headers)
+
+    body = list(middleware({'HTTP_ACCEPT_ENCODING': 'gzip'}, start_response))
+    assert headers['Content-Encoding'] == 'gzip'
+    assert 'Content-Length' not in headers
+
+    # Each chunk is flushed as it arrives, rather than buffered
+    assert len(body) > 2
+    assert gzip.decompress(b''.join(body)) == b''.join(chunks)
+
+    # Small streamed lines aren't held back until the minimum size
+    def ndjson_app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'application/x-ndjson')])
+        yield b'{"query": "first"}\n'
+        assert False, 'the first line was held back'
+
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    body = iter(CompressionMiddleware(ndjson_app, min_size=1024)(
+        {'HTTP_ACCEPT_ENCODING': 'gzip'}, start_response))
+    assert decompressor.decompress(next(body)) == b'{"query": "first"}\n'
+
+    # Bytes passed to the write callable are sent ahead of the body
+    def writing_app(environ, start_response):
+        write = start_response('200 OK', [('Content-Type', 'text/html')])
+        write(chunks[0])
+        return chunks[1:]
+
+    body = list(CompressionMiddleware(writing_app)(
+        {'HTTP_ACCEPT_ENCODING': 'gzip'}, start_response))
+    assert gzip.decompress(b''.join(body)) == b''.join(chunks)
+
+    # Excluded paths are passed through unchanged
+    middleware.exclude_paths = ('/element',)
+    body = list(middleware({'HTTP_ACCEPT_ENCODING': 'gzip',
+                            'PATH_INFO': '/element'}, start_response))
+    assert b''.join(body) == b''.join(chunks)
+
+
+def test_single_flight():
+    flights = SingleFlight(timeout=5)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow_call():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'result'
+
+    results = []
+    leader = threading.Thread(
+        target=lambda: results.append(flights.do('key', slow_call)))
+    leader.start()
+    started.wait(5)
+
+    duplicates = [threading.Thread(
+        target=lambda: results.append(flights.do('key', slow_call)))
+        for _ in range(3)]
+    for thread in duplicates:
+        thread.start()
+    while flights._flights['key'].waiters < 3:
+        pass
+    release.set()
+    for thread in [leader] + duplicates:
+        thread.join()
+
+    assert results == ['result'] * 4 and len(calls) == 1
+    assert flights.stats() == {'leaders': 1, 'coalesced': 3, 'timeouts': 0,
+                               'in_flight': 0}
+
+    # Duplicates stop waiting after the timeout, and make the call themselves
+    flights.timeout = 0
+    release.clear()
+    leader = threading.Thread(target=flights.do, args=('key', slow_call))
+    started.clear()
+    leader.start()
+    started.wait(5)
+    assert flights.do('key', lambda: 'own result') == 'own result'
+    release.set()
+    leader.join()
+    assert flights.timeouts == 1
+
+    assert normalize_url('HTTPS://Example.com/search?q=a&b=1') == \
+        normalize_url('https://example.com/search?b=1&q=a')
+
+
+def test_coalesced_upstream_requests(monkeypatch):
+    flights = SingleFlight(timeout=5)
+    monkeypatch.setattr('app.request.upstream_flights', flights)
+    calls = []
+    release = threading.Event()
+
+    def get(url, **kwargs):
+        calls.append(url)
+        release.wait(5)
+        response = Response()
+        response.status_code = 200
+        response._content = b'results'
+        return response
+
+    monkeypatch.setattr('app.request.requests.get', get)
+
+    # Each user has a different (randomly generated) user agent
+    with app.app_context():
+        users = [Request('Mozilla/5.0', 'http://localhost:5000',
+                         config=Config(**{})) for _ in range(4)]
+    results = []
+    threads = [threading.Thread(
+        target=lambda u=user: results.append(u.send(query='whoogle')))
+        for user in users]
+    for thread in threads:
+        thread.start()
+    while not flights._flights or \
+            next(iter(flights._flights.values())).waiters < 3:
+        pass
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1 and len(results) == 4
+    assert all(_ is results[0] for _ in results)
+
+
+def test_page_cache():
+    cache = PageCache(windows={'all': CacheWindow(60, 600, 3600)},
+                      refresh_workers=1)
+    pages = iter(['page 1', 'page 2', 'captcha', 'page 3'])
+
+    def fetch():
+        page = next(pages)
+        if page == 'error':
+            raise ConnectionError()
+        return page
+
+    def is_valid(page):
+        return page != 'captcha'
+
+    def get_page():
+        return cache.get_page('key', '', fetch, is_valid)
+
+    def age_entry(age):
+        cache._entries['key'].stored_at -= age
+
+    # Fresh pages are served from the cache
+    assert get_page() == 'page 1'
+    assert get_page() == 'page 1'
+
+    # Stale pages are served while they're refreshed in the background
+    age_entry(120)
+    assert get_page() == 'page 1'
+    cache._refresher.submit(lambda: None).result()
+    assert get_page() == 'page 2'
+
+    # Records are extracted once per page and variant, and a refreshed page
+    # gets its own records
+    extracted = []
+
+    def get_records(variant=''):
+        page = get_page()
+        return cache.get_records('key', page, variant,
+                                 lambda: extracted.append(page) or page)
+
+    assert get_records() == get_records() == 'page 2'
+    assert get_records('other') == 'page 2'
+    assert extracted == ['page 2', 'page 2']
+
+    # Old pages are refetched, unless upstream is blocked by a captcha
+    age_entry(1200)
+    assert get_page() == 'page 2'
+    assert get_records() == 'page 3'
+    assert extracted == ['page 2', 'page 2', 'page 3']
+
+    # Pages past the error window aren't served
+    age_entry(7200)
+    pages = iter(['error'])
+    try:
+        get_page()
+        assert False
+    except ConnectionError:
+        pass
+    assert cache.sweep() == 1
+
+    assert cache.stats() == {'entries': 0, 'hits': 5, 'stale_hits': 1,
+                             'error_hits': 1, 'misses': 4, 'refreshes': 1,
+                             'prefetch_hits': 0, 'record_hits': 1,
+                             'record_misses': 3}
+
+    windows = parse_cache_windows('all=10:20:30,nws=5')
+    assert windows['all'].error == 30 and windows['nws'].stale == 5
+    assert windows['isch'].fresh == 300
+
+
+def test_egress_limiter():
+    limiter = EgressLimiter('direct', max_rate=2, min_rate=0.1, burst=1,
+                            increase=1, cooldown=60)
+    limiter.acquire()
+
+    # Queued requests are admitted in priority order
+    admitted = []
+
+    def acquire(priority):
+        limiter.acquire(priority, timeout=5)
+        admitted.append(priority)
+
+    threads = []
+    for priority in [PRIORITY_ELEMENT, PRIORITY_SEARCH]:
+        threads.append(threading.Thread(target=acquire, args=(priority,)))
+        threads[-1].start()
+        while len(limiter._waiters) < len(threads):
+            time.sleep(0.001)
+    for thread in threads:
+        thread.join()
+    assert admitted == [PRIORITY_SEARCH, PRIORITY_ELEMENT]
+
+    # Captchas halve the rate and block background requests, and the rate
+    # recovers with each successful response
+    limiter.on_captcha()
+    limiter.on_captcha()
+    assert limiter.stats()['rate'] == 0.5 and limiter.blocked
+    try:
+        limiter.acquire(PRIORITY_BACKGROUND)
+        assert False
+    except AdmissionError:
+        pass
+    limiter.on_success()
+    assert limiter.rate == 1.5
+
+    # Requests that can't get a turn in time aren't sent
+    try:
+        limiter.acquire(PRIORITY_SEARCH, timeout=0)
+        assert False
+    except AdmissionError:
+        pass
+    assert limiter.stats()['queue_depth'] == 0
+
+    limiter.reset()
+    assert not limiter.blocked and limiter.rate == 2
+
+
+def test_paced_upstream_hosts(monkeypatch):
+    def get(url, **kwargs):
+        response = Response()
+        response.status_code = 200
+        response._content = b'<toplevel></toplevel>'
+        return response
+
+    scheduler = UpstreamScheduler(max_wait=0, max_rate=0.01, burst=1)
+    monkeypatch.setattr('app.request.requests.get', get)
+    monkeypatch.setattr('app.request.upstream_scheduler', scheduler)
+    with app.app_context():
+        user = Request('Mozilla/5.0', 'http://localhost:5000',
+                       config=Config(**{}))
+
+    # Searches and suggestions share the egress identity's bucket, and
+    # don't wait once it's empty
+    user.send(query='whoogle')
+    for send in (lambda: user.send(query='other'),
+                 lambda: user.autocomplete('who')):
+        try:
+            send()
+            assert False
+        except AdmissionError:
+            pass
+
+    # Media from other hosts isn't paced
+    for idx in range(5):
+        user.send(base_url=f'https://example.com/{idx}.png')
+    assert scheduler.stats()['direct']['admitted'] == 1
+
+
+def test_classify_response():
+    def make_response(status_code=200, body=b'results', url=''):
+        response = Response()
+        response.status_code = status_code
+        response._content = body
+        response.url = url
+        return response
+
+    assert classify_response(make_response()) == VERDICT_OK
+    assert classify_response(make_response(
+        body=b'<div class="g-recaptcha"></div>')) == VERDICT_CAPTCHA
+    assert classify_response(make_response(status_code=429)) == \
+        VERDICT_BLOCKED
+    assert classify_response(make_response(
+        url='https://www.google.com/sorry/index?continue=')) == \
+        VERDICT_BLOCKED
+    assert classify_response(make_response(status_code=502)) == \
+        VERDICT_ERROR
+
+
+class StubBackend(SearchBackend):
+    """A local backend that answers once released (right away by default),
+    or blocks every request"""
+
+    def __init__(self, name, release=None, blocked=False):
+        super().__init__(name)
+        self.release = release
+        self.blocked = blocked
+
+    def fetch(self, search, user_request, full_query, priority):
+        if self.release is not None:
+            self.release.wait(10)
+        if self.blocked:
+            raise BackendBlocked(self.name)
+        return f'{self.name} results for {full_query}'
+
+
+def test_backend_hedging():
+    def fetch(pool):
+        start = time.monotonic()
+        page = pool.fetch(
+            lambda backend: backend.fetch(None, None, 'whoogle',
+                                          PRIORITY_SEARCH),
+            lambda page: 'captcha' not in page)
+        return page, time.monotonic() - start
+
+    # Backends that never answer on their own are released at the end, and
+    # timings only assert that a hedge wasn't waited for (hedge delays are
+    # far longer than the test should ever take)
+    release = threading.Event()
+
+    # A slow primary is hedged after the delay, and the secondary wins
+    slow, fast = StubBackend('slow', release), StubBackend('fast')
+    pool = BackendPool([slow, fast], hedge_delay=0.1)
+    page, elapsed = fetch(pool)
+    assert page == 'fast results for whoogle'
+    assert elapsed >= 0.1
+    assert fast.wins == 1 and slow.wins == 0
+
+    # The primary is used on its own while it answers within the delay
+    primary = StubBackend('primary')
+    secondary = StubBackend('secondary')
+    pool = BackendPool([primary, secondary], hedge_delay=30)
+    assert fetch(pool)[0] == 'primary results for whoogle'
+    assert secondary.attempts == 0
+
+    # A primary that blocks fails over to the secondary, and is then hedged
+    # right away while it's still blocking
+    blocked = StubBackend('blocked', blocked=True)
+    pool = BackendPool([blocked, StubBackend('fallback')], hedge_delay=30)
+    assert fetch(pool)[0] == 'fallback results for whoogle'
+    assert blocked.is_blocking()
+    blocked.release = release
+    page, elapsed = fetch(pool)
+    assert page == 'fallback results for whoogle' and elapsed < 10
+
+    # If every backend is blocked, the primary's error is raised
+    pool = BackendPool([StubBackend('a', blocked=True),
+                        StubBackend('b', blocked=True)], hedge_delay=0.1)
+    try:
+        fetch(pool)
+        assert False
+    except BackendBlocked as e:
+        assert str(e) == 'a'
+
+    # Searches don't queue behind attempts that are still running: while
+    # every worker is busy, the primary is used on the caller's thread
+    primary, secondary = StubBackend('primary', release), \
+        StubBackend('secondary')
+    pool = BackendPool([primary, secondary], hedge_delay=0.1, max_workers=2)
+    assert fetch(pool)[0] == 'secondary results for whoogle'
+    primary.release = None
+    pool.max_workers = 1
+    assert fetch(pool)[0] == 'primary results for whoogle'
+    assert primary.attempts == 2 and secondary.attempts == 1
+    release.set()
+
+
+def test_metrics_registry():
+    registry = Registry()
+    counter = registry.counter('test_total', 'Test counter', ('kind',))
+    histogram = registry.histogram('test_seconds', 'Test histogram',
+                                   buckets=(0.1, 1))
+
+    # Each thread records into its own shard, which are summed on collection
+    def record():
+        for _ in range(1000):
+            counter.inc('a')
+        histogram.observe(0.5)
+
+    threads = [threading.Thread(target=record) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    counter.inc('b', amount=2)
+    histogram.observe(0.05)
+    histogram.observe(5)
+
+    assert counter.get('a') == 4000
+    # The shards of threads that have exited are folded into the base
+    assert len(counter._shards) == len(histogram._shards) == 1
+    lines = registry.render().splitlines()
+    assert '# TYPE test_total counter' in lines
+    assert 'test_total{kind="a"} 4000' in lines
+    assert 'test_total{kind="b"} 2' in lines
+    assert 'test_seconds_bucket{le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{le="1"} 5' in lines
+    assert 'test_seconds_bucket{le="+Inf"} 6' in lines
+    assert 'test_seconds_count 6' in lines
+
+
+def test_tracing(tmp_path):
+    tracer = Tracer(path=str(tmp_path / 'traces.jsonl'), enabled=True)
+
+    # Unsampled requests aren't traced, and their spans are no-ops
+    assert tracer.start_trace('GET /search') is None
+    with tracer.span('filter.clean') as span:
+        assert span is None
+
+    root = tracer.start_trace('GET /search', force=True, route='/search')
+    with tracer.span('upstream.send', attempt=0):
+        tracer.annotate(status=200)
+        with tracer.span('upstream.http'):
+            pass
+    try:
+        with tracer.span('filter.clean'):
+            raise ValueError('broken page')
+    except ValueError:
+        pass
+    root.end()
+
+    lines = (tmp_path / 'traces.jsonl').read_text().splitlines()
+    assert len(lines) == 1
+    spans = {_['name']: _ for _ in json.loads(lines[0])[
+        'resourceSpans'][0]['scopeSpans'][0]['spans']}
+    assert spans['GET /search']['parentSpanId'] == ''
+    assert spans['upstream.send']['parentSpanId'] == root.span_id
+    assert spans['upstream.http']['parentSpanId'] == \
+        spans['upstream.send']['spanId']
+    assert {'key': 'status', 'value': {'intValue': '200'}} in \
+        spans['upstream.send']['attributes']
+    assert spans['filter.clean']['status']['code'] == STATUS_ERROR
+    assert len({_['traceId'] for _ in spans.values()}) == 1
+
+
+def test_benchmark_corpus():
+    pages = load_corpus()
+    assert len(pages) == len(TABS) * 2 * 2
+    for page in pages:
+        with app.test_request_context('/search'):
+            soup = Filter(generate_key(), config=Config(**{}),
+                          mobile=page.mobile, query=DEFAULT_QUERY).clean(
+                BeautifulSoup(page.html, 'html.parser'))
+        links = {_['href'] for _ in soup.find_all('a', href=True)
+                 if _['href'].startswith('https://')}
+        # Each result links to its own page (though the odd result is
+        # removed by the ad filter)
+        assert len(links) >= page.num_results * 0.9, page.name
+
+    def run(*medians):
+        return {'results': [{'name': 'stage', 'page': str(idx),
+                             'median_ms': median}
+                            for idx, median in enumerate(medians)]}
+
+    rows = compare_benchmarks(run(10, 10, 10), run(10.5, 13, 8),
+                              threshold=0.1)
+    assert [_['verdict'] for _ in rows] == ['same', 'regression',
+                                            'improvement']
+
+
+def test_route_upstream(monkeypatch):
+    search = 'https://www.google.com/search?gbv=1&q=test'
+    assert route_upstream(search) == search
+
+    monkeypatch.setenv('WHOOGLE_UPSTREAM_URL', 'http://localhost:5050/')
+    assert route_upstream(search) == \
+        'http://localhost:5050/search?gbv=1&q=test'
+    assert route_upstream(
+        'https://suggestqueries.google.com/complete/search?q=t'
+    ) == 'http://localhost:5050/complete/search?q=t'
+    assert route_upstream('https://github.com/favicon.ico') == \
+        'http://localhost:5050/element?url=https%3A%2F%2Fgithub.com%2F' \
+        'favicon.ico'
+
+
+def test_loadgen_reports():
+    assert parse_mix('search=3, window') == {'search': 3, 'window': 1}
+    for mix in ('search=1,images=1', 'search=0'):
+        try:
+            parse_mix(mix)
+            assert False, mix
+        except ValueError:
+            pass
+
+    summary = summarize([_ / 1000 for _ in range(100, 0, -1)], 5, 10)
+    assert summary['requests'] == 100 and summary['error_rate'] == 0.05
+    assert summary['throughput_rps'] == 10
+    assert (summary['p50_ms'], summary['p95_ms'], summary['p99_ms'],
+            summary['max_ms']) == (50, 95, 99, 100)
+
+    # Resource usage is read from the instance's own metrics
+    samples = parse_metrics(metrics_registry.render())
+    assert samples['process_cpu_seconds_total'] > 0
+    assert samples['process_resident_memory_bytes'] > 0
+
+    def run(throughput, p95, error_rate):
+        summary = {'requests': 100, 'throughput_rps': throughput,
+                   'error_rate': error_rate, 'p50_ms': 10, 'p95_ms': p95,
+                   'p99_ms': p95, 'max_ms': p95}
+        return {'total': summary, 'routes': {'search': summary}}
+
+    rows = compare(run(50, 100, 0), run(40, 90, 0.05))
+    verdicts = {_['measure']: _['verdict'] for _ in rows
+                if _['route'] == 'search'}
+    assert verdicts == {'throughput_rps': 'regression',
+                        'error_rate': 'regression', 'p50_ms': 'same',
+                        'p95_ms': 'same', 'p99_ms': 'same', 'max_ms': 'same'}
+    assert compare(run(50, 100, 0), run(50, 150, 0))[-1]['verdict'] == \
+        'slower'
@@ -1,15 +1,24 @@
+import os
+import time
 from bs4 import BeautifulSoup
+from app import app
 from app.filter import Filter
 from app.models.config import Config
 from app.models.endpoint import Endpoint
-from app.utils import results
+from app.request import Request
+from app.utils import results, search
+from app.utils.page_cache import PageCache
+from app.utils.prefetch import Prefetcher
 from app.utils.session import generate_key
 from datetime import datetime
 from dateutil.parser import ParserError, parse
+from requests.models import Response
 from urllib.parse import urlparse
 
 from test.conftest import demo_config
 
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+
 
 def get_search_results(data):
     secret_key = generate_key()
@@ -165,3 +174,152 @@ def test_site_alt_prefix_skip():
     assert results.get_site_alt(link = 'https://www.reddit.com', site_alts = test_site_alts) == 'https://reddit.endswithmobile.domain'
     assert results.get_site_alt(link = 'https://www.twitter.com', site_alts = test_site_alts) == 'https://twitter.endswithm.domain'
     assert results.get_site_alt(link = 'https://www.youtube.com', site_alts = test_site_alts) == 'http://yt.endswithwww.domain'
+
+
+def test_tabs_content():
+    tab_templates = results.compile_tabs(app.config['HEADER_TABS'])
+    translation = app.config['TRANSLATIONS']['lang_en']
+
+    tabs = results.get_tabs_content(
+        tab_templates,
+        'test+-site:example.com&start=10&tbm=isch',
+        'isch',
+        'prefs',
+        translation)
+
+    assert tabs['images']['selected'] and not tabs['all']['selected']
+    assert tabs['all']['href'] == \
+        'search?q=test+-site:example.com&preferences=prefs'
+    assert tabs['videos']['href'] == \
+        'search?q=test+-site:example.com&tbm=vid&preferences=prefs'
+    assert tabs['maps']['href'] == 'https://maps.google.com/maps?q=test+'
+    assert tabs['news']['name'] == translation['news']
+
+    tabs = results.get_tabs_content(tab_templates, 'test', '', '',
+                                    translation)
+    assert tabs['all']['selected'] and not tabs['maps']['selected']
+    assert tabs['images']['href'] == 'search?q=test&tbm=isch'
+
+
+def test_extract_results():
+    with open(os.path.join(FIXTURES_DIR, 'results.html')) as f:
+        soup = BeautifulSoup(f.read(), 'html.parser')
+
+    with app.test_request_context(f'/{Endpoint.search}?q=whoogle'):
+        soup = Filter(generate_key(), config=Config(**{})).clean(soup)
+
+    page = results.extract_results(soup)
+    assert len(page) == 2
+    assert page.first_link == 'https://github.com/benbusby/whoogle-search'
+
+    result = page.results[0]
+    assert result.title.startswith('GitHub - benbusby/whoogle-search')
+    assert result.display_url.startswith('github.com')
+    assert result.snippet == \
+        'A self-hosted, ad-free, privacy-respecting metasearch engine.'
+    assert result.sitelinks == [
+        ('Releases', 'https://github.com/benbusby/whoogle-search/releases'),
+        ('Issues', 'https://github.com/benbusby/whoogle-search/issues')]
+
+    currency = page.get_card('currency')
+    assert currency.data['currencyValue2'] == 83.12
+    assert page.next_start == 10 and page.prev_start is None
+
+
+def test_result_records_in_search(client, monkeypatch):
+    with open(os.path.join(FIXTURES_DIR, 'results.html')) as f:
+        body = f.read()
+
+    def send(*args, **kwargs):
+        response = Response()
+        response.status_code = 200
+        response._content = body.encode()
+        response.encoding = 'utf-8'
+        return response
+
+    monkeypatch.setattr(Request, 'send', send)
+
+    rv = client.get(f'/{Endpoint.search}?q=whoogle')
+    assert rv._status_code == 200
+    assert b'conversion_box' in rv.data
+    assert b'st-card' not in rv.data
+
+    rv = client.get(f'/{Endpoint.search}?q=whoogle%20!')
+    assert rv._status_code == 303
+    assert rv.headers.get('Location') == \
+        'https://github.com/benbusby/whoogle-search'
+
+
+def test_json_search(client, monkeypatch):
+    with open(os.path.join(FIXTURES_DIR, 'results.html')) as f:
+        body = f.read()
+
+    def send(*args, **kwargs):
+        response = Response()
+        response.status_code = 200
+        response._content = body.encode()
+        response.encoding = 'utf-8'
+        return response
+
+    monkeypatch.setattr(Request, 'send', send)
+
+    rv = client.get(f'/{Endpoint.search}?q=whoogle&format=json')
+    assert rv._status_code == 200
+    data = rv.get_json()
+    assert data['query'] == 'whoogle'
+    assert data['results'][0]['url'] == \
+        'https://github.com/benbusby/whoogle-search'
+    assert data['results'][0]['sitelinks'][0]['title'] == 'Releases'
+    assert data['cards'][0]['type'] == 'currency'
+    assert data['next_start'] == 10
+
+    rv = client.get(f'/{Endpoint.search}?q=&format=json')
+    assert rv._status_code == 400
+
+    # Records are cached with the page, so it's only parsed once
+    page_cache = PageCache()
+    monkeypatch.setattr(search, 'page_cache', page_cache)
+    for _ in range(2):
+        rv = client.get(f'/{Endpoint.search}?q=whoogle&format=json')
+        assert rv.get_json()['results'] == data['results']
+    assert page_cache.stats()['record_hits'] == 1
+
+
+def test_next_page_prefetch(client, monkeypatch):
+    with open(os.path.join(FIXTURES_DIR, 'results.html')) as f:
+        body = f.read()
+
+    queries = []
+
+    def send(*args, query='', **kwargs):
+        queries.append(query)
+        response = Response()
+        response.status_code = 200
+        response._content = body.encode()
+        response.encoding = 'utf-8'
+        return response
+
+    page_cache = PageCache()
+    prefetcher = Prefetcher(page_cache, max_load=0)
+    monkeypatch.setattr(Request, 'send', send)
+    monkeypatch.setattr(search, 'page_cache', page_cache)
+    monkeypatch.setattr(search, 'prefetcher', prefetcher)
+
+    rv = client.get(f'/{Endpoint.search}?q=whoogle')
+    assert rv._status_code == 200
+    for _ in range(500):
+        if prefetcher.completed:
+            break
+        time.sleep(0.01)
+    assert len(queries) == 2 and '&start=10' in queries[1]
+
+    # The next page is served from the cache
+    rv = client.get(f'/{Endpoint.search}?q=whoogle&start=10')
+    assert rv._status_code == 200
+    assert len(queries) == 2
+    assert prefetcher.stats()['hit_ratio'] == 1.0
+
+    # Prefetching is paused while upstream is returning captchas
+    prefetcher.note_captcha()
+    client.get(f'/{Endpoint.search}?q=captcha')
+    assert prefetcher.stats()['skipped']['captcha'] == 1
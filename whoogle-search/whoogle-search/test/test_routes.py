@@ -1,7 +1,19 @@
 from app import app
 from app.models.endpoint import Endpoint
+from app.filter import Filter
+from app.request import Request
+from app.utils import metrics
+from app.tools.upstream_stub import StubBehaviour, UpstreamStub
+from app.utils.admission import UpstreamScheduler
+from app.utils.tracing import tracer, TRACE_HEADER, TRACE_ID_HEADER
+from requests.models import Response
 
+from collections import OrderedDict
+import brotli
+import gzip
 import json
+import os
+import re
 
 from test.conftest import demo_config
 
@@ -89,3 +101,232 @@ def test_opensearch(client):
     rv = client.get(f'/{Endpoint.opensearch}')
     assert rv._status_code == 200
     assert '<ShortName>Whoogle</ShortName>' in str(rv.data)
+
+
+def test_precompressed_assets(client):
+    asset_url = '/' + app.config['CACHE_BUSTING_MAP']['main.css']
+
+    rv = client.get(asset_url, headers={'Accept-Encoding': 'gzip, br'})
+    assert rv._status_code == 200
+    assert rv.headers.get('Content-Encoding') == 'br'
+    assert 'Accept-Encoding' in rv.headers.get('Vary')
+    assert 'immutable' in rv.headers.get('Cache-Control')
+    assert rv.mimetype == 'text/css'
+
+    rv = client.get(asset_url, headers={'Accept-Encoding': 'gzip'})
+    assert rv.headers.get('Content-Encoding') == 'gzip'
+
+    rv = client.get(asset_url, headers={'Accept-Encoding': 'identity'})
+    assert rv.headers.get('Content-Encoding') is None
+    assert b'{' in rv.data
+
+
+def test_compression(client):
+    rv = client.get('/', headers={'Accept-Encoding': 'br, gzip'})
+    assert rv._status_code == 200
+    assert rv.headers.get('Content-Encoding') == 'br'
+    assert 'Accept-Encoding' in rv.headers.get('Vary')
+    assert b'<html' in brotli.decompress(rv.data)
+
+    rv = client.get('/', headers={'Accept-Encoding': 'gzip'})
+    assert rv.headers.get('Content-Encoding') == 'gzip'
+    assert b'<html' in gzip.decompress(rv.data)
+
+    rv = client.get('/')
+    assert rv.headers.get('Content-Encoding') is None
+    assert b'<html' in rv.data
+
+
+def test_batch_search(client, monkeypatch):
+    fixture = os.path.join(os.path.dirname(__file__), 'fixtures',
+                           'results.html')
+    with open(fixture) as f:
+        body = f.read()
+
+    def send(*args, query='', **kwargs):
+        response = Response()
+        response.status_code = 200
+        response._content = (
+            '<div class="g-recaptcha"></div>' if 'blocked' in query
+            else body).encode()
+        response.encoding = 'utf-8'
+        return response
+
+    monkeypatch.setattr(Request, 'send', send)
+    monkeypatch.setattr(app.batch_limiter, 'interval', 0)
+
+    rv = client.post(f'/{Endpoint.batch}', json={'queries': [
+        'whoogle',
+        {'q': 'whoogle', 'tbm': 'nws', 'start': 10},
+        'blocked',
+        ''
+    ]})
+    assert rv._status_code == 200
+    assert rv.mimetype == 'application/x-ndjson'
+
+    items = [json.loads(_) for _ in rv.data.decode().splitlines()]
+    items = {_['index']: _ for _ in items}
+    assert len(items) == 4
+    assert items[0]['status'] == 200
+    assert items[0]['results'][0]['url'] == \
+        'https://github.com/benbusby/whoogle-search'
+    assert items[1]['search_type'] == 'nws' and items[1]['start'] == 10
+    assert items[2]['status'] == 503
+    assert items[3]['status'] == 400
+
+    rv = client.post(f'/{Endpoint.batch}', json={'queries': []})
+    assert rv._status_code == 400
+
+
+def test_blocked_upstream(client, monkeypatch):
+    def get(url, **kwargs):
+        response = Response()
+        response.status_code = 429
+        response.url = 'https://www.google.com/sorry/index?continue=' + url
+        response._content = b'<form id="captcha-form"></form>'
+        return response
+
+    def clean(*args, **kwargs):
+        raise AssertionError('Blocked pages should not be parsed')
+
+    scheduler = UpstreamScheduler()
+    monkeypatch.setattr('app.request.requests.get', get)
+    monkeypatch.setattr('app.request.upstream_scheduler', scheduler)
+    monkeypatch.setattr(Filter, 'clean', clean)
+
+    rv = client.get(f'/{Endpoint.search}?q=blocked')
+    assert rv._status_code == 503
+    assert scheduler.stats()['direct']['verdicts'] == {'blocked': 1}
+    assert scheduler.stats()['direct']['blocked']
+
+
+def test_metrics(client, monkeypatch):
+    def get(url, **kwargs):
+        response = Response()
+        response.status_code = 429
+        response._content = b''
+        return response
+
+    monkeypatch.setattr('app.request.requests.get', get)
+    monkeypatch.setattr('app.request.upstream_scheduler', UpstreamScheduler())
+
+    # The endpoint is off by default
+    rv = client.get(f'/{Endpoint.metrics}')
+    assert rv._status_code == 404
+    monkeypatch.setitem(app.config, 'METRICS', True)
+
+    healthz = metrics.http_requests.get(f'/{Endpoint.healthz}', 'GET', '200')
+    blocked = metrics.upstream_verdicts.get('direct', 'blocked')
+    client.get(f'/{Endpoint.healthz}')
+    client.get(f'/{Endpoint.healthz}')
+    client.get(f'/{Endpoint.search}?q=metrics')
+
+    rv = client.get(f'/{Endpoint.metrics}')
+    assert rv._status_code == 200
+    assert rv.headers['Content-Type'] == metrics.CONTENT_TYPE
+    assert rv.headers['Cache-Control'] == 'no-store'
+
+    text = rv.data.decode()
+    assert 'whoogle_http_requests_total{route="/healthz",method="GET",' \
+        f'status="200"}} {healthz + 2}' in text
+    assert f'whoogle_upstream_verdicts_total{{egress="direct",' \
+        f'verdict="blocked"}} {blocked + 1}' in text
+    assert 'whoogle_stage_duration_seconds_count{stage="fetch"}' in text
+    assert 'whoogle_http_requests_in_flight 1' in text
+    assert 'whoogle_cache_requests_total{cache="page",result="misses"}' in text
+
+    # Metrics require the instance's credentials, when they're set
+    monkeypatch.setenv('WHOOGLE_USER', 'user')
+    monkeypatch.setenv('WHOOGLE_PASS', 'pass')
+    with app.test_client() as anonymous:
+        rv = anonymous.get(f'/{Endpoint.metrics}')
+        assert rv._status_code == 401
+        rv = anonymous.get(f'/{Endpoint.metrics}',
+                           auth=('user', 'pass'))
+        assert rv._status_code == 200
+
+
+def test_forced_trace(client, monkeypatch, tmp_path):
+    def get(url, **kwargs):
+        response = Response()
+        response.status_code = 429
+        response._content = b''
+        return response
+
+    monkeypatch.setattr('app.request.requests.get', get)
+    monkeypatch.setattr('app.request.upstream_scheduler', UpstreamScheduler())
+    monkeypatch.setattr(tracer, 'enabled', True)
+    monkeypatch.setattr(tracer, 'sample_rate', 0)
+    monkeypatch.setattr(tracer, 'path', str(tmp_path / 'traces.jsonl'))
+
+    rv = client.get(f'/{Endpoint.search}?q=private')
+    assert TRACE_ID_HEADER not in rv.headers
+
+    rv = client.get(f'/{Endpoint.search}?q=private',
+                    headers={TRACE_HEADER: '1'})
+    trace = json.loads((tmp_path / 'traces.jsonl').read_text())
+    spans = trace['resourceSpans'][0]['scopeSpans'][0]['spans']
+    assert {_['traceId'] for _ in spans} == {rv.headers[TRACE_ID_HEADER]}
+
+    names = [_['name'] for _ in spans]
+    for name in ('GET /search', 'before_request', 'search.fetch',
+                 'upstream.send', 'upstream.http', 'render_template'):
+        assert name in names
+
+    # Queries aren't included in traced urls
+    assert 'private' not in json.dumps(
+        [_ for _ in spans if _['name'] == 'upstream.send'])
+
+
+def test_upstream_stub(client, monkeypatch):
+    stub = UpstreamStub(('127.0.0.1', 0), StubBehaviour(seed=0)).start()
+    monkeypatch.setenv('WHOOGLE_UPSTREAM_URL', stub.url)
+    monkeypatch.setattr('app.request.upstream_scheduler', UpstreamScheduler())
+    try:
+        rv = client.get(f'/{Endpoint.search}?q=stand-in+results')
+        assert rv._status_code == 200
+        assert b'stand-in results' in rv.data
+
+        rv = client.get(f'/{Endpoint.autocomplete}?q=stand-in')
+        assert json.loads(rv.data)[1][:2] == ['stand-in',
+                                              'stand-in self-hosted']
+
+        # Captchas injected by the stand-in are detected like real ones
+        stub.behaviour.update(captcha_rate=1)
+        rv = client.get(f'/{Endpoint.search}?q=stand-in+captcha')
+        assert rv._status_code == 503
+
+        assert stub.stats_snapshot() == {'search': {'ok': 1, 'captcha': 1},
+                                         'suggest': {'ok': 1}}
+    finally:
+        stub.stop()
+
+
+def test_style(client, monkeypatch):
+    monkeypatch.setitem(app.config, 'CONFIG_DISABLE', 0)
+    custom_css = '.custom-test-style { color: #123456; }'
+    rv = client.post(f'/{Endpoint.config}',
+                     data={**demo_config, 'style_modified': custom_css})
+    assert rv._status_code == 302
+
+    # The compiled style is linked from the home page, instead of inlined
+    rv = client.get('/')
+    assert b'custom-test-style' not in rv.data
+    style_url = re.search(rb'href="(style/[0-9a-f]+\.css)"',
+                          rv.data).group(1).decode()
+
+    rv = client.get(f'/{style_url}')
+    assert rv._status_code == 200
+    assert rv.mimetype == 'text/css'
+    assert 'custom-test-style' in rv.data.decode()
+    assert rv.cache_control.public and rv.cache_control.immutable
+    assert rv.cache_control.max_age == 31536000
+
+    # A digest that is no longer cached is rebuilt from the user's own style
+    monkeypatch.setattr('app.models.config._compiled_styles', OrderedDict())
+    rv = client.get(f'/{style_url}')
+    assert rv._status_code == 200
+    assert 'custom-test-style' in rv.data.decode()
+
+    rv = client.get(f'/{Endpoint.style}/0123456789abcdef.css')
+    assert rv._status_code == 404